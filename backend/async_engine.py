@@ -0,0 +1,303 @@
+"""
+Asyncio sync engine for the pharmacy backend
+
+Drop-in alternative to the threaded PharmacyDatabaseSync loop, selected with
+`python sync.py --sync --engine async`. All table reads and writes run
+concurrently over async HTTP, with a bounded number of requests in flight
+per Supabase instance. With `--listen` it is driven by realtime change
+events instead of the polling interval.
+"""
+
+import asyncio
+import signal
+import time
+
+import httpx
+from loguru import logger
+from supabase import acreate_client, AsyncClientOptions
+
+from config import (
+    REMOTE_SUPABASE_URL,
+    REMOTE_SERVICE_ROLE_KEY,
+    SYNC_INTERVAL_MINUTES,
+    SYNC_HTTP_POOL_SIZE,
+    SYNC_HTTP_KEEPALIVE_SECONDS,
+    SYNC_HTTP_TIMEOUT_SECONDS,
+    SYNC_MAX_IN_FLIGHT,
+    SYNC_RECONCILE_MINUTES,
+    SYNC_CRITICAL_INTERVAL_SECONDS,
+)
+from change_feed import ChangeFeed
+from resilience import AsyncBreakerTransport
+from steps import Query, Concurrently, PerTable, Blocking, Connect
+from sync import PharmacyDatabaseSync
+
+
+class AsyncPharmacyDatabaseSync(PharmacyDatabaseSync):
+    """Asyncio variant of PharmacyDatabaseSync, carrying out the same sync steps over async HTTP"""
+
+    def __init__(self, branch=None):
+        """Initialize the async sync class, for the local instance of branch if given"""
+        super().__init__(branch)
+
+        # Requests allowed in flight per Supabase instance
+        self.max_in_flight = SYNC_MAX_IN_FLIGHT
+        self.request_timeout = SYNC_HTTP_TIMEOUT_SECONDS
+        self._semaphores = {}
+        # Serializes full cycles and change-feed micro-batches
+        self._cycle_lock = asyncio.Lock()
+
+    async def connect_to_supabase(self, target="both"):
+        """Establish async connections to both Supabase instances"""
+        if target == "local":
+            try:
+                self.local_supabase = await self._create_client("local", self.local_url, self.local_key)
+                logger.info(f"Connected to local Supabase at {self.local_url}")
+                self.health_status = "Connected to local Supabase"
+            except Exception as e:
+                # A client that cannot be built (bad URL or key, missing HTTP/2 support) will not recover on a retry
+                logger.error(f"Failed to create local Supabase client: {e}")
+                self.local_supabase = None
+                self._set_unhealthy(f"Failed to create local Supabase client: {str(e)}")
+                raise
+        elif target == "remote":
+            try:
+                self.remote_supabase = await self._create_client("remote", REMOTE_SUPABASE_URL, REMOTE_SERVICE_ROLE_KEY)
+                logger.info(f"Connected to remote Supabase at {REMOTE_SUPABASE_URL}")
+                self.health_status = "Connected to remote Supabase"
+            except Exception as e:
+                logger.error(f"Failed to create remote Supabase client: {e}")
+                self.remote_supabase = None
+                self._set_unhealthy(f"Failed to create remote Supabase client: {str(e)}")
+                raise
+        elif target == "both":
+            await self.connect_to_supabase("local")
+            await self.connect_to_supabase("remote")
+        else:
+            logger.error(f"Invalid target: {target}")
+            return False
+        return True
+
+    async def _create_client(self, target, url, key):
+        """Create an async Supabase client on a pooled keep-alive HTTP client, replacing any previous one"""
+        previous_http_client = self._http_clients.pop(target, None)
+        if previous_http_client is not None:
+            await previous_http_client.aclose()
+
+        transport = httpx.AsyncHTTPTransport(
+            limits=httpx.Limits(
+                max_connections=SYNC_HTTP_POOL_SIZE,
+                max_keepalive_connections=SYNC_HTTP_POOL_SIZE,
+                keepalive_expiry=SYNC_HTTP_KEEPALIVE_SECONDS,
+            ),
+            http2=True,
+        )
+        http_client = httpx.AsyncClient(
+            transport=AsyncBreakerTransport(self.breakers[target], transport),
+            timeout=SYNC_HTTP_TIMEOUT_SECONDS,
+            follow_redirects=True,
+            event_hooks={"request": [self._count_request_bytes(target)], "response": [self._count_response_bytes(target)]},
+        )
+        self._http_clients[target] = http_client
+        self._semaphores[target] = asyncio.Semaphore(self.max_in_flight)
+
+        options = AsyncClientOptions(httpx_client=http_client, auto_refresh_token=False, persist_session=False)
+        return await acreate_client(url, key, options=options)
+
+    def _count_request_bytes(self, target):
+        """Build an async HTTP hook counting request body bytes sent to target and timing the request"""
+        async def hook(request):
+            self._request_sent(target, request)
+        return hook
+
+    def _count_response_bytes(self, target):
+        """Build an async HTTP hook counting response body bytes received from target and tracing the request"""
+        async def hook(response):
+            await response.aread()
+            self._response_received(target, response)
+        return hook
+
+    async def close(self):
+        """Close the pooled HTTP clients and the trace file"""
+        for http_client in self._http_clients.values():
+            await http_client.aclose()
+        self._http_clients.clear()
+        self.tracer.close()
+
+    async def _execute(self, target, query):
+        """Execute a query against target, bounded by its in-flight limit and the request timeout"""
+        async with self._semaphores[target]:
+            try:
+                return await asyncio.wait_for(query.execute(), self.request_timeout)
+            except TimeoutError:
+                # The transport only sees the request being cancelled
+                self.breakers[target].record_failure()
+                raise
+
+    async def _run_steps(self, steps):
+        """Drive a generator of sync steps (see steps.py) to completion, returning its result"""
+        result, error = None, None
+        while True:
+            try:
+                step = steps.send(result) if error is None else steps.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                result, error = await self._run_step(step), None
+            except BaseException as e:
+                result, error = None, e
+
+    async def _run_step(self, step):
+        """Carry out a single sync step"""
+        if isinstance(step, Query):
+            return await self._execute(step.target, step.query)
+        if isinstance(step, Concurrently):
+            return await asyncio.gather(*(self._run_steps(steps) for steps in step.steps))
+        if isinstance(step, PerTable):
+            return await self._run_per_table(lambda table: self._run_steps(step.sync_table(table)), step.tables, step.reverse)
+        if isinstance(step, Blocking):
+            # Compressing and syncing archive files to disk would block the event loop
+            return await asyncio.to_thread(step.function, *step.args)
+        if isinstance(step, Connect):
+            return await self.connect_to_supabase(step.target)
+        raise TypeError(f"Unknown sync step {step!r}")
+
+    async def ensure_connections(self):
+        """Reuse existing clients, reconnecting only those that are missing or fail a liveness probe"""
+        await self._run_steps(self._ensure_connections())
+
+    async def update_backlog(self):
+        """Refresh the backlog gauge of every table (only while metrics are served)"""
+        await self._run_steps(self._update_backlog())
+
+    async def sync_local_to_remote(self, tables=None):
+        """Sync data from local to remote database, optionally limited to some tables"""
+        await self._run_steps(self._push(tables))
+
+    async def sync_remote_to_local(self, tables=None):
+        """Sync data from remote to local database, optionally limited to some tables"""
+        await self._run_steps(self._pull(tables))
+
+    async def sync_critical_lanes(self):
+        """Sync only the tables of the lanes without a time budget, between full cycles"""
+        async with self._cycle_lock:
+            await self._run_steps(self._sync_critical_lanes())
+
+    async def _sync_critical_lanes_forever(self):
+        """Sync the critical lanes every SYNC_CRITICAL_INTERVAL_SECONDS"""
+        while True:
+            await asyncio.sleep(SYNC_CRITICAL_INTERVAL_SECONDS)
+            try:
+                await self.sync_critical_lanes()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Critical lane sync failed: {e}")
+                self._set_unhealthy(f"Critical lane sync failed: {str(e)}")
+
+    async def run_retention(self):
+        """Move rows past their retention period into archive files now; returns {target: {table: rows archived}}"""
+        return await self._run_steps(self.retention.run())
+
+    async def _run_per_table(self, sync_table, tables=None, reverse=False):
+        """Run sync_table for every table (or the given ones) concurrently, each waiting for the tables it references (or with reverse, referencing it)"""
+        dependencies = self._table_dependencies(tables, reverse)
+        finished = {table: asyncio.Event() for table in dependencies}
+
+        async def run_table(table):
+            try:
+                for parent in dependencies[table]:
+                    await finished[parent].wait()
+                await sync_table(table)
+            except Exception as e:
+                # Caught here, or the TaskGroup would cancel every other table
+                logger.error(f"Unexpected error syncing {table}: {e}")
+                self._set_unhealthy(f"Unexpected error syncing {table}: {str(e)}")
+            finally:
+                finished[table].set()
+
+        # A TaskGroup cancels every table task if the cycle itself is cancelled
+        async with asyncio.TaskGroup() as group:
+            for table in dependencies:
+                group.create_task(run_table(table))
+
+    async def run_sync(self):
+        """Run a complete sync cycle"""
+        async with self._cycle_lock:
+            await self._run_steps(self._run_cycle())
+
+    async def sync_changed_tables(self, push_tables, pull_tables):
+        """Sync only the tables the change feed reported as changed"""
+        if not self.local_supabase or not self.remote_supabase:
+            return
+
+        async with self._cycle_lock:
+            await self._run_steps(self._sync_changes(push_tables, pull_tables))
+        self.last_sync_time = time.strftime("%Y-%m-%dT%H:%M:%S")
+
+    def _sync_changes(self, push_tables, pull_tables):
+        """Steps of sync_changed_tables"""
+        with self.tracer.span("changes_cycle", node=self.node_id):
+            if push_tables:
+                yield from self._push(push_tables)
+            if pull_tables:
+                yield from self._pull(pull_tables)
+
+    async def serve(self, listen=False):
+        """Run sync cycles until cancelled.
+
+        Normally a full cycle runs every SYNC_INTERVAL_MINUTES, and the
+        critical lanes also every SYNC_CRITICAL_INTERVAL_SECONDS. With listen,
+        realtime changes are synced as they arrive and the full cycle only
+        runs every SYNC_RECONCILE_MINUTES as a safety net.
+        """
+        feed = None
+        feed_task = None
+        critical_task = None
+        interval_minutes = SYNC_INTERVAL_MINUTES
+        try:
+            await self.run_sync()
+
+            if listen and self.local_supabase and self.remote_supabase:
+                feed = ChangeFeed(self)
+                if await feed.subscribe():
+                    feed_task = asyncio.create_task(feed.run())
+                    interval_minutes = SYNC_RECONCILE_MINUTES
+                else:
+                    logger.warning("Change feed unavailable, falling back to interval polling")
+            if feed_task is None and SYNC_CRITICAL_INTERVAL_SECONDS:
+                critical_task = asyncio.create_task(self._sync_critical_lanes_forever())
+
+            while True:
+                await asyncio.sleep(interval_minutes * 60)
+                await self.run_sync()
+        except asyncio.CancelledError:
+            logger.info("Sync service cancelled, shutting down")
+            raise
+        finally:
+            if feed_task is not None:
+                feed_task.cancel()
+            if critical_task is not None:
+                critical_task.cancel()
+            if feed is not None:
+                await feed.close()
+            await self.close()
+
+    def start(self, listen=False):
+        """Start the async sync service"""
+        logger.info("Starting pharmacy database sync service (async engine)")
+        logger.info(f"Local Supabase URL: {self.local_url}")
+        logger.info(f"Remote Supabase URL: {REMOTE_SUPABASE_URL}")
+        self.start_metrics_server()
+
+        async def main():
+            task = asyncio.current_task()
+            loop = asyncio.get_running_loop()
+            # Stop cleanly on `docker stop`
+            loop.add_signal_handler(signal.SIGTERM, task.cancel)
+            await self.serve(listen)
+
+        try:
+            asyncio.run(main())
+        except (asyncio.CancelledError, KeyboardInterrupt):
+            logger.info("Sync service stopped")
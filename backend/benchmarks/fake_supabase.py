@@ -0,0 +1,378 @@
+"""
+In-process stand-in for a Supabase instance, for the sync benchmarks
+
+Implements the subset of the supabase-py / postgrest-py query builder the sync
+engines use (select, upsert, update, delete, eq/gt/in_/or_ filters, order,
+limit) plus the sync_apply_batch, sync_mark_synced, sync_archive_rows,
+sync_bucket_checksums and compact_sync_tombstones RPCs over plain dicts, counts
+every round trip and can add a fixed latency to each one to model the link. With capture_outbox it also
+mimics the sync_outbox trigger from sync_outbox.sql.
+"""
+
+import asyncio
+import copy
+import time
+from datetime import datetime, timedelta, timezone
+
+
+class FakeResponse:
+    """Mimics postgrest's APIResponse"""
+
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+
+
+class FakeAPIError(Exception):
+    """Mimics postgrest's APIError, which carries the PostgREST error code"""
+
+    def __init__(self, message, code):
+        super().__init__(message)
+        self.code = code
+
+
+def _split_top_level(expression):
+    """Split a PostgREST logic expression on commas outside parentheses and quotes"""
+    parts, depth, quoted, current = [], 0, False, ""
+    for char in expression:
+        if char == '"':
+            quoted = not quoted
+        elif not quoted and char == "(":
+            depth += 1
+        elif not quoted and char == ")":
+            depth -= 1
+        if char == "," and depth == 0 and not quoted:
+            parts.append(current)
+            current = ""
+        else:
+            current += char
+    parts.append(current)
+    return parts
+
+
+def _coerce(row_value, text):
+    """Convert a filter value from a logic expression to the column's type"""
+    if isinstance(row_value, bool):
+        return text == "true"
+    if isinstance(row_value, int):
+        return int(text)
+    if isinstance(row_value, float):
+        return float(text)
+    return text
+
+
+_OPERATORS = {
+    "eq": lambda a, b: a == b,
+    "neq": lambda a, b: a != b,
+    "gt": lambda a, b: a > b,
+    "gte": lambda a, b: a >= b,
+    "lt": lambda a, b: a < b,
+    "lte": lambda a, b: a <= b,
+}
+
+
+def _parse_logic(kind, expression):
+    """Build a row predicate from an or(...) / and(...) expression"""
+    terms = []
+    for part in _split_top_level(expression):
+        if part.startswith(("and(", "or(")):
+            nested = part[:part.index("(")]
+            terms.append(_parse_logic(nested, part[len(nested) + 1:-1]))
+            continue
+        column, operator, value = part.split(".", 2)
+        if operator == "in":
+            values = {item.strip('"') for item in _split_top_level(value[1:-1])}
+            terms.append(lambda row, column=column, values=values: str(row.get(column)) in values)
+            continue
+        value = value.strip('"')
+
+        def term(row, column=column, operator=operator, value=value):
+            row_value = row.get(column)
+            return row_value is not None and _OPERATORS[operator](row_value, _coerce(row_value, value))
+        terms.append(term)
+    if kind == "and":
+        return lambda row: all(term(row) for term in terms)
+    return lambda row: any(term(row) for term in terms)
+
+
+class FakeQuery:
+    """A single query against one table of a FakeSupabase"""
+
+    def __init__(self, db, table):
+        self.db = db
+        self.table = table
+        self.operation = "select"
+        self.function = None
+        self.columns = "*"
+        self.count = None
+        self.head = False
+        self.payload = None
+        self.conflict_columns = None
+        self.filters = []
+        self.ordering = []
+        self.row_limit = None
+        self.id_filter = None
+        self.params = None
+        self._negate = False
+
+    def select(self, columns="*", count=None, head=None):
+        self.operation, self.columns, self.count, self.head = "select", columns, count, bool(head)
+        return self
+
+    def upsert(self, rows, on_conflict="", **kwargs):
+        self.operation, self.payload = "upsert", rows if isinstance(rows, list) else [rows]
+        self.conflict_columns = on_conflict.split(",") if on_conflict else None
+        return self
+
+    def insert(self, rows, **kwargs):
+        self.operation, self.payload = "upsert", rows if isinstance(rows, list) else [rows]
+        return self
+
+    def update(self, values, **kwargs):
+        self.operation, self.payload = "update", values
+        return self
+
+    def delete(self, **kwargs):
+        self.operation = "delete"
+        return self
+
+    @property
+    def not_(self):
+        self._negate = True
+        return self
+
+    def _add(self, predicate):
+        negate, self._negate = self._negate, False
+        self.filters.append((lambda row: not predicate(row)) if negate else predicate)
+        return self
+
+    def eq(self, column, value):
+        return self._add(lambda row: row.get(column) == value)
+
+    def neq(self, column, value):
+        return self._add(lambda row: row.get(column) != value)
+
+    def gt(self, column, value):
+        return self._add(lambda row: row.get(column) is not None and row[column] > value)
+
+    def gte(self, column, value):
+        return self._add(lambda row: row.get(column) is not None and row[column] >= value)
+
+    def lt(self, column, value):
+        return self._add(lambda row: row.get(column) is not None and row[column] < value)
+
+    def lte(self, column, value):
+        return self._add(lambda row: row.get(column) is not None and row[column] <= value)
+
+    def in_(self, column, values):
+        values = {str(value) for value in values}
+        if column == "id" and not self._negate and self.id_filter is None:
+            # Look rows up by key instead of scanning the table
+            self.id_filter = values
+        return self._add(lambda row: str(row.get(column)) in values)
+
+    def or_(self, expression):
+        return self._add(_parse_logic("or", expression))
+
+    def order(self, column, desc=False):
+        self.ordering.append((column, desc))
+        return self
+
+    def limit(self, count):
+        self.row_limit = count
+        return self
+
+    def _candidates(self, rows):
+        if self.id_filter is None:
+            return rows.values()
+        by_text = self.db.id_index(self.table)
+        return [rows[by_text[record_id]] for record_id in self.id_filter if record_id in by_text]
+
+    def _matching(self, rows):
+        return [row for row in self._candidates(rows) if all(predicate(row) for predicate in self.filters)]
+
+    def run(self):
+        """Apply the query to the in-memory tables"""
+        self.db.round_trips += 1
+        rows = self.db.tables.setdefault(self.table, {})
+
+        if self.operation == "select":
+            result = self._matching(rows)
+            for column, desc in reversed(self.ordering):
+                result.sort(key=lambda row: (row.get(column) is None, row.get(column)), reverse=desc)
+            count = len(result)
+            if self.row_limit is not None:
+                result = result[:self.row_limit]
+            if self.head:
+                return FakeResponse([], count)
+            if self.columns != "*":
+                selected = [column.strip() for column in self.columns.split(",")]
+                result = [{column: row.get(column) for column in selected} for row in result]
+            return FakeResponse(copy.deepcopy(result), count)
+
+        if self.operation == "upsert":
+            for record in self.payload:
+                key = tuple(record[column] for column in self.conflict_columns) if self.conflict_columns else record["id"]
+                row = dict(rows.get(key, {}), **record)
+                self.db.put(self.table, row, key)
+                self.db.capture(self.table, row, "UPDATE")
+            return FakeResponse([])
+
+        if self.operation == "rpc":
+            if self.function == "sync_archive_rows":
+                # Archived rows are not captured as changes
+                removed = [record["id"] for record in self.payload if record["id"] in rows]
+                for record_id in removed:
+                    self.db.remove(self.table, record_id)
+                return FakeResponse(len(removed))
+            if self.function == "sync_mark_synced":
+                marked = 0
+                for record in self.payload:
+                    row = rows.get(record["id"])
+                    if row is not None and row.get("updated_at") == record["updated_at"]:
+                        row["synced"] = True
+                        marked += 1
+                return FakeResponse(marked)
+            if self.function == "compact_sync_tombstones":
+                return FakeResponse(self._compact_tombstones())
+            if self.function == "sync_bucket_checksums":
+                return FakeResponse(self._bucket_checksums(rows))
+            if self.function != "sync_apply_batch":
+                raise FakeAPIError(f"Could not find the function public.{self.function}", "PGRST202")
+            stored = []
+            for record in self.payload:
+                inserted = record["id"] not in rows
+                row = dict(rows.get(record["id"], {}), **record)
+                self.db.put(self.table, row)
+                self.db.capture(self.table, row, "UPDATE")
+                stored.append({"id": row["id"], "updated_at": row.get("updated_at"), "inserted": inserted})
+            return FakeResponse(stored)
+
+        if self.operation == "update":
+            for row in self._matching(rows):
+                row.update(self.payload)
+                self.db.capture(self.table, row, "UPDATE")
+            return FakeResponse([])
+
+        for row in self._matching(rows):
+            self.db.remove(self.table, row["id"])
+            self.db.capture(self.table, row, "DELETE")
+        return FakeResponse([])
+
+    def _compact_tombstones(self):
+        """Remove old tombstones every node has acknowledged, like compact_sync_tombstones"""
+        cutoff = datetime.now(timezone.utc) - timedelta(days=self.params["retention_days"])
+        acked = {}
+        for ack in self.db.tables.get("sync_tombstone_acks", {}).values():
+            acked[ack["table_name"]] = min(acked.get(ack["table_name"], ack["last_seq"]), ack["last_seq"])
+        removed = [
+            tombstone["id"] for tombstone in self.db.tables.get("sync_tombstones", {}).values()
+            if datetime.fromisoformat(tombstone["deleted_at"]).replace(tzinfo=timezone.utc) < cutoff
+            and tombstone["seq"] <= acked.get(tombstone["table_name"], -1)
+        ]
+        for record_id in removed:
+            self.db.remove("sync_tombstones", record_id)
+        return len(removed)
+
+    def _bucket_checksums(self, rows):
+        """Row count and checksum per id bucket, leaving synced and updated_at out like sync_bucket_checksums"""
+        size, min_id, max_id = self.params["p_bucket_size"], self.params["p_min_id"], self.params["p_max_id"]
+        buckets = {}
+        for record_id in sorted(rows):
+            if (min_id is not None and record_id < min_id) or (max_id is not None and record_id >= max_id):
+                continue
+            content = {column: value for column, value in rows[record_id].items() if column not in ("synced", "updated_at")}
+            buckets.setdefault(record_id // size, []).append(repr(sorted(content.items())))
+        return [
+            {"bucket": bucket, "row_count": len(contents), "checksum": hash(tuple(contents))}
+            for bucket, contents in buckets.items()
+        ]
+
+    def execute(self):
+        if self.db.latency:
+            time.sleep(self.db.latency)
+        return self.run()
+
+
+class AsyncFakeQuery(FakeQuery):
+    """FakeQuery whose execute is a coroutine, for the async engine"""
+
+    async def execute(self):
+        if self.db.latency:
+            await asyncio.sleep(self.db.latency)
+        return self.run()
+
+
+class FakeSupabase:
+    """In-memory Supabase instance counting round trips"""
+
+    query_class = FakeQuery
+
+    def __init__(self, latency=0.0, capture_outbox=False):
+        """latency is added to every round trip, in seconds"""
+        self.tables = {}
+        self.latency = latency
+        self.capture_outbox = capture_outbox
+        self.round_trips = 0
+        self._id_indexes = {}
+        self._outbox_seq = 0
+
+    def table(self, name):
+        return self.query_class(self, name)
+
+    def rpc(self, name, params):
+        """Call a database function; only the sync service's own functions exist here"""
+        query = self.query_class(self, params.get("p_table"))
+        query.operation, query.function, query.payload = "rpc", name, params.get("p_rows")
+        query.params = params
+        return query
+
+    def id_index(self, table):
+        """Return {str(id): id} for a table"""
+        index = self._id_indexes.get(table)
+        if index is None:
+            index = {str(record_id): record_id for record_id in self.tables.get(table, {})}
+            self._id_indexes[table] = index
+        return index
+
+    def put(self, table, row, key=None):
+        """Store row under key (its id by default)"""
+        key = row["id"] if key is None else key
+        self.tables.setdefault(table, {})[key] = row
+        if table in self._id_indexes:
+            self._id_indexes[table][str(key)] = key
+
+    def remove(self, table, record_id):
+        del self.tables[table][record_id]
+        self._id_indexes.get(table, {}).pop(str(record_id), None)
+
+    def reserve_seq(self):
+        """Take the next sync_outbox seq without writing an event, as a transaction that has not committed yet does"""
+        self._outbox_seq += 1
+        return self._outbox_seq
+
+    def capture(self, table, row, operation, seq=None):
+        """Record a change in sync_outbox the way the capture trigger does.
+
+        seq is a value taken earlier with reserve_seq, for a change whose
+        transaction commits after later ones.
+        """
+        if not self.capture_outbox or table.startswith("sync_"):
+            return
+        if operation != "DELETE" and row.get("synced") is True:
+            return
+        if seq is None:
+            seq = self.reserve_seq()
+        self.put("sync_outbox", {
+            "id": seq,
+            "seq": seq,
+            "table_name": table,
+            "record_id": str(row["id"]),
+            "op": operation,
+        })
+
+
+class AsyncFakeSupabase(FakeSupabase):
+    """FakeSupabase for the async engine"""
+
+    query_class = AsyncFakeQuery
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+Sync throughput benchmark
+
+Runs the sync engines against two in-process Supabase stand-ins (see
+fake_supabase.py) seeded with products, sales and sale_items, and reports
+rows/s (from the rows the engine counted as synced), round trips, cycle latency and peak RSS for both directions as JSON:
+
+    python benchmarks/sync_benchmark.py --products 5000 --sales 2000 --latency-ms 20
+    python benchmarks/sync_benchmark.py --engine async --output results.json
+
+Numbers are only comparable between runs with the same arguments.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+BENCHMARK_TABLES = ["categories", "products", "customers", "sales", "sale_items"]
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MiB, or None where it cannot be measured"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KiB elsewhere
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def seed(db, args, id_offset, synced, timestamp):
+    """Fill db with categories, products, customers, sales and sale_items; returns the row count"""
+    def put(table, row):
+        if synced is not None:
+            row["synced"] = synced
+        row["updated_at"] = timestamp
+        db.put(table, row)
+        db.capture(table, row, "INSERT")
+
+    categories = max(1, args.products // 100)
+    for index in range(categories):
+        put("categories", {"id": id_offset + index, "name": f"Category {index}", "description": "x" * 200})
+    for index in range(args.products):
+        put("products", {
+            "id": id_offset + index,
+            "name": f"Product {index}",
+            "category_id": id_offset + index % categories,
+            "price": round(1 + index % 500 * 0.25, 2),
+            "quantity": index % 300,
+            "description": "Lorem ipsum dolor sit amet " * 8,
+        })
+    customers = max(1, args.sales // 10)
+    for index in range(customers):
+        put("customers", {"id": id_offset + index, "name": f"Customer {index}", "total_spent": 0.0, "loyalty_points": 0})
+    item_id = id_offset
+    for index in range(args.sales):
+        put("sales", {"id": id_offset + index, "customer_id": id_offset + index % customers, "total": 0.0})
+        for item in range(args.items_per_sale):
+            put("sale_items", {
+                "id": item_id,
+                "sale_id": id_offset + index,
+                "product_id": id_offset + (index + item) % max(1, args.products),
+                "quantity": 1 + item,
+                "unit_price": 2.5,
+            })
+            item_id += 1
+    return categories + args.products + customers + args.sales * (1 + args.items_per_sale)
+
+
+def rows_synced(engine, direction):
+    """Rows the engine has counted as synced in direction so far"""
+    counters = engine.metrics.rows_pushed if direction == "local_to_remote" else engine.metrics.rows_pulled
+    return sum(counters.values())
+
+
+def measure(engine, local, remote, direction):
+    """Run one direction of the sync on engine and return its measurements"""
+    local.round_trips = remote.round_trips = 0
+    rows_before = rows_synced(engine, direction)
+    sync = engine.sync_local_to_remote if direction == "local_to_remote" else engine.sync_remote_to_local
+    started = time.perf_counter()
+    if asyncio.iscoroutinefunction(sync):
+        asyncio.run(with_semaphores(engine, sync))
+    else:
+        sync()
+    seconds = time.perf_counter() - started
+    rows = rows_synced(engine, direction) - rows_before
+    return {
+        "rows": rows,
+        "seconds": round(seconds, 4),
+        "rows_per_second": round(rows / seconds, 1) if seconds and rows else None,
+        "round_trips": {"local": local.round_trips, "remote": remote.round_trips},
+    }
+
+
+async def with_semaphores(engine, sync):
+    """Run an async engine coroutine, creating the per-target semaphores its client setup would"""
+    engine._semaphores = {target: asyncio.Semaphore(engine.max_in_flight) for target in ("local", "remote")}
+    await sync()
+
+
+def run(args):
+    """Run the benchmark scenario and return the results"""
+    # The engines read their settings at import time
+    workdir = tempfile.mkdtemp(prefix="sync-benchmark-")
+    os.chdir(workdir)
+    os.environ.setdefault("SYNC_INTERVAL_MINUTES", "5")
+    os.environ["SYNC_STATE_FILE"] = os.path.join(workdir, "sync_state.db")
+    os.environ["SYNC_METRICS_PORT"] = "0"
+    os.environ["SYNC_PUSH_SOURCE"] = args.push_source
+    if args.batch_size:
+        os.environ["SYNC_BATCH_SIZE"] = str(args.batch_size)
+    if args.page_size:
+        os.environ["SYNC_PAGE_SIZE"] = str(args.page_size)
+
+    from loguru import logger
+    from fake_supabase import FakeSupabase, AsyncFakeSupabase
+
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    if args.engine == "async":
+        from async_engine import AsyncPharmacyDatabaseSync
+        engine = AsyncPharmacyDatabaseSync()
+        fake_class = AsyncFakeSupabase
+    else:
+        from sync import PharmacyDatabaseSync
+        engine = PharmacyDatabaseSync()
+        fake_class = FakeSupabase
+
+    latency = args.latency_ms / 1000
+    local = fake_class(latency=latency, capture_outbox=args.push_source == "outbox")
+    remote = fake_class(latency=latency)
+    engine.PHARMACY_DB_TABLES = list(BENCHMARK_TABLES)
+    engine.local_supabase, engine.remote_supabase = local, remote
+
+    # Local changes made offline, pushed in one cycle
+    push_rows = seed(local, args, id_offset=1, synced=False, timestamp="2026-01-01T08:00:00")
+    push = measure(engine, local, remote, "local_to_remote")
+    push["rows_seeded"] = push_rows
+
+    # Changes made at HQ, pulled in one cycle (ids beyond the pushed ones)
+    pull_rows = seed(remote, args, id_offset=10_000_000, synced=None, timestamp="2026-01-01T09:00:00")
+    pull = measure(engine, local, remote, "remote_to_local")
+    pull["rows_seeded"] = pull_rows
+    # The pushed rows come back in the same pull and should not be written again
+    pull["echoes_skipped"] = sum(engine.metrics.echoes_skipped.values())
+
+    # A cycle with nothing to do, which is what most cycles look like
+    idle_push = measure(engine, local, remote, "local_to_remote")
+    idle_pull = measure(engine, local, remote, "remote_to_local")
+
+    return {
+        "engine": args.engine,
+        "parameters": {
+            "products": args.products,
+            "sales": args.sales,
+            "items_per_sale": args.items_per_sale,
+            "latency_ms": args.latency_ms,
+            "push_source": args.push_source,
+            "batch_size": engine.max_batch_size,
+            "page_size": engine.page_size,
+        },
+        "local_to_remote": push,
+        "remote_to_local": pull,
+        "idle_cycle": {
+            "seconds": round(idle_push["seconds"] + idle_pull["seconds"], 4),
+            "round_trips": {
+                target: idle_push["round_trips"][target] + idle_pull["round_trips"][target]
+                for target in ("local", "remote")
+            },
+        },
+        "peak_rss_mb": peak_rss_mb(),
+        "python": platform.python_version(),
+    }
+
+
+def main():
+    """Parse arguments, run the benchmark and print the JSON results"""
+    parser = argparse.ArgumentParser(description="Benchmark the pharmacy sync engines against in-process Supabase stand-ins")
+    parser.add_argument("--engine", choices=["threaded", "async"], default="threaded", help="Sync engine to benchmark")
+    parser.add_argument("--products", type=int, default=2000, help="Products to seed on each side")
+    parser.add_argument("--sales", type=int, default=2000, help="Sales to seed on each side")
+    parser.add_argument("--items-per-sale", type=int, default=3, help="sale_items per sale")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Simulated latency of every round trip")
+    parser.add_argument("--push-source", choices=["outbox", "scan"], default="outbox", help="Where pushed changes are read from")
+    parser.add_argument("--batch-size", type=int, help="Override SYNC_BATCH_SIZE")
+    parser.add_argument("--page-size", type=int, help="Override SYNC_PAGE_SIZE")
+    parser.add_argument("--output", help="Also write the JSON results to this file")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output else None
+    results = run(args)
+    text = json.dumps(results, indent=2)
+    print(text)
+    if output:
+        with open(output, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
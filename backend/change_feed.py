@@ -0,0 +1,101 @@
+"""
+Change-feed driven sync for the pharmacy backend
+
+Listens to Supabase Realtime row changes on both instances and turns them into
+small per-direction micro-batches, so a change reaches the other side within
+seconds instead of waiting for the next polling interval.
+
+Realtime only reports tables that are part of the `supabase_realtime`
+publication on each instance:
+
+    ALTER PUBLICATION supabase_realtime ADD TABLE products, categories, ...;
+"""
+
+import asyncio
+
+from loguru import logger
+from realtime import RealtimeSubscribeStates
+
+from config import SYNC_FEED_DEBOUNCE_SECONDS, SYNC_HTTP_TIMEOUT_SECONDS
+
+
+class ChangeFeed:
+    """Coalesces realtime change events into per-direction sets of dirty tables"""
+
+    def __init__(self, engine):
+        """Attach the feed to an AsyncPharmacyDatabaseSync engine"""
+        self.engine = engine
+        self.debounce_seconds = SYNC_FEED_DEBOUNCE_SECONDS
+        self._dirty = {"local_to_remote": set(), "remote_to_local": set()}
+        self._changed = asyncio.Event()
+        self._channels = []
+
+    async def subscribe(self):
+        """Subscribe to row changes of every synced table on both instances.
+
+        Returns False if either subscription could not be set up, in which
+        case the caller should fall back to interval polling.
+        """
+        sources = (
+            (self.engine.local_supabase, "local", "local_to_remote"),
+            (self.engine.remote_supabase, "remote", "remote_to_local"),
+        )
+        try:
+            for client, target, direction in sources:
+                channel = client.channel(f"pharmacy-sync-{target}")
+                for table in self.engine.PHARMACY_DB_TABLES:
+                    channel.on_postgres_changes(
+                        "*", schema="public", table=table, callback=self._on_change(direction, target)
+                    )
+                await asyncio.wait_for(channel.subscribe(self._on_state(target)), SYNC_HTTP_TIMEOUT_SECONDS)
+                self._channels.append((client, channel))
+            logger.info("Subscribed to realtime changes on local and remote Supabase")
+            return True
+        except Exception as e:
+            logger.error(f"Failed to subscribe to realtime changes: {e!r}")
+            return False
+
+    async def close(self):
+        """Unsubscribe from all realtime channels"""
+        for client, channel in self._channels:
+            try:
+                await client.remove_channel(channel)
+            except Exception as e:
+                logger.warning(f"Error removing realtime channel: {e}")
+        self._channels.clear()
+
+    def _on_change(self, direction, target):
+        """Build the callback marking a table dirty for direction"""
+        def callback(payload):
+            data = payload.get("data", {})
+            record = data.get("record") or {}
+            # Local writes applied by the puller are already synced, so don't echo them back
+            if target == "local" and record.get("synced") is True:
+                return
+            self._dirty[direction].add(data.get("table"))
+            self._changed.set()
+        return callback
+
+    def _on_state(self, target):
+        """Build the callback logging subscription state changes for target"""
+        def callback(state, error):
+            if state == RealtimeSubscribeStates.SUBSCRIBED:
+                logger.info(f"Realtime channel on {target} Supabase subscribed")
+            elif state in (RealtimeSubscribeStates.CHANNEL_ERROR, RealtimeSubscribeStates.TIMED_OUT):
+                logger.warning(f"Realtime channel on {target} Supabase {state.value.lower()}: {error}")
+        return callback
+
+    async def run(self):
+        """Flush dirty tables as micro-batches until cancelled.
+
+        After the first change arrives the feed waits debounce_seconds so
+        that a burst of changes (e.g. a sale with its items) syncs together.
+        """
+        while True:
+            await self._changed.wait()
+            await asyncio.sleep(self.debounce_seconds)
+            self._changed.clear()
+
+            push_tables, self._dirty["local_to_remote"] = self._dirty["local_to_remote"], set()
+            pull_tables, self._dirty["remote_to_local"] = self._dirty["remote_to_local"], set()
+            await self.engine.sync_changed_tables(push_tables, pull_tables)
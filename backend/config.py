@@ -31,4 +31,60 @@ REMOTE_SERVICE_ROLE_KEY = os.getenv("REMOTE_SERVICE_ROLE_KEY")
 
 # Sync Configuration
 SYNC_INTERVAL_MINUTES = int(os.getenv("SYNC_INTERVAL_MINUTES"))
-SYNC_LOG_FILE = os.getenv("SYNC_LOG_FILE", "sync.log")
\ No newline at end of file
+SYNC_LOG_FILE = os.getenv("SYNC_LOG_FILE", "sync.log")
+# Number of rows sent to the remote per upsert request when pushing local changes
+SYNC_BATCH_SIZE = int(os.getenv("SYNC_BATCH_SIZE", "500"))
+# Number of rows fetched per page when reading changes (keep at or below PostgREST max-rows)
+SYNC_PAGE_SIZE = int(os.getenv("SYNC_PAGE_SIZE", "1000"))
+# Number of tables synced concurrently (tables linked by foreign keys still sync in order)
+SYNC_WORKERS = int(os.getenv("SYNC_WORKERS", "4"))
+# SQLite file holding the per-table sync watermarks
+SYNC_STATE_FILE = os.getenv("SYNC_STATE_FILE", "sync_state.db")
+# HTTP connection pool shared by each Supabase client across sync cycles
+SYNC_HTTP_POOL_SIZE = int(os.getenv("SYNC_HTTP_POOL_SIZE", "10"))
+SYNC_HTTP_KEEPALIVE_SECONDS = float(os.getenv("SYNC_HTTP_KEEPALIVE_SECONDS", "120"))
+SYNC_HTTP_TIMEOUT_SECONDS = float(os.getenv("SYNC_HTTP_TIMEOUT_SECONDS", "30"))
+# Requests in flight per Supabase instance when running the async engine
+SYNC_MAX_IN_FLIGHT = int(os.getenv("SYNC_MAX_IN_FLIGHT", "8"))
+# Change-feed mode: seconds to coalesce realtime changes, and minutes between full reconciliation cycles
+SYNC_FEED_DEBOUNCE_SECONDS = float(os.getenv("SYNC_FEED_DEBOUNCE_SECONDS", "1"))
+SYNC_RECONCILE_MINUTES = int(os.getenv("SYNC_RECONCILE_MINUTES", "30"))
+# Checksum verification: bucket sizes (in ids) for each drill-down level, largest first
+SYNC_VERIFY_BUCKET_SIZES = [int(size) for size in os.getenv("SYNC_VERIFY_BUCKET_SIZES", "10000,100,1").split(",")]
+# Text values longer than this are only pushed when their content changed
+SYNC_LARGE_COLUMN_BYTES = int(os.getenv("SYNC_LARGE_COLUMN_BYTES", "1024"))
+# Port of the built-in /metrics and /health endpoint (0 disables it)
+SYNC_METRICS_PORT = int(os.getenv("SYNC_METRICS_PORT", "9108"))
+# Source of local changes to push: "outbox" (sync_outbox change log, see sync_outbox.sql) or "scan" (synced = false)
+SYNC_PUSH_SOURCE = os.getenv("SYNC_PUSH_SOURCE", "outbox")
+# Push batch size adaptation: batches slower than this shrink, faster ones grow back up to SYNC_BATCH_SIZE
+SYNC_BATCH_TARGET_SECONDS = float(os.getenv("SYNC_BATCH_TARGET_SECONDS", "2"))
+SYNC_MIN_BATCH_SIZE = int(os.getenv("SYNC_MIN_BATCH_SIZE", "10"))
+# Circuit breaker: consecutive network failures before an instance is considered down,
+# and the exponential backoff (with jitter) before probing it again
+SYNC_BREAKER_FAILURES = int(os.getenv("SYNC_BREAKER_FAILURES", "3"))
+SYNC_BACKOFF_BASE_SECONDS = float(os.getenv("SYNC_BACKOFF_BASE_SECONDS", "5"))
+SYNC_BACKOFF_MAX_SECONDS = float(os.getenv("SYNC_BACKOFF_MAX_SECONDS", "300"))
+# Records per gzip JSONL chunk file in snapshots (sync.py snapshot export)
+SYNC_SNAPSHOT_CHUNK_ROWS = int(os.getenv("SYNC_SNAPSHOT_CHUNK_ROWS", "50000"))
+# Name of this sync node in the tombstone acknowledgements of each instance (see sync_tombstones.sql)
+SYNC_NODE_ID = os.getenv("SYNC_NODE_ID", socket.gethostname())
+# Days an acknowledged tombstone is kept before it is compacted
+SYNC_TOMBSTONE_RETENTION_DAYS = int(os.getenv("SYNC_TOMBSTONE_RETENTION_DAYS", "30"))
+# Seconds behind the newest applied tombstone that are read again, for deletes whose transaction committed late
+SYNC_TOMBSTONE_LOOKBACK_SECONDS = int(os.getenv("SYNC_TOMBSTONE_LOOKBACK_SECONDS", "600"))
+# Multi-branch mode (sync.py --branches): JSON file listing the local instance of each branch,
+# and how many branches are synced at the same time
+SYNC_BRANCHES_FILE = os.getenv("SYNC_BRANCHES_FILE")
+SYNC_HUB_CONCURRENCY = int(os.getenv("SYNC_HUB_CONCURRENCY", "4"))
+# Seconds between syncs of the lanes without a time budget, on top of the full cycles (0 disables them)
+SYNC_CRITICAL_INTERVAL_SECONDS = int(os.getenv("SYNC_CRITICAL_INTERVAL_SECONDS", "60"))
+# Retention (RETENTION_POLICIES in sync.py): hours between archival runs (0 disables them), the instances
+# this node archives, the directory archive files are written to and the records per archive file
+SYNC_RETENTION_INTERVAL_HOURS = float(os.getenv("SYNC_RETENTION_INTERVAL_HOURS", "24"))
+SYNC_RETENTION_TARGETS = [target.strip() for target in os.getenv("SYNC_RETENTION_TARGETS", "local,remote").split(",") if target.strip()]
+SYNC_ARCHIVE_DIR = os.getenv("SYNC_ARCHIVE_DIR", "archive")
+SYNC_ARCHIVE_CHUNK_ROWS = int(os.getenv("SYNC_ARCHIVE_CHUNK_ROWS", "10000"))
+
+# File the spans of every sync cycle are appended to as JSON lines (see tracing.py); unset disables tracing
+SYNC_TRACE_FILE = os.getenv("SYNC_TRACE_FILE")
\ No newline at end of file
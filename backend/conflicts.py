@@ -0,0 +1,111 @@
+"""
+Conflict resolution for the pharmacy sync service
+
+A row that was changed on both instances since it was last synced is in
+conflict. Instead of letting whichever direction writes last win, the local
+and remote versions are merged against the base (the version both sides last
+agreed on, kept in the sync state store) following the table's policy:
+
+    merge        - field-level three-way merge: a column changed on one side
+                   keeps that change; a column changed on both sides takes the
+                   value of the newer row, except additive columns, which
+                   combine both deltas (base + local delta + remote delta)
+    remote_wins  - the remote row replaces the local one whenever remote changed
+
+Rows without a recorded base are left to the plain upsert behaviour.
+"""
+
+from decimal import Decimal
+
+from loguru import logger
+
+
+class ConflictResolver:
+    """Three-way merges of rows changed on both sides, page by page"""
+
+    def __init__(self, state, policies):
+        """Use bases from a SyncStateStore and the {table: policy} conflict policies"""
+        self.state = state
+        self.policies = policies
+
+    def has_policy(self, table):
+        """Whether conflicts in table are resolved rather than overwritten"""
+        return table in self.policies
+
+    def resolve_page(self, table, local_records, remote_records):
+        """Merge a page of local records with their remote versions, in place.
+
+        Returns the local records whose content changed; those must be written
+        back locally. Local records without a remote version or a base are
+        left untouched.
+        """
+        remote_by_id = {str(record["id"]): record for record in remote_records}
+        bases = self.state.get_base_rows(table, [record["id"] for record in local_records])
+
+        changed = []
+        conflict_count = 0
+        for local in local_records:
+            remote = remote_by_id.get(str(local["id"]))
+            base = bases.get(str(local["id"]))
+            if remote is None or base is None:
+                continue
+            merged, conflicts = self._merge(self.policies[table], local, remote, base)
+            conflict_count += conflicts
+            if merged != local:
+                local.update(merged)
+                changed.append(local)
+
+        if conflict_count:
+            logger.warning(f"Resolved {conflict_count} conflicting column changes in {table}")
+        return changed
+
+    def record_bases(self, table, records):
+        """Remember records as the versions now present on both sides.
+
+        Columns missing from a record (large values left out of a push because
+        they had not changed) keep their value from the previous base.
+        """
+        if self.has_policy(table):
+            bases = self.state.get_base_rows(table, [record["id"] for record in records])
+            self.state.set_base_rows(table, [
+                dict(bases.get(str(record["id"]), {}), **{column: value for column, value in record.items() if column != "synced"})
+                for record in records
+            ])
+
+    def _merge(self, policy, local, remote, base):
+        """Return (merged row, number of columns changed on both sides)"""
+        columns = [column for column in local if column != "synced" and column in remote and column in base]
+        remote_changed = [column for column in columns if remote[column] != base[column]]
+        if not remote_changed:
+            return local, 0
+
+        if policy.get("strategy") == "remote_wins":
+            return dict(local, **{column: remote[column] for column in columns}), int(
+                any(local[column] != base[column] for column in columns)
+            )
+
+        additive = policy.get("additive", ())
+        remote_is_newer = (remote.get("updated_at") or "") >= (local.get("updated_at") or "")
+        merged = dict(local)
+        conflicts = 0
+        for column in remote_changed:
+            if local[column] == base[column]:
+                merged[column] = remote[column]
+            elif local[column] != remote[column]:
+                if column != "updated_at":
+                    conflicts += 1
+                if column in additive and self._is_number(local[column], remote[column], base[column]):
+                    merged[column] = self._add_deltas(local[column], remote[column], base[column])
+                elif remote_is_newer:
+                    merged[column] = remote[column]
+        return merged, conflicts
+
+    def _is_number(self, *values):
+        """Whether every value is an int or float"""
+        return all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in values)
+
+    def _add_deltas(self, local_value, remote_value, base_value):
+        """Apply both sides' deltas to the base, without float rounding drift"""
+        if all(isinstance(value, int) for value in (local_value, remote_value, base_value)):
+            return local_value + remote_value - base_value
+        return float(Decimal(str(local_value)) + Decimal(str(remote_value)) - Decimal(str(base_value)))
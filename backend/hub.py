@@ -0,0 +1,166 @@
+"""
+Multi-branch sync hub for the pharmacy backend
+
+`python sync.py --sync --branches branches.json` syncs many branches from a
+single process. Each branch gets its own async engine with its own local
+connection, state file and tombstone acknowledgement. All branches share one
+remote client, so HQ sees one HTTP connection pool, one circuit breaker and
+one limit of SYNC_MAX_IN_FLIGHT requests in flight, however many branches
+there are. At most SYNC_HUB_CONCURRENCY branch cycles run at a time, and
+branches waiting for a slot are served in the order they became due.
+
+The branches file is a JSON list of local instances:
+
+    [
+        {"id": "branch-01", "url": "http://10.0.1.5:54321", "key_env": "BRANCH_01_SERVICE_ROLE_KEY"},
+        {"id": "branch-02", "url": "http://10.0.2.5:54321", "key": "<service role key>"}
+    ]
+"""
+
+import asyncio
+import json
+import os
+import re
+import signal
+import time
+
+from loguru import logger
+
+from config import REMOTE_SUPABASE_URL, SYNC_INTERVAL_MINUTES, SYNC_HUB_CONCURRENCY, SYNC_METRICS_PORT
+from async_engine import AsyncPharmacyDatabaseSync
+from metrics import MetricsGroup, start_metrics_server
+
+
+def load_branches(path):
+    """Read the branches file, resolving key_env entries, and return [{"id", "url", "key"}]"""
+    with open(path) as f:
+        entries = json.load(f)
+
+    branches = []
+    for entry in entries:
+        branch_id = entry.get("id")
+        # The id names the branch's state file and its tombstone acknowledgements
+        if not branch_id or not re.fullmatch(r"[A-Za-z0-9_.-]+", branch_id):
+            raise ValueError(f"Invalid branch id {branch_id!r}: use letters, digits, '.', '_' and '-'")
+        if any(branch["id"] == branch_id for branch in branches):
+            raise ValueError(f"Duplicate branch id {branch_id}")
+        key = entry.get("key") or os.getenv(entry.get("key_env", ""))
+        if not entry.get("url") or not key:
+            raise ValueError(f"Branch {branch_id} needs a url and a key or key_env")
+        branches.append({"id": branch_id, "url": entry["url"], "key": key})
+
+    if not branches:
+        raise ValueError(f"No branches listed in {path}")
+    return branches
+
+
+def _tag_branch(record):
+    """Prefix log messages written during a branch's cycle with the branch id"""
+    branch = record["extra"].get("branch")
+    if branch:
+        record["message"] = f"[{branch}] {record['message']}"
+
+
+class BranchHub:
+    """Runs the sync cycles of many branches against one shared remote connection"""
+
+    def __init__(self, branches):
+        """Create an engine per branch; the first one owns the shared remote client"""
+        self.engines = [AsyncPharmacyDatabaseSync(branch) for branch in branches]
+        self.concurrency = SYNC_HUB_CONCURRENCY
+        self.interval_seconds = SYNC_INTERVAL_MINUTES * 60
+        # Each branch keeps its own metrics, labelled with its id, served together
+        self.metrics = MetricsGroup(engine.metrics for engine in self.engines)
+        self.metrics_server = None
+
+        owner = self.engines[0]
+        for engine in self.engines:
+            engine.shared_remote = True
+            engine.breakers["remote"] = owner.breakers["remote"]
+            if engine is not owner:
+                # Every branch's cycles go to one trace file, told apart by their node attribute
+                engine.tracer.close()
+                engine.tracer = owner.tracer
+                # The shared remote instance is archived once, by the owner
+                engine.retention.targets = [target for target in engine.retention.targets if target != "remote"]
+
+        # Created inside the event loop
+        self._slots = None
+        self._remote_lock = None
+
+    def get_health_status(self):
+        """Return the health of every branch; the hub is healthy when all branches are"""
+        branches = {engine.branch_id: engine.get_health_status() for engine in self.engines}
+        healthy = sum(1 for status in branches.values() if status["is_healthy"])
+        return {
+            "is_healthy": healthy == len(branches),
+            "status": f"{healthy} of {len(branches)} branches healthy",
+            "circuits": {"remote": self.engines[0].breakers["remote"].state},
+            "branches": branches,
+        }
+
+    async def connect_remote(self):
+        """Connect the remote client shared by every branch if it is missing"""
+        owner = self.engines[0]
+        async with self._remote_lock:
+            if owner.remote_supabase is None:
+                await owner.connect_to_supabase("remote")
+            for engine in self.engines[1:]:
+                engine.remote_supabase = owner.remote_supabase
+                if "remote" in owner._semaphores:
+                    engine._semaphores["remote"] = owner._semaphores["remote"]
+
+    async def run_branch(self, engine):
+        """Sync one branch every SYNC_INTERVAL_MINUTES, waiting for a free slot each time"""
+        while True:
+            due = time.monotonic()
+            async with self._slots:
+                with logger.contextualize(branch=engine.branch_id):
+                    try:
+                        await self.connect_remote()
+                        await engine.run_sync()
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as e:
+                        logger.error(f"Sync cycle failed: {e}")
+                        engine._set_unhealthy(f"Sync cycle failed: {str(e)}")
+            # Time spent waiting for a slot counts towards the interval
+            await asyncio.sleep(max(0.0, self.interval_seconds - (time.monotonic() - due)))
+
+    async def serve(self):
+        """Run every branch's sync loop until cancelled"""
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._remote_lock = asyncio.Lock()
+        try:
+            async with asyncio.TaskGroup() as group:
+                for engine in self.engines:
+                    group.create_task(self.run_branch(engine))
+        except asyncio.CancelledError:
+            logger.info("Sync hub cancelled, shutting down")
+            raise
+        finally:
+            for engine in self.engines:
+                await engine.close()
+
+    def start(self):
+        """Start the sync hub"""
+        logger.configure(patcher=_tag_branch)
+        logger.info(f"Starting pharmacy database sync hub for {len(self.engines)} branches")
+        logger.info(f"Remote Supabase URL: {REMOTE_SUPABASE_URL}")
+        if SYNC_METRICS_PORT and self.metrics_server is None:
+            self.metrics_server = start_metrics_server(self, SYNC_METRICS_PORT)
+            # Branch cycles only refresh their backlog gauges while metrics are served
+            for engine in self.engines:
+                engine.metrics_server = self.metrics_server
+
+        async def main():
+            task = asyncio.current_task()
+            loop = asyncio.get_running_loop()
+            # Stop cleanly on `docker stop`
+            loop.add_signal_handler(signal.SIGTERM, task.cancel)
+            await self.serve()
+
+        try:
+            asyncio.run(main())
+        except (asyncio.CancelledError, KeyboardInterrupt):
+            logger.info("Sync hub stopped")
@@ -0,0 +1,133 @@
+"""
+Priority lanes for the pharmacy sync service
+
+Tables are grouped into lanes (SYNC_LANES in sync.py) that each direction of
+a cycle syncs one after the other. Lanes without a time budget, such as
+sales and stock changes, run first and always to completion. The other lanes
+get a time budget per cycle: once it is spent their tables stop after the
+current page, and the rest of their backlog waits for the next cycle, which
+resumes from the committed watermark or outbox position.
+
+The backlog a lane leaves behind decides which budgeted lane goes first: a
+lane whose deferred backlog has waited longer than its max_delay_minutes,
+then the lane with the most deferred rows times minutes waited, then the
+configured order. Tables referenced by a table in a more urgent lane are
+synced in that lane too, so foreign keys are always satisfied.
+"""
+
+import threading
+import time
+
+from loguru import logger
+
+
+class LaneScheduler:
+    """Orders the lanes of each sync direction and tracks their time budgets and deferred backlog"""
+
+    def __init__(self, lanes):
+        """Use the {name: {"tables", "budget_seconds", "max_delay_minutes"}} lanes, most urgent first"""
+        self.lanes = lanes
+        # Lanes without a budget always run before the budgeted ones
+        self._rank = sorted(lanes, key=lambda lane: lanes[lane].get("budget_seconds") is not None)
+        self._lock = threading.Lock()
+        self._assignment_key = None
+        self._assignment = {}
+        # {(lane, direction): monotonic deadline} of the lanes running now
+        self._deadlines = {}
+        # {(table, direction): [rows, deferred since]} of tables with backlog left over
+        self._deferred = {}
+        self._deferred_now = set()
+
+    def assign(self, tables, dependencies):
+        """Return {table: lane} for tables, moving tables linked by foreign keys into the more urgent lane"""
+        key = (tuple(tables), tuple(sorted((table, tuple(parents)) for table, parents in dependencies.items())))
+        if key == self._assignment_key:
+            return self._assignment
+
+        listed = {table: lane for lane in self._rank for table in self.lanes[lane].get("tables", [])}
+        catch_all = [lane for lane in self._rank if "tables" not in self.lanes[lane]] or self._rank[-1:]
+        assignment = {table: listed.get(table, catch_all[-1]) for table in tables}
+
+        rank = {lane: index for index, lane in enumerate(self._rank)}
+        changed = True
+        while changed:
+            changed = False
+            for table in tables:
+                for parent in dependencies.get(table, []):
+                    if parent not in assignment or assignment[parent] == assignment[table]:
+                        continue
+                    lane, parent_lane = assignment[table], assignment[parent]
+                    if rank[parent_lane] > rank[lane]:
+                        # The parent must arrive before the child
+                        assignment[parent] = lane
+                        changed = True
+                        logger.info(f"Syncing {parent} in the {lane} lane, as {table} references it")
+                    elif self.lanes[parent_lane].get("budget_seconds") is not None:
+                        # A budgeted lane may be deferred, so the child follows its parent
+                        assignment[table] = parent_lane
+                        changed = True
+                        logger.info(f"Syncing {table} in the {parent_lane} lane, as it references {parent}")
+
+        self._assignment_key, self._assignment = key, assignment
+        return assignment
+
+    def plan(self, direction, tables, dependencies):
+        """Return [(lane, tables)] in the order this cycle should sync them in a direction"""
+        assignment = self.assign(tables, dependencies)
+        by_lane = {lane: [table for table in tables if assignment[table] == lane] for lane in self._rank}
+
+        def urgency(lane):
+            rows, age = self.backlog(lane, direction, by_lane[lane])
+            max_delay = self.lanes[lane].get("max_delay_minutes")
+            starved = max_delay is not None and age > max_delay * 60
+            return (not starved, -rows * age / 60)
+
+        unbudgeted = [lane for lane in self._rank if self.lanes[lane].get("budget_seconds") is None]
+        budgeted = sorted((lane for lane in self._rank if lane not in unbudgeted), key=urgency)
+        return [(lane, by_lane[lane]) for lane in unbudgeted + budgeted if by_lane[lane]]
+
+    def critical_tables(self, tables, dependencies):
+        """Return the tables of the lanes without a budget"""
+        assignment = self.assign(tables, dependencies)
+        return [table for table in tables if self.lanes[assignment[table]].get("budget_seconds") is None]
+
+    def start_lane(self, lane, direction):
+        """Start the clock on a lane's budget for this cycle"""
+        budget = self.lanes[lane].get("budget_seconds")
+        with self._lock:
+            self._deadlines[(lane, direction)] = None if budget is None else time.monotonic() + budget
+
+    def out_of_budget(self, table, direction):
+        """Return whether the lane of a table has spent its budget, so its next page should wait"""
+        lane = self._assignment.get(table)
+        deadline = self._deadlines.get((lane, direction))
+        return deadline is not None and time.monotonic() > deadline
+
+    def table_started(self, table, direction):
+        """Note that a table starts syncing in a direction"""
+        with self._lock:
+            self._deferred_now.discard((table, direction))
+
+    def defer(self, table, direction, rows):
+        """Record that a table stopped with rows of backlog left, keeping the time it first did"""
+        with self._lock:
+            self._deferred_now.add((table, direction))
+            entry = self._deferred.setdefault((table, direction), [rows, time.time()])
+            entry[0] = rows
+
+    def table_finished(self, table, direction):
+        """Forget the deferred backlog of a table that synced to the end"""
+        with self._lock:
+            if (table, direction) not in self._deferred_now:
+                self._deferred.pop((table, direction), None)
+
+    def backlog(self, lane, direction, tables=None):
+        """Return the (rows, seconds waited by the oldest) deferred backlog of a lane"""
+        if tables is None:
+            tables = [table for table, assigned in self._assignment.items() if assigned == lane]
+        now = time.time()
+        with self._lock:
+            entries = [self._deferred[(table, direction)] for table in tables if (table, direction) in self._deferred]
+        if not entries:
+            return 0, 0.0
+        return sum(rows for rows, _ in entries), max(now - since for _, since in entries)
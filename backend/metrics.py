@@ -0,0 +1,218 @@
+"""
+Sync metrics for the pharmacy backend
+
+Collects per-table counters, batch latency histograms and transfer sizes from
+the sync engines and serves them, together with the health status, over a
+small built-in HTTP server:
+
+    GET /metrics  - Prometheus text exposition format
+    GET /health   - JSON health status (HTTP 503 when unhealthy)
+"""
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from loguru import logger
+
+
+# Upper bounds (seconds) of the batch latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class SyncMetrics:
+    """Thread-safe store of sync counters, gauges and histograms"""
+
+    def __init__(self, branch=None):
+        """Initialize empty metrics, labelled with the branch of a hub (see hub.py) if given"""
+        self._lock = threading.Lock()
+        self.branch = branch
+        self.rows_pushed = {}
+        self.rows_pulled = {}
+        self.echoes_skipped = {}
+        self.bytes_transferred = {}
+        self.backlog = {}
+        self.lane_backlog = {}
+        self.watermark_lag = {}
+        self.batch_latency = {}
+        self.last_error = None
+        self.last_error_time = None
+
+    def add_rows(self, direction, table, count):
+        """Count rows moved in a direction ("local_to_remote" or "remote_to_local")"""
+        counters = self.rows_pushed if direction == "local_to_remote" else self.rows_pulled
+        with self._lock:
+            counters[table] = counters.get(table, 0) + count
+
+    def add_echoes(self, table, count):
+        """Count pulled rows skipped because they were the versions this node had pushed"""
+        with self._lock:
+            self.echoes_skipped[table] = self.echoes_skipped.get(table, 0) + count
+
+    def add_bytes(self, target, direction, count):
+        """Count HTTP body bytes sent to or received from a target ("local" or "remote")"""
+        with self._lock:
+            key = (target, direction)
+            self.bytes_transferred[key] = self.bytes_transferred.get(key, 0) + count
+
+    def observe_batch(self, direction, table, seconds):
+        """Record how long one batch of a table took"""
+        with self._lock:
+            histogram = self.batch_latency.setdefault((direction, table), [[0] * len(LATENCY_BUCKETS), 0.0, 0])
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    histogram[0][index] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def set_backlog(self, table, count):
+        """Set the number of local records still waiting to be pushed"""
+        with self._lock:
+            self.backlog[table] = count
+
+    def set_lane_backlog(self, lane, direction, rows, seconds):
+        """Set the rows a lane deferred to the next cycle and how long the oldest has waited"""
+        with self._lock:
+            self.lane_backlog[(lane, direction)] = (rows, seconds)
+
+    def set_watermark_lag(self, table, seconds):
+        """Set how far the pull watermark of a table trails the current time"""
+        with self._lock:
+            self.watermark_lag[table] = seconds
+
+    def set_error(self, message):
+        """Remember the most recent sync error"""
+        with self._lock:
+            self.last_error = message
+            self.last_error_time = time.time()
+
+    def render(self, health):
+        """Render all metrics in the Prometheus text exposition format"""
+        return render_metrics([self], health)
+
+    def families(self):
+        """Return every metric family as (name, kind, help, [(sample suffix, labels, value)])"""
+
+        def labels(**values):
+            # Per-branch series of a hub are told apart by their branch label
+            return dict({"branch": self.branch}, **values) if self.branch else values
+
+        with self._lock:
+            latency = []
+            for (direction, table), (buckets, total, count) in sorted(self.batch_latency.items()):
+                series = labels(direction=direction, table=table)
+                for bound, bucket_count in zip(LATENCY_BUCKETS, buckets):
+                    latency.append(("_bucket", dict(series, le=str(bound)), bucket_count))
+                latency.append(("_bucket", dict(series, le="+Inf"), count))
+                latency.append(("_sum", series, round(total, 6)))
+                latency.append(("_count", series, count))
+
+            return [
+                ("sync_rows_pushed_total", "counter", "Rows pushed from local to remote",
+                 [("", labels(table=table), count) for table, count in sorted(self.rows_pushed.items())]),
+                ("sync_rows_pulled_total", "counter", "Rows pulled from remote to local",
+                 [("", labels(table=table), count) for table, count in sorted(self.rows_pulled.items())]),
+                ("sync_echoes_skipped_total", "counter", "Pulled rows skipped as echoes of pushed rows",
+                 [("", labels(table=table), count) for table, count in sorted(self.echoes_skipped.items())]),
+                # Not per branch: the branches of a hub share one remote client
+                ("sync_bytes_total", "counter", "HTTP body bytes transferred",
+                 [("", {"target": target, "direction": direction}, count)
+                  for (target, direction), count in sorted(self.bytes_transferred.items())]),
+                ("sync_backlog_rows", "gauge", "Local rows with synced = false",
+                 [("", labels(table=table), count) for table, count in sorted(self.backlog.items())]),
+                ("sync_lane_deferred_rows", "gauge", "Rows a lane deferred to the next cycle when its time budget ran out",
+                 [("", labels(lane=lane, direction=direction), rows)
+                  for (lane, direction), (rows, _) in sorted(self.lane_backlog.items())]),
+                ("sync_lane_deferred_age_seconds", "gauge", "Seconds the oldest deferred backlog of a lane has waited",
+                 [("", labels(lane=lane, direction=direction), round(seconds, 3))
+                  for (lane, direction), (_, seconds) in sorted(self.lane_backlog.items())]),
+                ("sync_watermark_lag_seconds", "gauge", "Seconds the pulled rows are behind remote (0 once every remote change is pulled)",
+                 [("", labels(table=table), round(seconds, 3)) for table, seconds in sorted(self.watermark_lag.items())]),
+                ("sync_batch_seconds", "histogram", "Time taken to sync one batch", latency),
+                ("sync_last_error_timestamp_seconds", "gauge", "Unix time of the last sync error",
+                 [("", labels(), self.last_error_time)] if self.last_error_time else []),
+                ("sync_last_error_info", "gauge", "Message of the last sync error",
+                 [("", labels(message=self.last_error), 1)] if self.last_error else []),
+            ]
+
+
+class MetricsGroup:
+    """The metrics of several engines, such as the branches of a hub, served as one"""
+
+    def __init__(self, metrics):
+        """Serve every SyncMetrics in metrics"""
+        self.metrics = list(metrics)
+
+    def render(self, health):
+        """Render the metrics of every engine in the Prometheus text exposition format"""
+        return render_metrics(self.metrics, health)
+
+
+def render_metrics(metrics, health):
+    """Render the families of one or more SyncMetrics in the Prometheus text exposition format.
+
+    Samples with the same name and labels in several of them, such as the
+    bytes sent over a hub's shared remote client, are added up.
+    """
+    families = {}
+    for engine_metrics in metrics:
+        for name, kind, help_text, samples in engine_metrics.families():
+            merged = families.setdefault(name, (kind, help_text, {}))[2]
+            for suffix, labels, value in samples:
+                key = (suffix, tuple(labels.items()))
+                merged[key] = merged.get(key, 0) + value
+    families["sync_healthy"] = ("gauge", "Whether the last sync cycle was healthy", {("", ()): int(bool(health["is_healthy"]))})
+
+    lines = []
+    for name, (kind, help_text, samples) in families.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for (suffix, labels), value in samples.items():
+            lines.append(f"{name}{suffix}{_format_labels(dict(labels))} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels):
+    """Format a label dict as {name="value",...}"""
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label(value)}"' for name, value in labels.items()) + "}"
+
+
+def _escape_label(value):
+    """Escape a label value per the exposition format"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def start_metrics_server(engine, port):
+    """Serve /metrics and /health for engine on port in a background thread"""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            health = engine.get_health_status()
+            if self.path == "/metrics":
+                body = engine.metrics.render(health).encode()
+                self._respond(200, "text/plain; version=0.0.4; charset=utf-8", body)
+            elif self.path == "/health":
+                body = json.dumps(health).encode()
+                self._respond(200 if health["is_healthy"] else 503, "application/json", body)
+            else:
+                self._respond(404, "text/plain", b"Not found\n")
+
+        def _respond(self, status, content_type, body):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Scrapes are frequent; keep them out of sync.log
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True)
+    thread.start()
+    logger.info(f"Serving sync metrics on port {port}")
+    return server
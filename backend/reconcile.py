@@ -0,0 +1,122 @@
+"""
+Checksum reconciliation for the pharmacy backend
+
+Detects drift between the local and remote copy of each table without
+transferring them in full (`python sync.py --verify`). Both sides compute
+range-bucketed checksums over id ranges with the `sync_bucket_checksums`
+database function (see sync_functions.sql); only buckets whose checksums
+differ are split into smaller buckets, down to single rows, and only those
+rows are re-synced.
+"""
+
+from loguru import logger
+
+from config import SYNC_VERIFY_BUCKET_SIZES
+
+
+class ChecksumReconciler:
+    """Compares bucketed table checksums on both instances and repairs the rows that differ"""
+
+    def __init__(self, engine):
+        """Attach the reconciler to a connected PharmacyDatabaseSync engine"""
+        self.engine = engine
+        # Bucket size per drill-down level, largest first and ending with single rows
+        self.bucket_sizes = list(SYNC_VERIFY_BUCKET_SIZES)
+        if self.bucket_sizes[-1] != 1:
+            self.bucket_sizes.append(1)
+        self.results = {}
+
+    def verify(self):
+        """Verify every synced table, repairing drift, and return a summary per table"""
+        self.results = {}
+        self.engine._run_per_table(self.verify_table)
+        return self.results
+
+    def verify_table(self, table):
+        """Find and re-sync the rows of a single table that differ between local and remote"""
+        try:
+            self.results[table] = {"queries": 0, "differing": 0, "pushed": 0, "pulled": 0}
+            differing_ids = self._differing_ids(table, 0, None, None)
+            self.results[table]["differing"] = len(differing_ids)
+
+            if not differing_ids:
+                logger.success(f"{table} is in sync ({self.results[table]['queries']} checksum queries)")
+                return
+
+            logger.warning(f"{len(differing_ids)} records differ in {table}, re-syncing them")
+            for start in range(0, len(differing_ids), self.engine.batch_size):
+                self._repair(table, differing_ids[start:start + self.engine.batch_size])
+            logger.success(
+                f"Repaired {table}: pushed {self.results[table]['pushed']}, pulled {self.results[table]['pulled']}"
+            )
+
+        except Exception as e:
+            logger.error(f"Error verifying {table}: {e}")
+            self.results[table]["error"] = str(e)
+
+    def _checksums(self, client, table, bucket_size, min_id, max_id):
+        """Fetch {bucket: (row_count, checksum)} for one side"""
+        self.results[table]["queries"] += 1
+        rows = client.rpc("sync_bucket_checksums", {
+            "p_table": table,
+            "p_bucket_size": bucket_size,
+            "p_min_id": min_id,
+            "p_max_id": max_id,
+        }).execute().data
+        return {row["bucket"]: (row["row_count"], row["checksum"]) for row in rows}
+
+    def _differing_ids(self, table, level, min_id, max_id):
+        """Return the ids in [min_id, max_id) whose rows differ, drilling into mismatched buckets"""
+        bucket_size = self.bucket_sizes[level]
+        local = self._checksums(self.engine.local_supabase, table, bucket_size, min_id, max_id)
+        remote = self._checksums(self.engine.remote_supabase, table, bucket_size, min_id, max_id)
+
+        differing_ids = []
+        for bucket in sorted(set(local) | set(remote)):
+            if local.get(bucket) == remote.get(bucket):
+                continue
+            if bucket_size == 1:
+                differing_ids.append(bucket)
+            else:
+                lower = bucket * bucket_size
+                differing_ids.extend(self._differing_ids(table, level + 1, lower, lower + bucket_size))
+        return differing_ids
+
+    def _repair(self, table, record_ids):
+        """Re-sync differing rows in the direction that preserves unsynced local changes.
+
+        Rows not yet synced locally are pushed; every other row is taken from
+        remote. A synced local row missing on remote was deleted there, and is
+        left to its tombstone.
+        """
+        columns = self.engine._select_columns(table)
+        local_columns = columns if columns == "*" or "synced" in columns.split(",") else f"{columns},synced"
+        local_records = {
+            record["id"]: record
+            for record in self.engine.local_supabase.table(table).select(local_columns).in_("id", record_ids).execute().data
+        }
+        remote_records = {
+            record["id"]: record
+            for record in self.engine.remote_supabase.table(table).select(columns).in_("id", record_ids).execute().data
+        }
+
+        to_push = []
+        to_pull = []
+        deleted_count = 0
+        for record_id in record_ids:
+            local_record = local_records.get(record_id)
+            remote_record = remote_records.get(record_id)
+            if local_record is not None and local_record.get("synced") is False:
+                to_push.append({k: v for k, v in local_record.items() if k != "synced"})
+            elif remote_record is not None:
+                to_pull.append(dict(remote_record, synced=True))
+            elif local_record is not None:
+                deleted_count += 1
+
+        if deleted_count:
+            logger.info(f"{deleted_count} records of {table} were deleted on remote, leaving them to its tombstones")
+        if to_push:
+            self.results[table]["pushed"] += self.engine._run_steps(self.engine._push_batch(table, to_push))
+        if to_pull:
+            self.engine._run_steps(self.engine._upsert_records("local", table, to_pull))
+            self.results[table]["pulled"] += len(to_pull)
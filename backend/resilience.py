@@ -0,0 +1,160 @@
+"""
+Circuit breakers for the pharmacy sync service
+
+Each Supabase instance gets a CircuitBreaker that watches every HTTP request
+made to it. After SYNC_BREAKER_FAILURES consecutive network failures the
+circuit opens, and requests fail immediately instead of each waiting for a
+timeout. After an exponentially growing, jittered delay the circuit turns
+half-open and lets a single probe request through; its outcome closes the
+circuit again or re-opens it with a longer delay.
+"""
+
+import random
+import threading
+import time
+
+import httpx
+from loguru import logger
+
+from config import SYNC_BREAKER_FAILURES, SYNC_BACKOFF_BASE_SECONDS, SYNC_BACKOFF_MAX_SECONDS
+
+
+# Responses meaning the instance (or the proxy in front of it) is unavailable
+UNAVAILABLE_STATUS_CODES = (502, 503, 504)
+
+
+class CircuitOpenError(httpx.TransportError):
+    """Raised instead of sending a request while a circuit is open"""
+
+
+class CircuitBreaker:
+    """Closed / open / half-open breaker with exponential backoff and jitter"""
+
+    def __init__(self, name):
+        """Create a closed breaker for the instance called name"""
+        self.name = name
+        self.failure_threshold = SYNC_BREAKER_FAILURES
+        self.base_delay = SYNC_BACKOFF_BASE_SECONDS
+        self.max_delay = SYNC_BACKOFF_MAX_SECONDS
+        self.state = "closed"
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_count = 0
+        self._retry_at = 0.0
+        self._probing = False
+
+    def allow(self):
+        """Whether a request may be sent now; in half-open state only one probe is let through"""
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open":
+                if time.monotonic() < self._retry_at:
+                    return False
+                self.state = "half_open"
+                logger.info(f"{self.name} circuit half-open, probing")
+            if self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def is_open(self):
+        """Whether requests are currently being refused (without taking the half-open probe)"""
+        with self._lock:
+            return self.state == "open" and time.monotonic() < self._retry_at
+
+    def retry_in(self):
+        """Seconds until the circuit lets a probe through"""
+        with self._lock:
+            return max(0.0, self._retry_at - time.monotonic())
+
+    def record_success(self):
+        """Close the circuit after a request reached the instance"""
+        with self._lock:
+            if self.state != "closed":
+                logger.success(f"{self.name} circuit closed")
+            self.state = "closed"
+            self._failures = 0
+            self._opened_count = 0
+            self._probing = False
+
+    def release(self):
+        """Let a new probe through after a request ended without telling anything about the instance"""
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self):
+        """Count a network failure, opening the circuit once there are too many in a row"""
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            # Requests already in flight when the circuit opened don't extend the delay
+            if self.state == "open":
+                return
+            if self.state == "half_open" or self._failures >= self.failure_threshold:
+                self._opened_count += 1
+                delay = min(self.max_delay, self.base_delay * 2 ** (self._opened_count - 1))
+                delay = random.uniform(delay / 2, delay)
+                self._retry_at = time.monotonic() + delay
+                logger.warning(f"{self.name} circuit open, next attempt in {delay:.1f}s")
+                self.state = "open"
+
+
+class BreakerTransport(httpx.BaseTransport):
+    """HTTP transport that routes every request through a CircuitBreaker"""
+
+    def __init__(self, breaker, transport):
+        """Wrap transport, reporting each outcome to breaker"""
+        self.breaker = breaker
+        self.transport = transport
+
+    def handle_request(self, request):
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"{self.breaker.name} circuit is open", request=request)
+        try:
+            response = self.transport.handle_request(request)
+        except httpx.TransportError:
+            self.breaker.record_failure()
+            raise
+        except BaseException:
+            self.breaker.release()
+            raise
+        if response.status_code in UNAVAILABLE_STATUS_CODES:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return response
+
+    def close(self):
+        self.transport.close()
+
+
+class AsyncBreakerTransport(httpx.AsyncBaseTransport):
+    """Async HTTP transport that routes every request through a CircuitBreaker"""
+
+    def __init__(self, breaker, transport):
+        """Wrap transport, reporting each outcome to breaker"""
+        self.breaker = breaker
+        self.transport = transport
+
+    async def handle_async_request(self, request):
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"{self.breaker.name} circuit is open", request=request)
+        try:
+            response = await self.transport.handle_async_request(request)
+        except httpx.TransportError:
+            self.breaker.record_failure()
+            raise
+        except BaseException:
+            # Cancelled requests say nothing about the instance; an expired
+            # engine request timeout is counted by the engine instead
+            self.breaker.release()
+            raise
+        if response.status_code in UNAVAILABLE_STATUS_CODES:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
@@ -0,0 +1,136 @@
+"""
+Retention and archival of log tables for the pharmacy sync service
+
+Tables such as email_logs, email_queue and notifications only ever grow, and
+every sync cycle scans them on both instances. With a policy in
+RETENTION_POLICIES (sync.py), rows older than the policy's number of days are
+moved out of the table once every SYNC_RETENTION_INTERVAL_HOURS: they are
+written to gzip-compressed JSONL files under SYNC_ARCHIVE_DIR, laid out as
+
+    <instance>/<table>/<run timestamp>-<chunk>.jsonl.gz
+
+and only once a chunk file is safely on disk are its rows deleted, in one
+request, through sync_archive_rows (sync_functions.sql). That function keeps
+the deletes out of sync_outbox and sync_tombstones, so archiving on one
+instance is not propagated as a delete to the other; each instance is
+archived on its own. Local rows still waiting to be pushed are never archived.
+"""
+
+import gzip
+import json
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+from loguru import logger
+
+from steps import Query, Blocking
+from config import SYNC_ARCHIVE_DIR, SYNC_ARCHIVE_CHUNK_ROWS, SYNC_RETENTION_INTERVAL_HOURS, SYNC_RETENTION_TARGETS
+
+
+class Retention:
+    """Moves rows past their table's retention period into compressed archive files"""
+
+    def __init__(self, engine, path=SYNC_ARCHIVE_DIR):
+        """Archive the tables of a PharmacyDatabaseSync engine under path"""
+        self.engine = engine
+        self.path = path
+        self.chunk_rows = SYNC_ARCHIVE_CHUNK_ROWS
+        self.interval_seconds = SYNC_RETENTION_INTERVAL_HOURS * 3600
+        # Instances archived by this node ("local", "remote")
+        self.targets = list(SYNC_RETENTION_TARGETS)
+
+    def due(self):
+        """Return whether the retention interval has passed since the last run"""
+        if not self.interval_seconds or not self.engine.RETENTION_POLICIES:
+            return False
+        last_run = self.engine.state.get_metadata("retention_last_run")
+        return last_run is None or time.time() - last_run >= self.interval_seconds
+
+    def mark_run(self):
+        """Record that retention has just run"""
+        self.engine.state.set_metadata("retention_last_run", time.time())
+
+    def run(self):
+        """Steps (see steps.py) archiving every table with a retention policy on each target; returns {target: {table: rows archived}}"""
+        stamp = time.strftime("%Y%m%dT%H%M%S")
+        results = {}
+        for target in self.targets:
+            client = self.engine.local_supabase if target == "local" else self.engine.remote_supabase
+            if client is None:
+                continue
+            results[target] = {}
+            for table, policy in self.engine.RETENTION_POLICIES.items():
+                try:
+                    results[target][table] = yield from self.archive_table(client, target, table, policy, stamp)
+                except Exception as e:
+                    if self.engine._table_missing(e):
+                        # The table, or sync_archive_rows (sync_functions.sql), is not installed there
+                        logger.warning(f"Not archiving {table} on {target}: {e}")
+                        continue
+                    logger.error(f"Error archiving {table} on {target}: {e}")
+        self.mark_run()
+        return results
+
+    def archive_table(self, client, target, table, policy, stamp):
+        """Steps moving the rows of a table older than its policy into chunk files, chunk by chunk"""
+        cutoff = self.cutoff(policy)
+        archived = chunks = 0
+        chunk, cursor = [], None
+        while True:
+            page = (yield Query(target, self.page_query(client, target, table, policy, cutoff, cursor))).data
+            chunk.extend(page)
+            if page:
+                cursor = self.cursor(policy, page)
+            if len(chunk) >= self.chunk_rows or (not page and chunk):
+                yield Blocking(self.write_chunk, target, table, stamp, chunks, chunk)
+                yield Query(target, self.delete_query(client, table, chunk))
+                archived += len(chunk)
+                chunks += 1
+                chunk = []
+            if not page:
+                break
+        if archived:
+            logger.success(f"Archived {archived} records of {table} on {target} older than {policy['days']} days")
+        return archived
+
+    def cutoff(self, policy):
+        """Return the ISO timestamp before which rows fall out of a policy's retention period"""
+        return (datetime.now(timezone.utc) - timedelta(days=policy["days"])).isoformat()
+
+    def cursor(self, policy, page):
+        """Return the (timestamp, id) keyset cursor after the last row of a page"""
+        column = policy.get("column", "created_at")
+        return page[-1][column], page[-1]["id"]
+
+    def page_query(self, client, target, table, policy, cutoff, cursor):
+        """Build the query for the next page of rows older than cutoff, in (column, id) order"""
+        column = policy.get("column", "created_at")
+        query = client.table(table).select("*").lt(column, cutoff)
+        if target == "local":
+            # Rows that have not reached the remote yet stay
+            query = query.neq("synced", False)
+        if cursor is not None:
+            value, record_id = cursor
+            query = query.or_(f'{column}.gt."{value}",and({column}.eq."{value}",id.gt."{record_id}")')
+        return query.order(column).order("id").limit(self.engine.page_size)
+
+    def delete_query(self, client, table, records):
+        """Build the request deleting archived records without recording them as changes to sync"""
+        return client.rpc("sync_archive_rows", {"p_table": table, "p_rows": [{"id": record["id"]} for record in records]})
+
+    def write_chunk(self, target, table, stamp, index, records):
+        """Write records to a gzip JSONL chunk file, durably, before they are deleted"""
+        instance = target if target == "remote" or not self.engine.branch_id else f"local-{self.engine.branch_id}"
+        directory = os.path.join(self.path, instance, table)
+        os.makedirs(directory, exist_ok=True)
+        chunk_file = os.path.join(directory, f"{stamp}-{index:05d}.jsonl.gz")
+        partial_file = chunk_file + ".partial"
+        with open(partial_file, "wb") as raw:
+            with gzip.open(raw, "wt", encoding="utf-8") as chunk:
+                for record in records:
+                    chunk.write(json.dumps(record, default=str) + "\n")
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(partial_file, chunk_file)
+        return chunk_file
@@ -0,0 +1,89 @@
+"""
+Schema discovery for the pharmacy sync service
+
+Instead of syncing a hard-coded list of tables, the sync service asks both
+instances for their table metadata once at startup (sync_table_metadata in
+sync_functions.sql). A table is synced when it exists on both instances with
+an `id` primary key, an `updated_at` column and a `synced` flag; its foreign
+keys decide the sync order and the columns present on both sides (except
+generated ones) are the columns transferred. The discovered schema is cached
+in the sync state store, so a restart while discovery is unavailable still
+syncs the tables seen last time.
+"""
+
+from loguru import logger
+
+
+# Columns a table needs before the sync service can track its changes
+REQUIRED_COLUMNS = ("id", "updated_at", "synced")
+
+
+class SchemaCatalog:
+    """Syncable tables with their columns and foreign keys, as discovered on both instances"""
+
+    def __init__(self, state):
+        """Cache discovered schemas in a SyncStateStore"""
+        self.state = state
+        self.tables = {}
+
+    def update(self, local_rows, remote_rows):
+        """Rebuild the catalog from the sync_table_metadata rows of both instances and cache it"""
+        local_tables = self._syncable(local_rows, "local")
+        remote_tables = self._syncable(remote_rows, "remote")
+
+        self.tables = {}
+        for table, local in local_tables.items():
+            remote = remote_tables.get(table)
+            if remote is None:
+                continue
+            remote_columns = set(remote["columns"])
+            self.tables[table] = {
+                "columns": [column for column in local["columns"] if column in remote_columns],
+                "references": sorted(set(local["references"]) & set(remote["references"])),
+            }
+        for table in sorted(set(local_tables) ^ set(remote_tables)):
+            side = "remote" if table in local_tables else "local"
+            logger.warning(f"Not syncing {table}: it is not syncable on the {side} instance")
+
+        self.state.set_metadata("schema", self.tables)
+        logger.info(f"Discovered {len(self.tables)} syncable tables")
+
+    def load(self):
+        """Load the schema cached by the last discovery; returns False if there is none"""
+        self.tables = self.state.get_metadata("schema") or {}
+        return bool(self.tables)
+
+    def ordered_tables(self, preferred):
+        """Return the syncable tables, those in preferred first and in its order, then new ones by name"""
+        known = [table for table in preferred if table in self.tables]
+        return known + sorted(table for table in self.tables if table not in known)
+
+    def dependencies(self):
+        """Return {table: [referenced syncable tables]} from the discovered foreign keys"""
+        return {
+            table: [parent for parent in info["references"] if parent in self.tables and parent != table]
+            for table, info in self.tables.items()
+            if info["references"]
+        }
+
+    def columns(self, table):
+        """Return the columns of table to transfer"""
+        return self.tables[table]["columns"]
+
+    def _syncable(self, rows, target):
+        """Return {table: {columns, references}} of the tables in rows the sync service can track"""
+        tables = {}
+        for row in rows:
+            table = row["table_name"]
+            missing = [column for column in REQUIRED_COLUMNS if column not in row["columns"]]
+            if "synced" in missing:
+                # No synced flag means the table was never meant to be synced
+                continue
+            if row["primary_key"] != ["id"] or missing:
+                logger.warning(
+                    f"Not syncing {table} on {target}: it needs an id primary key and "
+                    f"{', '.join(REQUIRED_COLUMNS)} columns (see sync_functions.sql)"
+                )
+                continue
+            tables[table] = {"columns": row["columns"], "references": row["references_tables"] or []}
+        return tables
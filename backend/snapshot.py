@@ -0,0 +1,147 @@
+"""
+Compressed snapshots for bootstrapping new branches
+
+`python sync.py snapshot export DIR` streams every synced table from the
+remote instance into gzip-compressed JSONL chunks, together with a manifest
+recording each table's high-water mark. `python sync.py snapshot import DIR`
+bulk loads those chunks into the local instance and sets the pull
+watermarks, so incremental sync continues from the snapshot instead of
+pulling the whole catalogue from 1970 row by row.
+"""
+
+import gzip
+import json
+import os
+import time
+
+from loguru import logger
+
+from config import SYNC_SNAPSHOT_CHUNK_ROWS
+
+
+MANIFEST_FILE = "manifest.json"
+SNAPSHOT_FORMAT = 1
+
+
+class Snapshot:
+    """A snapshot directory of gzip JSONL chunks plus a manifest with per-table watermarks"""
+
+    def __init__(self, engine, path):
+        """Attach the snapshot at path to a connected PharmacyDatabaseSync engine"""
+        self.engine = engine
+        self.path = path
+        self.chunk_rows = SYNC_SNAPSHOT_CHUNK_ROWS
+        self.manifest = {"format": SNAPSHOT_FORMAT, "tables": {}}
+        self.errors = {}
+
+    def export(self):
+        """Write every synced table of the remote instance to the snapshot; returns False on errors.
+
+        The manifest is written last, so a snapshot without one is incomplete.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        self.manifest["created_at"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+        self.engine._run_per_table(self.export_table)
+
+        failed = [table for table, entry in self.manifest["tables"].items() if "error" in entry]
+        if failed:
+            logger.error(f"Snapshot export failed for {', '.join(failed)}")
+            return False
+
+        with open(os.path.join(self.path, MANIFEST_FILE), "w") as f:
+            json.dump(self.manifest, f, indent=2)
+        total = sum(entry["rows"] for entry in self.manifest["tables"].values())
+        logger.success(f"Exported {total} records to snapshot {self.path}")
+        return True
+
+    def export_table(self, table):
+        """Stream a remote table into chunk files in (updated_at, id) order"""
+        entry = {"rows": 0, "chunks": [], "watermark": None}
+        self.manifest["tables"][table] = entry
+        chunk = None
+        try:
+            for records in self.engine._iter_updated_since(table, ("1970-01-01T00:00:00", None)):
+                for record in records:
+                    if chunk is None or entry["rows"] % self.chunk_rows == 0:
+                        if chunk is not None:
+                            chunk.close()
+                        chunk_file = f"{table}-{len(entry['chunks']):05d}.jsonl.gz"
+                        entry["chunks"].append(chunk_file)
+                        chunk = gzip.open(os.path.join(self.path, chunk_file), "wt", encoding="utf-8")
+                    record.pop("synced", None)
+                    chunk.write(json.dumps(record, default=str) + "\n")
+                    entry["rows"] += 1
+                # Rows changed during the export move past the cursor and are exported
+                # later, so the last row is a safe point for incremental sync to resume
+                entry["watermark"] = [records[-1]["updated_at"], records[-1]["id"]]
+            logger.info(f"Exported {entry['rows']} records from {table}")
+
+        except Exception as e:
+            logger.error(f"Error exporting {table}: {e}")
+            entry["error"] = str(e)
+        finally:
+            if chunk is not None:
+                chunk.close()
+
+    def load(self):
+        """Bulk load the snapshot into the local instance and set the pull watermarks; returns False on errors"""
+        manifest_path = os.path.join(self.path, MANIFEST_FILE)
+        if not os.path.exists(manifest_path):
+            logger.error(f"{self.path} is not a complete snapshot (no {MANIFEST_FILE})")
+            return False
+        with open(manifest_path) as f:
+            self.manifest = json.load(f)
+        if self.manifest.get("format") != SNAPSHOT_FORMAT:
+            logger.error(f"Unsupported snapshot format {self.manifest.get('format')}")
+            return False
+
+        self.errors = {}
+        self.engine._run_per_table(self.import_table)
+        if self.errors:
+            logger.error(f"Snapshot import failed for {', '.join(self.errors)}")
+            return False
+        logger.success(f"Imported snapshot {self.path} taken at {self.manifest.get('created_at')}")
+        return True
+
+    def import_table(self, table):
+        """Bulk upsert a table's chunks into the local instance, then resume pulls from its watermark"""
+        entry = self.manifest["tables"].get(table)
+        if entry is None:
+            logger.warning(f"{table} is not in the snapshot, it will be pulled in full")
+            return
+        try:
+            batch = []
+            for chunk_file in entry["chunks"]:
+                with gzip.open(os.path.join(self.path, chunk_file), "rt", encoding="utf-8") as chunk:
+                    for line in chunk:
+                        record = json.loads(line)
+                        record["synced"] = True
+                        batch.append(record)
+                        if len(batch) >= self.engine.batch_size:
+                            self._load_batch(table, batch)
+                            batch = []
+            if batch:
+                self._load_batch(table, batch)
+
+            if entry["watermark"]:
+                self._resume_from(table, tuple(entry["watermark"]))
+            logger.success(f"Imported {entry['rows']} records into {table}")
+
+        except Exception as e:
+            logger.error(f"Error importing {table}: {e}")
+            self.errors[table] = str(e)
+
+    def _load_batch(self, table, records):
+        """Upsert one batch of snapshot records locally in a single request"""
+        self.engine._run_steps(self.engine._upsert_records("local", table, records))
+        self.engine._record_pulled_hashes(table, records)
+        self.engine.conflicts.record_bases(table, records)
+        self.engine.metrics.add_rows("remote_to_local", table, len(records))
+
+    def _resume_from(self, table, watermark):
+        """Set the pull watermark to the snapshot's, unless local is already further ahead"""
+        current = self.engine.state.get_watermark(table, "remote_to_local")
+        if current is not None and current[0] >= watermark[0]:
+            logger.info(f"Keeping the newer pull watermark of {table} ({current[0]})")
+            return
+        self.engine.state.set_watermark(table, "remote_to_local", *watermark)
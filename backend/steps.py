@@ -0,0 +1,54 @@
+"""
+Sync steps shared by the threaded and asyncio engines
+
+The sync logic (what to read, what to write, when to checkpoint) is written
+once, in PharmacyDatabaseSync, as generators that yield each piece of I/O
+they need as a step and receive the step's result back:
+
+    page = (yield Query("remote", query)).data
+
+Each engine drives these generators with its own _run_steps. The threaded
+engine carries the steps out in the calling thread; the asyncio engine
+awaits them, bounded by its per-instance limit of requests in flight. An
+error raised by a step is thrown back into the generator at its yield, so
+the sync logic handles errors with plain try/except.
+"""
+
+
+class Query:
+    """Execute a postgrest query builder on target ("local" or "remote"); the result is its response"""
+
+    def __init__(self, target, query):
+        self.target = target
+        self.query = query
+
+
+class Concurrently:
+    """Drive several step generators, at the same time where the engine can; the result is the list of their return values"""
+
+    def __init__(self, steps):
+        self.steps = list(steps)
+
+
+class PerTable:
+    """Drive sync_table(table), a step generator, for every table (or the given ones) in foreign key order"""
+
+    def __init__(self, sync_table, tables=None, reverse=False):
+        self.sync_table = sync_table
+        self.tables = tables
+        self.reverse = reverse
+
+
+class Blocking:
+    """Call function(*args), which blocks on local files; the asyncio engine runs it in a worker thread"""
+
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
+
+
+class Connect:
+    """Create the client of target ("local" or "remote"), replacing any previous one"""
+
+    def __init__(self, target):
+        self.target = target
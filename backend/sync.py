@@ -12,19 +12,44 @@ import sys
 import time
 import json
 import argparse
+import hashlib
+import contextvars
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 import schedule
 from loguru import logger
-from supabase import create_client, Client
+from supabase import create_client, Client, ClientOptions
+from postgrest import ReturnMethod, CountMethod
+import httpx
 import requests
 
-from config import LOCAL_SUPABASE_URL, REMOTE_SUPABASE_URL, SYNC_INTERVAL_MINUTES, LOCAL_SERVICE_ROLE_KEY, REMOTE_SERVICE_ROLE_KEY
+from config import LOCAL_SUPABASE_URL, REMOTE_SUPABASE_URL, SYNC_INTERVAL_MINUTES, LOCAL_SERVICE_ROLE_KEY, REMOTE_SERVICE_ROLE_KEY, SYNC_BATCH_SIZE, SYNC_PAGE_SIZE, SYNC_WORKERS, SYNC_STATE_FILE, SYNC_HTTP_POOL_SIZE, SYNC_HTTP_KEEPALIVE_SECONDS, SYNC_HTTP_TIMEOUT_SECONDS, SYNC_LARGE_COLUMN_BYTES, SYNC_METRICS_PORT, SYNC_PUSH_SOURCE, SYNC_BATCH_TARGET_SECONDS, SYNC_MIN_BATCH_SIZE, SYNC_NODE_ID, SYNC_TOMBSTONE_RETENTION_DAYS, SYNC_TOMBSTONE_LOOKBACK_SECONDS, SYNC_BRANCHES_FILE, SYNC_CRITICAL_INTERVAL_SECONDS, SYNC_TRACE_FILE
+from sync_state import SyncStateStore
+from metrics import SyncMetrics, start_metrics_server
+from conflicts import ConflictResolver
+from schema import SchemaCatalog
+from lanes import LaneScheduler
+from retention import Retention
+from resilience import CircuitBreaker, BreakerTransport
+from tracing import Tracer, SamplingProfiler
+from steps import Query, Concurrently, PerTable, Blocking, Connect
 
 class PharmacyDatabaseSync:
     """Class to handle synchronization between local and remote Supabase instances"""
     
-    def __init__(self):
-        """Initialize the sync class"""
+    # Log sinks are process-wide, so they are added by the first engine only
+    _log_configured = False
+    
+    def __init__(self, branch=None):
+        """Initialize the sync class.
+
+        branch ({"id", "url", "key"}) selects the local instance when one
+        process syncs several branches (see hub.py); by default it is
+        LOCAL_SUPABASE_URL.
+        """
 
+        # Tables to sync until schema discovery has run (see schema.py); discovered
+        # tables keep this order, tables not listed here are added after them
         self.PHARMACY_DB_TABLES = [
             "products",
             "categories",
@@ -40,40 +65,153 @@ class PharmacyDatabaseSync:
             "email_logs",
         ]
 
+        # Foreign keys between synced tables; a table syncs only after the tables it references.
+        # Replaced by the foreign keys found by schema discovery
+        self.TABLE_DEPENDENCIES = {
+            "products": ["categories"],
+            "sales": ["customers"],
+            "sale_items": ["sales", "products"],
+        }
+
+        # Per-table sync profiles:
+        #   columns       - columns to transfer (defaults to the discovered columns present on
+        #                   both instances, or all; must include id and updated_at)
+        #   large_columns - columns only sent when their content changed; any text value
+        #                   longer than SYNC_LARGE_COLUMN_BYTES is treated the same way
+        self.SYNC_PROFILES = {
+            "products": {"large_columns": ["description"]},
+            "categories": {"large_columns": ["description"]},
+            "email_queue": {"large_columns": ["template_data"]},
+        }
+
+        # Conflict policies for rows changed on both sides since their last sync (see conflicts.py):
+        #   strategy - "merge" (field-level three-way merge) or "remote_wins"
+        #   additive - numeric columns whose local and remote deltas are both applied
+        # Tables without a policy are overwritten by whichever direction writes last
+        self.CONFLICT_POLICIES = {
+            "products": {"strategy": "merge", "additive": ["quantity"]},
+            "customers": {"strategy": "merge", "additive": ["total_spent", "loyalty_points"]},
+            "settings": {"strategy": "remote_wins"},
+        }
+
+        # Retention policies for tables that only grow (see retention.py):
+        #   days   - rows older than this are moved into compressed archive files
+        #   column - timestamp column the age of a row is taken from (default created_at)
+        self.RETENTION_POLICIES = {
+            "email_logs": {"days": 90},
+            "email_queue": {"days": 30},
+            "notifications": {"days": 90},
+        }
+
+        # Sync lanes, most urgent first (see lanes.py):
+        #   tables            - tables in the lane; tables listed nowhere join the lane without a list
+        #   budget_seconds    - time per cycle and direction before the lane's remaining backlog
+        #                       waits for the next cycle (None: always synced to the end, first)
+        #   max_delay_minutes - deferred backlog older than this puts the lane ahead of the other budgeted lanes
+        self.SYNC_LANES = {
+            "critical": {
+                "tables": ["sales", "sale_items", "products", "stock_adjustments", "stock_audits", "stock_audit_items"],
+                "budget_seconds": None,
+            },
+            "standard": {"budget_seconds": 120, "max_delay_minutes": 30},
+            "bulk": {
+                "tables": ["notifications", "email_queue", "email_logs"],
+                "budget_seconds": 60,
+                "max_delay_minutes": 120,
+            },
+        }
+
         # Configure logging
-        logger.add("sync.log", rotation="10 MB", retention="1 week")
+        if not PharmacyDatabaseSync._log_configured:
+            logger.add("sync.log", rotation="10 MB", retention="1 week")
+            PharmacyDatabaseSync._log_configured = True
+        
+        # The local instance, and the name under which this node acknowledges tombstones
+        self.branch_id = branch["id"] if branch else None
+        self.local_url = branch["url"] if branch else LOCAL_SUPABASE_URL
+        self.local_key = branch["key"] if branch else LOCAL_SERVICE_ROLE_KEY
+        self.node_id = self.branch_id or SYNC_NODE_ID
+        # Whether the remote client is owned by a BranchHub and shared with other branches
+        self.shared_remote = False
+        
+        # Durable per-table watermarks, one state file per branch
+        state_file = SYNC_STATE_FILE
+        if branch:
+            stem, extension = os.path.splitext(SYNC_STATE_FILE)
+            state_file = f"{stem}.{self.branch_id}{extension}"
+        self.state = SyncStateStore(state_file)
+        self.conflicts = ConflictResolver(self.state, self.CONFLICT_POLICIES)
+        self.catalog = SchemaCatalog(self.state)
+        self.lanes = LaneScheduler(self.SYNC_LANES)
+        self.retention = Retention(self)
+        self.schema_discovered = False
         
         # Initialize clients
         self.local_supabase = None
         self.remote_supabase = None
+        # Pooled keep-alive HTTP clients backing the Supabase clients, by target
+        self._http_clients = {}
+        
+        # Where pushed changes come from: "outbox" (sync_outbox change log) or "scan" (synced = false)
+        self.push_source = SYNC_PUSH_SOURCE
+        # Instances with the sync_apply_batch function (see sync_functions.sql); REST upserts otherwise
+        self.bulk_apply = {"local": True, "remote": True}
+        # Whether the local instance has the sync_mark_synced function; filtered REST updates otherwise
+        self.bulk_mark = True
+        # Source instances of each direction with a sync_tombstones log (see sync_tombstones.sql)
+        self.tombstone_logs = {"local_to_remote": True, "remote_to_local": True}
+        
+        # Rows per remote upsert request when pushing; adapts between
+        # SYNC_MIN_BATCH_SIZE and SYNC_BATCH_SIZE to the observed batch latency
+        self.batch_size = SYNC_BATCH_SIZE
+        self.max_batch_size = SYNC_BATCH_SIZE
+        self.batch_target_seconds = SYNC_BATCH_TARGET_SECONDS
+        
+        # One circuit breaker per Supabase instance, shared by every request to it
+        self.breakers = {"local": CircuitBreaker("Local Supabase"), "remote": CircuitBreaker("Remote Supabase")}
+        # Rows per page when reading changes
+        self.page_size = SYNC_PAGE_SIZE
+        # Tables synced concurrently
+        self.max_workers = SYNC_WORKERS
         
         # Health status
         self.last_sync_time = None
         self.is_healthy = True
         self.health_status = "Initialized"
+        # Errors reported during the current cycle; it is only healthy without any
+        self.cycle_errors = []
+        self.last_connect_seconds = None
+        
+        # Counters and histograms exposed on /metrics
+        self.metrics = SyncMetrics(self.branch_id)
+        self.metrics_server = None
+        
+        # Spans of each cycle, written to SYNC_TRACE_FILE when it is set
+        self.tracer = Tracer(SYNC_TRACE_FILE)
 
     def connect_to_supabase(self, target="both"):
         """Establish connections to both Supabase instances"""
         if target == "local":
             try:
-                self.local_supabase = create_client(LOCAL_SUPABASE_URL, LOCAL_SERVICE_ROLE_KEY)
-                logger.info(f"Connected to local Supabase at {LOCAL_SUPABASE_URL}")
+                self.local_supabase = self._create_client("local", self.local_url, self.local_key)
+                logger.info(f"Connected to local Supabase at {self.local_url}")
                 self.health_status = "Connected to local Supabase"
             except Exception as e:
-                logger.error(f"Failed to connect to local Supabase: {e}")
+                # A client that cannot be built (bad URL or key, missing HTTP/2 support) will not recover on a retry
+                logger.error(f"Failed to create local Supabase client: {e}")
                 self.local_supabase = None
-                self.is_healthy = False
-                self.health_status = f"Failed to connect to local Supabase: {str(e)}"
+                self._set_unhealthy(f"Failed to create local Supabase client: {str(e)}")
+                raise
         elif target == "remote":
             try:
-                self.remote_supabase = create_client(REMOTE_SUPABASE_URL, REMOTE_SERVICE_ROLE_KEY)
+                self.remote_supabase = self._create_client("remote", REMOTE_SUPABASE_URL, REMOTE_SERVICE_ROLE_KEY)
                 logger.info(f"Connected to remote Supabase at {REMOTE_SUPABASE_URL}")
                 self.health_status = "Connected to remote Supabase"
             except Exception as e:
-                logger.error(f"Failed to connect to remote Supabase: {e}")
+                logger.error(f"Failed to create remote Supabase client: {e}")
                 self.remote_supabase = None
-                self.is_healthy = False
-                self.health_status = f"Failed to connect to remote Supabase: {str(e)}"
+                self._set_unhealthy(f"Failed to create remote Supabase client: {str(e)}")
+                raise
         elif target == "both":
             self.connect_to_supabase("local")
             self.connect_to_supabase("remote")
@@ -82,6 +220,146 @@ class PharmacyDatabaseSync:
             return False
         return True
 
+    def _create_client(self, target, url, key):
+        """Create a Supabase client on a pooled keep-alive HTTP client, replacing any previous one"""
+        previous_http_client = self._http_clients.pop(target, None)
+        if previous_http_client is not None:
+            previous_http_client.close()
+
+        transport = httpx.HTTPTransport(
+            limits=httpx.Limits(
+                max_connections=SYNC_HTTP_POOL_SIZE,
+                max_keepalive_connections=SYNC_HTTP_POOL_SIZE,
+                keepalive_expiry=SYNC_HTTP_KEEPALIVE_SECONDS,
+            ),
+            http2=True,
+        )
+        http_client = httpx.Client(
+            transport=BreakerTransport(self.breakers[target], transport),
+            timeout=SYNC_HTTP_TIMEOUT_SECONDS,
+            follow_redirects=True,
+            event_hooks={"request": [self._count_request_bytes(target)], "response": [self._count_response_bytes(target)]},
+        )
+        self._http_clients[target] = http_client
+
+        # Service role keys need no auth session, so skip the token refresh machinery
+        options = ClientOptions(httpx_client=http_client, auto_refresh_token=False, persist_session=False)
+        return create_client(url, key, options=options)
+
+    def _count_request_bytes(self, target):
+        """Build an HTTP hook counting request body bytes sent to target and timing the request"""
+        def hook(request):
+            self._request_sent(target, request)
+        return hook
+
+    def _count_response_bytes(self, target):
+        """Build an HTTP hook counting response body bytes received from target and tracing the request"""
+        def hook(response):
+            response.read()
+            self._response_received(target, response)
+        return hook
+
+    def _request_sent(self, target, request):
+        """Count the body bytes of a request to target and note when it went out"""
+        self.metrics.add_bytes(target, "sent", int(request.headers.get("content-length", 0)))
+        request.extensions["sync_started_ns"] = time.time_ns()
+
+    def _response_received(self, target, response):
+        """Count the body bytes of a response from target and record its request as a span"""
+        self.metrics.add_bytes(target, "received", len(response.content))
+        request = response.request
+        self.tracer.record(
+            f"{request.method} {request.url.path}",
+            request.extensions.get("sync_started_ns", time.time_ns()),
+            time.time_ns(),
+            target=target,
+            status=response.status_code,
+            bytes_sent=int(request.headers.get("content-length", 0)),
+            bytes_received=len(response.content),
+        )
+
+    def _run_steps(self, steps):
+        """Drive a generator of sync steps (see steps.py) to completion in this thread, returning its result"""
+        result, error = None, None
+        while True:
+            try:
+                step = steps.send(result) if error is None else steps.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                result, error = self._run_step(step), None
+            except BaseException as e:
+                result, error = None, e
+
+    def _run_step(self, step):
+        """Carry out a single sync step in this thread"""
+        if isinstance(step, Query):
+            return step.query.execute()
+        if isinstance(step, Concurrently):
+            return [self._run_steps(steps) for steps in step.steps]
+        if isinstance(step, PerTable):
+            return self._run_per_table(lambda table: self._run_steps(step.sync_table(table)), step.tables, step.reverse)
+        if isinstance(step, Blocking):
+            return step.function(*step.args)
+        if isinstance(step, Connect):
+            return self.connect_to_supabase(step.target)
+        raise TypeError(f"Unknown sync step {step!r}")
+
+    def _request(self, target, query):
+        """Steps of a single query, for running queries Concurrently"""
+        return (yield Query(target, query))
+
+    def ensure_connections(self):
+        """Reuse existing clients, reconnecting only those that are missing or fail a liveness probe"""
+        self._run_steps(self._ensure_connections())
+
+    def _ensure_connections(self):
+        """Steps of ensure_connections"""
+        for target in ("local",) if self.shared_remote else ("local", "remote"):
+            client = self.local_supabase if target == "local" else self.remote_supabase
+            if client is not None and (yield from self._probe(client, target)):
+                continue
+            yield Connect(target)
+        if not self.schema_discovered and self.local_supabase and self.remote_supabase:
+            yield from self._discover_schema()
+
+    def _probe(self, client, target):
+        """Cheap liveness check: fetch a single id over the existing connection"""
+        try:
+            yield Query(target, client.table(self.PHARMACY_DB_TABLES[0]).select("id").limit(1))
+            return True
+        except Exception as e:
+            logger.warning(f"{target.capitalize()} Supabase failed liveness probe, reconnecting: {e}")
+            return False
+
+    def _discover_schema(self):
+        """Sync the tables discovered on both instances, falling back to the cached or built-in schema"""
+        try:
+            local_rows, remote_rows = yield Concurrently([
+                self._request("local", self.local_supabase.rpc("sync_table_metadata", {})),
+                self._request("remote", self.remote_supabase.rpc("sync_table_metadata", {})),
+            ])
+            self.catalog.update(local_rows.data, remote_rows.data)
+        except Exception as e:
+            if self._is_network_error(e):
+                logger.warning(f"Schema discovery failed, retrying on the next cycle: {e}")
+                if not self.catalog.tables and self.catalog.load():
+                    self._apply_schema()
+                return
+            self.schema_discovered = True
+            if not self.catalog.load():
+                logger.warning(f"Schema discovery unavailable, syncing the built-in table list: {e}")
+                return
+            logger.warning(f"Schema discovery unavailable, syncing the tables discovered last time: {e}")
+        self.schema_discovered = True
+        self._apply_schema()
+
+    def _apply_schema(self):
+        """Take the table list and foreign keys from the catalog"""
+        self.PHARMACY_DB_TABLES = self.catalog.ordered_tables(self.PHARMACY_DB_TABLES)
+        self.TABLE_DEPENDENCIES = self.catalog.dependencies()
+        logger.info(f"Syncing tables: {', '.join(self.PHARMACY_DB_TABLES)}")
+
     def get_health_status(self):
         """Return the health status of the sync service"""
         status = {
@@ -90,126 +368,939 @@ class PharmacyDatabaseSync:
             "last_sync_time": self.last_sync_time,
             "local_connection": self.local_supabase is not None,
             "remote_connection": self.remote_supabase is not None,
+            "connection_setup_seconds": self.last_connect_seconds,
+            "last_error": self.metrics.last_error,
+            "circuits": {target: breaker.state for target, breaker in self.breakers.items()},
         }
         return status
-        
-    def sync_local_to_remote(self):
-        """Sync data from local to remote database"""
+
+    def _is_network_error(self, error):
+        """Whether error means an instance could not be reached, rather than that it rejected the data"""
+        return isinstance(error, (httpx.TransportError, TimeoutError))
+
+    def _open_circuit(self):
+        """Return (target, breaker) of the first instance whose circuit is open, or None"""
+        for target, breaker in self.breakers.items():
+            if breaker.is_open():
+                return target, breaker
+        return None
+
+    def _adapt_batch_size(self, seconds=None):
+        """Grow the push batch size while batches finish within the target time; halve it when they are slow or fail"""
+        if seconds is not None and seconds <= self.batch_target_seconds:
+            self.batch_size = min(self.max_batch_size, self.batch_size + max(1, self.max_batch_size // 10))
+        else:
+            self.batch_size = max(min(SYNC_MIN_BATCH_SIZE, self.max_batch_size), self.batch_size // 2)
+
+    def _set_unhealthy(self, message):
+        """Mark the service unhealthy and remember message as the last error"""
+        self.is_healthy = False
+        self.health_status = message
+        self.metrics.set_error(message)
+        self.cycle_errors.append(message)
+
+    def _skip_for_open_circuit(self):
+        """Whether to skip this cycle because an instance is known to be unreachable"""
+        open_circuit = self._open_circuit()
+        if open_circuit is None:
+            return False
+        target, breaker = open_circuit
+        logger.warning(f"Skipping sync cycle: {target} Supabase unreachable, next attempt in {breaker.retry_in():.0f}s")
+        self._set_unhealthy(f"{target.capitalize()} Supabase unreachable")
+        return True
+
+    def start_metrics_server(self):
+        """Serve /metrics and /health on SYNC_METRICS_PORT, unless it is 0"""
+        if SYNC_METRICS_PORT and self.metrics_server is None:
+            self.metrics_server = start_metrics_server(self, SYNC_METRICS_PORT)
+
+    def _backlog_query(self, table):
+        """Build the query counting local records waiting to be pushed"""
+        return self.local_supabase.table(table).select("id", count=CountMethod.exact, head=True).eq("synced", False)
+
+    def update_backlog(self):
+        """Refresh the backlog gauge of every table (only while metrics are served)"""
+        self._run_steps(self._update_backlog())
+
+    def _update_backlog(self):
+        """Steps of update_backlog"""
+        if self.metrics_server is None:
+            return
+        for table in self.PHARMACY_DB_TABLES:
+            try:
+                self.metrics.set_backlog(table, (yield Query("local", self._backlog_query(table))).count or 0)
+            except Exception as e:
+                logger.warning(f"Could not count backlog of {table}: {e}")
+
+    def sync_local_to_remote(self, tables=None):
+        """Sync data from local to remote database, optionally limited to some tables"""
+        self._run_steps(self._push(tables))
+
+    def _push(self, tables=None):
+        """Steps of sync_local_to_remote"""
         if not self.local_supabase or not self.remote_supabase:
             logger.error("Cannot sync: one or both database connections are unavailable")
-            self.is_healthy = False
-            self.health_status = "Cannot sync: database connections unavailable"
+            self._set_unhealthy("Cannot sync: database connections unavailable")
             return
-        
+
         logger.info("Starting sync from local to remote")
-        
-        for table in self.PHARMACY_DB_TABLES:
+        with self.tracer.span("push", source=self.push_source):
+            yield from self._run_lanes(self._drain_outbox if self.push_source == "outbox" else self._push_table, "local_to_remote", tables)
+            # The outbox already carries local deletes; a scan cannot see them
+            if self.push_source == "scan":
+                yield PerTable(self._push_tombstones, tables, reverse=True)
+
+    def _push_table(self, table):
+        """Push unsynced local records of a single table to remote"""
+        try:
+            total_count = 0
+            synced_count = 0
+
+            # Read unsynced local records page by page, keyed on id. Stops on an empty
+            # page rather than a short one, so a server-side row cap smaller than the
+            # page size cannot end the scan early
+            last_id = None
+            while True:
+                records = (yield Query("local", self._unsynced_query(table, last_id))).data
+                if not records:
+                    break
+                last_id = records[-1]["id"]
+                with self.tracer.span("page", table=table, rows=len(records)):
+                    logger.info(f"Syncing {len(records)} records from {table}")
+                    yield from self._resolve_push_conflicts(table, records)
+
+                    # Trim the records in place for remote insertion
+                    content_hashes = self._prepare_push(table, records)
+
+                    # Push in chunks so each request carries many rows; the async engine sends a page's chunks together
+                    results = yield Concurrently(
+                        self._push_batch(table, records[start:start + self.batch_size], content_hashes)
+                        for start in range(0, len(records), self.batch_size)
+                    )
+                    synced_count += sum(results)
+                    total_count += len(records)
+                    if self.lanes.out_of_budget(table, "local_to_remote"):
+                        yield from self._defer(table, "local_to_remote")
+                        break
+
+            self._finish_push(table, total_count, synced_count)
+
+        except Exception as e:
+            logger.error(f"Error syncing {table}: {e}")
+            self._set_unhealthy(f"Error syncing {table}: {str(e)}")
+
+    def _drain_outbox(self, table):
+        """Push the local changes of a single table recorded in the outbox, acknowledging them batch by batch"""
+        try:
+            total_count = 0
+            synced_count = 0
+
+            # Outbox events in commit order
+            last_seq = None
+            while True:
+                events = (yield Query("local", self._outbox_query(table, last_seq))).data
+                if not events:
+                    break
+                last_seq = events[-1]["seq"]
+                with self.tracer.span("page", table=table, rows=len(events)):
+                    changed_ids, deleted_ids = self._coalesce_outbox(events)
+                    failed_ids = []
+
+                    # A deleted row may have been inserted again since
+                    if deleted_ids:
+                        present = (yield Query("local", self.local_supabase.table(table).select("id").in_("id", deleted_ids))).data
+                        present_ids = {str(record["id"]) for record in present}
+                        changed_ids += [record_id for record_id in deleted_ids if record_id in present_ids]
+                        deleted_ids = [record_id for record_id in deleted_ids if record_id not in present_ids]
+
+                    records = []
+                    if changed_ids:
+                        records = (yield Query("local", self._outbox_records_query(table, changed_ids))).data
+                    if records:
+                        logger.info(f"Syncing {len(records)} records from {table}")
+                        yield from self._resolve_push_conflicts(table, records)
+                        content_hashes = self._prepare_push(table, records)
+                        synced_count += yield from self._push_batch(table, records, content_hashes, failed_ids)
+                    if deleted_ids:
+                        logger.info(f"Deleting {len(deleted_ids)} records from {table} on remote")
+                        synced_count += yield from self._delete_remote(table, deleted_ids, failed_ids)
+                    total_count += len(records) + len(deleted_ids)
+
+                    ack = self._ack_outbox_query(table, events, failed_ids)
+                    if ack is not None:
+                        yield Query("local", ack)
+                    if self.lanes.out_of_budget(table, "local_to_remote"):
+                        yield from self._defer(table, "local_to_remote")
+                        break
+
+            self._finish_push(table, total_count, synced_count)
+
+        except Exception as e:
+            if self._table_missing(e):
+                logger.warning(f"Local sync_outbox table not found, falling back to scanning for unsynced records: {e}")
+                self.push_source = "scan"
+                return (yield from self._push_table(table))
+            logger.error(f"Error syncing {table}: {e}")
+            self._set_unhealthy(f"Error syncing {table}: {str(e)}")
+
+    def _outbox_query(self, table, last_seq):
+        """Build the query for the next batch of outbox events of a table after last_seq"""
+        query = self.local_supabase.table("sync_outbox").select("seq,record_id,op").eq("table_name", table)
+        if last_seq is not None:
+            query = query.gt("seq", last_seq)
+        return query.order("seq").limit(self.batch_size)
+
+    def _outbox_records_query(self, table, record_ids):
+        """Build the query for the local records among record_ids"""
+        return self.local_supabase.table(table).select(self._select_columns(table)).in_("id", record_ids)
+
+    def _coalesce_outbox(self, events):
+        """Reduce a batch of events to (changed_ids, deleted_ids), keeping the last operation per record"""
+        last_ops = {}
+        for event in events:
+            last_ops[event["record_id"]] = event["op"]
+        changed_ids = [record_id for record_id, op in last_ops.items() if op != "DELETE"]
+        deleted_ids = [record_id for record_id, op in last_ops.items() if op == "DELETE"]
+        return changed_ids, deleted_ids
+
+    def _ack_outbox_query(self, table, events, failed_ids):
+        """Build the query removing a batch of handled events from the outbox, or None if there are none.
+
+        Events of records that failed to sync stay in the outbox and are
+        retried on the next cycle. Events are removed by their exact seq: a
+        transaction committing late can add an event with a lower seq than
+        ones already read, and it must stay for the next drain.
+        """
+        failed = {str(record_id) for record_id in failed_ids}
+        seqs = [event["seq"] for event in events if event["record_id"] not in failed]
+        if not seqs:
+            return None
+        return (
+            self.local_supabase.table("sync_outbox")
+            .delete(returning=ReturnMethod.minimal)
+            .eq("table_name", table)
+            .in_("seq", seqs)
+        )
+
+    def _table_missing(self, error):
+        """Whether error means a table or function (e.g. sync_outbox) is not installed on the instance"""
+        return getattr(error, "code", None) in ("42P01", "42883", "PGRST202", "PGRST205")
+
+    def _delete_remote(self, table, record_ids, failed_ids):
+        """Delete records removed locally from remote, returning how many were deleted"""
+        try:
+            yield Query("remote", self.remote_supabase.table(table).delete(returning=ReturnMethod.minimal).in_("id", record_ids))
+            return len(record_ids)
+        except Exception as e:
+            if self._is_network_error(e):
+                raise
+            logger.error(f"Error deleting {len(record_ids)} records from {table} on remote: {e}")
+            failed_ids.extend(record_ids)
+            return 0
+
+    def _select_columns(self, table):
+        """Return the PostgREST select list for a table's sync profile, or its discovered columns"""
+        columns = self.SYNC_PROFILES.get(table, {}).get("columns")
+        if not columns and table in self.catalog.tables:
+            columns = self.catalog.columns(table)
+        return ",".join(columns) if columns else "*"
+
+    def _content_hash(self, value):
+        """Hash a column value so unchanged large values can be recognised"""
+        encoded = value.encode() if isinstance(value, str) else json.dumps(value, sort_keys=True).encode()
+        return hashlib.blake2b(encoded, digest_size=16).hexdigest()
+
+    def _large_column_hashes(self, table, record):
+        """Return {column: hash} for the large column values of a record"""
+        large_columns = self.SYNC_PROFILES.get(table, {}).get("large_columns", ())
+        return {
+            column: self._content_hash(value)
+            for column, value in record.items()
+            if value is not None and (
+                column in large_columns or (isinstance(value, str) and len(value) > SYNC_LARGE_COLUMN_BYTES)
+            )
+        }
+
+    def _prepare_push(self, table, records):
+        """Make fetched local records ready for remote insertion, in a single in-place pass.
+
+        Drops the sync flag and any large column whose content is unchanged
+        since it was last synced. Returns {id: [(column, hash)]} for the large
+        values of the records, to be recorded once remote has accepted them;
+        a record missing one of its columns was trimmed.
+
+        Large columns are only left out while remote has sync_apply_batch,
+        which reports the rows it had to insert (see _resend_trimmed).
+        """
+        known_hashes = self.state.get_column_hashes(table, [record["id"] for record in records]) if self.bulk_apply["remote"] else {}
+        content_hashes = {}
+        for record in records:
+            record.pop("synced", None)
+            record_id = str(record["id"])
+            for column, value_hash in self._large_column_hashes(table, record).items():
+                if known_hashes.get((record_id, column)) == value_hash:
+                    del record[column]
+                content_hashes.setdefault(record["id"], []).append((column, value_hash))
+        return content_hashes
+
+    def _group_by_columns(self, records):
+        """Split records into groups sharing the same columns.
+
+        PostgREST bulk upserts use one column list for every row, so trimmed
+        and untrimmed records must go in separate requests.
+        """
+        groups = {}
+        for record in records:
+            groups.setdefault(tuple(record), []).append(record)
+        return list(groups.values())
+
+    def _upsert_records(self, target, table, records):
+        """Upsert records into a table on target ("local" or "remote").
+
+        Uses one sync_apply_batch call, which writes every row in a single
+        transaction on the server, or one REST upsert per column set where
+        that function is not installed. Returns the stored [{id, updated_at}]
+        versions, or None when the rows went over REST.
+        """
+        client = self.local_supabase if target == "local" else self.remote_supabase
+        if self.bulk_apply[target]:
             try:
-                # Get local records with sync flag
-                response = self.local_supabase.table(table).select("*").eq("synced", False).execute()
-                local_records = response.data
-                
-                if not local_records:
-                    logger.info(f"No new records to sync in {table}")
-                    continue
-                
-                logger.info(f"Syncing {len(local_records)} records from {table}")
-                
-                # Insert or update records in remote db
-                for record in local_records:
-                    record_id = record.get("id")
-                    # Remove sync flag for remote insertion
-                    record_copy = {k: v for k, v in record.items() if k != "synced"}
-                    
-                    # Upsert the record to remote
-                    self.remote_supabase.table(table).upsert(record_copy).execute()
-                    
-                    # Mark as synced in local db
-                    self.local_supabase.table(table).update({"synced": True}).eq("id", record_id).execute()
-                
-                logger.success(f"Successfully synced {len(local_records)} records from {table}")
-            
+                return (yield Query(target, client.rpc("sync_apply_batch", {"p_table": table, "p_rows": records}))).data
             except Exception as e:
-                logger.error(f"Error syncing {table}: {e}")
-                self.is_healthy = False
-                self.health_status = f"Error syncing {table}: {str(e)}"
+                if not self._table_missing(e):
+                    raise
+                logger.warning(f"No sync_apply_batch function on {target} Supabase, writing rows over REST: {e}")
+                self.bulk_apply[target] = False
+        yield Concurrently(
+            self._request(target, client.table(table).upsert(group, returning=ReturnMethod.minimal))
+            for group in self._group_by_columns(records)
+        )
+        return None
+
+    def _resend_trimmed(self, table, records, versions, content_hashes):
+        """Push again in full the trimmed records remote had to insert, returning the stored versions.
+
+        A row deleted on remote after it was last synced (by a tombstone or
+        by archiving) comes back as an insert, and would lose the large
+        columns left out of it. Where remote did not report which rows it
+        inserted, every trimmed record is resent.
+        """
+        trimmed_ids = {
+            str(record["id"]) for record in records
+            if any(column not in record for column, _ in (content_hashes or {}).get(record["id"], ()))
+        }
+        if versions is not None:
+            trimmed_ids &= {str(version["id"]) for version in versions if version.get("inserted")}
+        if not trimmed_ids:
+            return versions
+
+        query = self.local_supabase.table(table).select(self._select_columns(table)).in_("id", list(trimmed_ids))
+        full_records = (yield Query("local", query)).data
+        for record in full_records:
+            record.pop("synced", None)
+        logger.info(f"Resending {len(full_records)} trimmed records of {table} in full: remote did not have them, or could not tell")
+        resent = yield from self._upsert_records("remote", table, full_records)
+        self._record_pulled_hashes(table, full_records)
+        if versions is None or resent is None:
+            return None
+        return [version for version in versions if str(version["id"]) not in trimmed_ids] + resent
+
+    def _mark_synced(self, table, records):
+        """Mark pushed local records synced, unless they were changed again after they were read.
+
+        Only rows whose updated_at still matches the version pushed are
+        marked; a newer local edit keeps its row unsynced (and its outbox
+        event pending) for the next push.
+        """
+        versions = [{"id": record["id"], "updated_at": record["updated_at"]} for record in records]
+        if self.bulk_mark:
+            try:
+                yield Query("local", self.local_supabase.rpc("sync_mark_synced", {"p_table": table, "p_rows": versions}))
+                return
+            except Exception as e:
+                if not self._table_missing(e):
+                    raise
+                logger.warning(f"No sync_mark_synced function on local Supabase, marking rows over REST: {e}")
+                self.bulk_mark = False
+        # One update for the whole batch, matching each row's id and version
+        record_ids = {}
+        for version in versions:
+            record_ids.setdefault(version["updated_at"], []).append(version["id"])
+        matches = []
+        for updated_at, ids in record_ids.items():
+            id_list = ",".join(f'"{record_id}"' for record_id in ids)
+            matches.append(f'and(updated_at.eq."{updated_at}",id.in.({id_list}))')
+        yield Query("local", self.local_supabase.table(table).update({"synced": True}, returning=ReturnMethod.minimal).or_(",".join(matches)))
+
+    def _sent_hashes(self, records, content_hashes):
+        """Return (id, column, hash) entries of content_hashes for the values sent in records"""
+        if not content_hashes:
+            return []
+        return [
+            (record["id"], column, value_hash)
+            for record in records
+            for column, value_hash in content_hashes.get(record["id"], ())
+            if column in record
+        ]
+
+    def _finish_push(self, table, total_count, synced_count):
+        """Report how the pushed records of a table went"""
+        if not total_count:
+            logger.info(f"No new records to sync in {table}")
+            return
+
+        self.metrics.add_rows("local_to_remote", table, synced_count)
+        failed_count = total_count - synced_count
+        if failed_count:
+            logger.warning(f"Synced {synced_count} records from {table}, {failed_count} failed")
+            self._set_unhealthy(f"{failed_count} records failed to sync from {table}")
+        else:
+            logger.success(f"Successfully synced {synced_count} records from {table}")
+
+    def _unsynced_query(self, table, last_id):
+        """Build the query for the page of unsynced local records after last_id"""
+        query = self.local_supabase.table(table).select(self._select_columns(table)).eq("synced", False)
+        if last_id is not None:
+            query = query.gt("id", last_id)
+        return query.order("id").limit(self.page_size)
+
+    def _updated_since_query(self, table, cursor, keys_only=False):
+        """Build the query for the page of remote records after the (updated_at, id) cursor
+
+        A cursor without an id (e.g. migrated from a legacy timestamp file)
+        only filters on updated_at. With keys_only, only id and updated_at
+        are selected.
+        """
+        columns = "id,updated_at" if keys_only else self._select_columns(table)
+        query = self.remote_supabase.table(table).select(columns)
+        if cursor[1] is None:
+            query = query.gt("updated_at", cursor[0])
+        else:
+            updated_at, record_id = cursor
+            query = query.or_(
+                f'updated_at.gt."{updated_at}",and(updated_at.eq."{updated_at}",id.gt."{record_id}")'
+            )
+        return query.order("updated_at").order("id").limit(self.page_size)
+
+    def _iter_updated_since(self, table, watermark):
+        """Yield pages of remote records after the (updated_at, id) watermark in this thread (snapshot export)"""
+        cursor = watermark
+        while True:
+            page = self._updated_since_query(table, cursor).execute().data
+            if not page:
+                return
+            yield page
+            cursor = (page[-1]["updated_at"], page[-1]["id"])
+
+    def _push_batch(self, table, records, content_hashes=None, failed_ids=None):
+        """Upsert a chunk of records to remote and mark them synced locally.
+
+        If the chunk is rejected it is split in half and each half retried, so
+        a single bad row only fails on its own. Returns the number of records
+        synced; ids of records that failed are appended to failed_ids.
+
+        The synced flag (and, with the outbox, its acknowledgement) is what a
+        push resumes from, so an interrupted push only replays the batch that
+        was in flight, which the remote upsert makes harmless.
+        """
+        try:
+            batch_started = time.monotonic()
+            versions = yield from self._upsert_records("remote", table, records)
+            versions = yield from self._resend_trimmed(table, records, versions, content_hashes)
+            yield from self._mark_synced(table, records)
+            if versions:
+                self.state.set_pushed_versions(table, versions)
+            self.state.set_column_hashes(table, self._sent_hashes(records, content_hashes))
+            self.conflicts.record_bases(table, records)
+            batch_seconds = time.monotonic() - batch_started
+            self.metrics.observe_batch("local_to_remote", table, batch_seconds)
+            self._adapt_batch_size(batch_seconds)
+            return len(records)
+        except Exception as e:
+            # Splitting only helps when remote rejected the data, not when it could not be reached
+            if self._is_network_error(e):
+                self._adapt_batch_size()
+                raise
+            if len(records) == 1:
+                logger.error(f"Error syncing record {records[0].get('id')} from {table}: {e}")
+                if failed_ids is not None:
+                    failed_ids.append(records[0]["id"])
+                return 0
+
+            logger.warning(f"Batch of {len(records)} records from {table} failed, splitting: {e}")
+            middle = len(records) // 2
+            halves = yield Concurrently([
+                self._push_batch(table, records[:middle], content_hashes, failed_ids),
+                self._push_batch(table, records[middle:], content_hashes, failed_ids),
+            ])
+            return sum(halves)
+
+    def sync_remote_to_local(self, tables=None):
+        """Sync data from remote to local database, optionally limited to some tables"""
+        self._run_steps(self._pull(tables))
 
-    def sync_remote_to_local(self):
-        """Sync data from remote to local database"""
+    def _pull(self, tables=None):
+        """Steps of sync_remote_to_local"""
         if not self.local_supabase or not self.remote_supabase:
             logger.error("Cannot sync: one or both database connections are unavailable")
-            self.is_healthy = False
-            self.health_status = "Cannot sync: database connections unavailable"
+            self._set_unhealthy("Cannot sync: database connections unavailable")
             return
-        
+
         logger.info("Starting sync from remote to local")
-        
-        for table in self.PHARMACY_DB_TABLES:
-            try:
-                # Get last sync timestamp for this table
-                last_sync_file = f"last_sync_{table}.txt"
-                last_sync = "1970-01-01T00:00:00"
-                
-                if os.path.exists(last_sync_file):
-                    with open(last_sync_file, "r") as f:
-                        last_sync = f.read().strip()
-                
-                # Get remote records updated since last sync
-                response = self.remote_supabase.table(table).select("*").gt("updated_at", last_sync).execute()
-                remote_records = response.data
-                
-                if not remote_records:
-                    logger.info(f"No new updates in remote {table}")
+        with self.tracer.span("pull"):
+            yield from self._run_lanes(self._pull_table, "remote_to_local", tables)
+            yield PerTable(self._pull_tombstones, tables, reverse=True)
+
+    def _pull_table(self, table):
+        """Pull remote records of a single table updated since the last sync"""
+        try:
+            # Resume from the newest (updated_at, id) received on the previous sync
+            watermark = self.state.get_watermark(table, "remote_to_local") or ("1970-01-01T00:00:00", None)
+
+            # Rows this node pushed come back with a newer updated_at; while any
+            # are expected, read keys first and only fetch the rows that are not echoes
+            echo_check = self.state.has_pushed_versions(table)
+
+            # Read remote records updated since last sync page by page, keyed on (updated_at, id)
+            total_count = 0
+            echo_count = 0
+            cursor = watermark
+            caught_up = True
+            while True:
+                page = (yield Query("remote", self._updated_since_query(table, cursor, keys_only=echo_check))).data
+                if not page:
+                    break
+                cursor = (page[-1]["updated_at"], page[-1]["id"])
+                with self.tracer.span("page", table=table, rows=len(page)):
+                    remote_records = (yield from self._without_echoes(table, page)) if echo_check else page
+                    echo_count += len(page) - len(remote_records)
+                    if remote_records:
+                        logger.info(f"Syncing {len(remote_records)} records to {table}")
+
+                        # Insert or update records in local db, keeping merged local changes unsynced
+                        batch_started = time.monotonic()
+                        pending = yield from self._resolve_pull_conflicts(table, remote_records)
+                        rows = []
+                        for record in remote_records:
+                            record["synced"] = True  # Mark as synced
+                            rows.append(pending.get(record["id"], record))
+                        yield from self._upsert_records("local", table, rows)
+                        self._record_pulled_hashes(table, remote_records)
+                        self.conflicts.record_bases(table, remote_records)
+                        self.metrics.observe_batch("remote_to_local", table, time.monotonic() - batch_started)
+                        total_count += len(remote_records)
+                    watermark = self._checkpoint_pull(table, page)
+                    if self.lanes.out_of_budget(table, "remote_to_local"):
+                        yield from self._defer(table, "remote_to_local")
+                        caught_up = False
+                        break
+
+            self._finish_pull(table, total_count, watermark, echo_count, caught_up)
+
+        except Exception as e:
+            logger.error(f"Error syncing {table} from remote: {e}")
+            self._set_unhealthy(f"Error syncing {table} from remote: {str(e)}")
+
+    def _without_echoes(self, table, page):
+        """Drop the rows of a key-only page that came back as this node pushed them, and fetch the rest in full"""
+        echoes = self.state.take_pushed_versions(table, page)
+        changed = [record for record in page if str(record["id"]) not in echoes]
+        if not changed:
+            return []
+        return (yield Query("remote", self._remote_versions_query(table, changed))).data
+
+    def _remote_versions_query(self, table, records):
+        """Build the query for the remote versions of local records"""
+        record_ids = [record["id"] for record in records]
+        return self.remote_supabase.table(table).select(self._select_columns(table)).in_("id", record_ids)
+
+    def _local_pending_query(self, table, records):
+        """Build the query for the local versions of remote records that have unsynced changes"""
+        record_ids = [record["id"] for record in records]
+        return self.local_supabase.table(table).select(self._select_columns(table)).in_("id", record_ids).eq("synced", False)
+
+    def _resolve_push_conflicts(self, table, records):
+        """Merge a page of local records with their remote versions before pushing it.
+
+        Costs one remote read per page, and one local write when merges
+        changed any record, for tables with a conflict policy only.
+        """
+        if not self.conflicts.has_policy(table):
+            return
+        remote_records = (yield Query("remote", self._remote_versions_query(table, records))).data
+        merged = self.conflicts.resolve_page(table, records, remote_records)
+        if merged:
+            yield from self._upsert_records("local", table, merged)
+
+    def _resolve_pull_conflicts(self, table, remote_records):
+        """Merge a page of remote records into local rows with unsynced changes.
+
+        Returns {id: merged local record} for the rows that must keep their
+        local changes (and stay unsynced) instead of being overwritten.
+        """
+        if not self.conflicts.has_policy(table):
+            return {}
+        local_records = (yield Query("local", self._local_pending_query(table, remote_records))).data
+        self.conflicts.resolve_page(table, local_records, remote_records)
+        return {record["id"]: record for record in local_records}
+
+    def _record_pulled_hashes(self, table, records):
+        """Remember large column values received from remote so they are not sent back"""
+        self.state.set_column_hashes(table, [
+            (record["id"], column, value_hash)
+            for record in records
+            for column, value_hash in self._large_column_hashes(table, record).items()
+        ])
+
+    def _checkpoint_pull(self, table, records):
+        """Commit the pull watermark after a page has been written locally, returning it.
+
+        Pages arrive in (updated_at, id) order, so the last row is the
+        high-water mark. A restarted sync resumes after the last committed
+        page; a page interrupted halfway is fetched and upserted again.
+        """
+        watermark = (records[-1]["updated_at"], records[-1]["id"])
+        self.state.set_watermark(table, "remote_to_local", *watermark)
+        return watermark
+
+    def _finish_pull(self, table, total_count, watermark, echo_count=0, caught_up=True):
+        """Report how many records of a table arrived, and how many were skipped as echoes"""
+        # Once every remote change has been pulled the table is not behind,
+        # however long ago it last changed; otherwise it is behind by the age
+        # of the newest row pulled so far
+        self.metrics.set_watermark_lag(table, 0.0 if caught_up else self._seconds_since(watermark[0]))
+        if echo_count:
+            self.metrics.add_echoes(table, echo_count)
+            logger.info(f"Skipped {echo_count} records of {table} that this node had pushed")
+        if not total_count:
+            logger.info(f"No new updates in remote {table}")
+            return
+
+        self.metrics.add_rows("remote_to_local", table, total_count)
+        logger.success(f"Successfully synced {total_count} records to {table}")
+
+    def _seconds_since(self, timestamp):
+        """Return the seconds elapsed since an ISO timestamp (UTC when it has no offset)"""
+        moment = datetime.fromisoformat(timestamp)
+        if moment.tzinfo is None:
+            moment = moment.replace(tzinfo=timezone.utc)
+        return max(0.0, (datetime.now(timezone.utc) - moment).total_seconds())
+
+    def _direction_clients(self, direction):
+        """Return the (source, target) clients of a sync direction"""
+        if direction == "local_to_remote":
+            return self.local_supabase, self.remote_supabase
+        return self.remote_supabase, self.local_supabase
+
+    def _push_tombstones(self, table):
+        """Delete from remote the records of a table deleted locally"""
+        with self.tracer.span("tombstones", table=table, direction="local_to_remote"):
+            yield from self._apply_tombstones(table, "local_to_remote")
+
+    def _pull_tombstones(self, table):
+        """Delete locally the records of a table deleted on remote"""
+        with self.tracer.span("tombstones", table=table, direction="remote_to_local"):
+            yield from self._apply_tombstones(table, "remote_to_local")
+
+    def _tombstone_query(self, source, table, cursor, after_seq):
+        """Build the query for the next batch of tombstones of a table.
+
+        Reads past the (deleted_at, seq) cursor and, because a delete whose
+        transaction commits late can carry a lower seq than tombstones already
+        applied, also the tombstones deleted within SYNC_TOMBSTONE_LOOKBACK_SECONDS
+        before it. after_seq is the last seq read in this pass.
+        """
+        query = source.table("sync_tombstones").select("seq,record_id,deleted_at").eq("table_name", table)
+        if cursor is not None:
+            window_start = self._tombstone_window_start(cursor).isoformat()
+            query = query.or_(f'seq.gt.{int(cursor[1])},deleted_at.gte."{window_start}"')
+        if after_seq is not None:
+            query = query.gt("seq", after_seq)
+        return query.order("seq").limit(self.batch_size)
+
+    def _tombstone_window_start(self, cursor):
+        """Return the deleted_at from which tombstones behind the cursor are read again"""
+        return datetime.fromisoformat(cursor[0]) - timedelta(seconds=SYNC_TOMBSTONE_LOOKBACK_SECONDS)
+
+    def _tombstone_delete_query(self, target, table, direction, record_ids):
+        """Build the bulk delete of records removed on the other side.
+
+        Local rows with unsynced changes are kept when pulling: the local
+        edit wins and recreates the row on remote when it is pushed.
+        """
+        query = target.table(table).delete(returning=ReturnMethod.minimal).in_("id", record_ids)
+        if direction == "remote_to_local":
+            query = query.neq("synced", False)
+        return query
+
+    def _ack_tombstones_query(self, source, table, cursor):
+        """Build the upsert recording on the source how far this node has applied its tombstones"""
+        return source.table("sync_tombstone_acks").upsert({
+            "node_id": self.node_id,
+            "table_name": table,
+            "last_seq": int(cursor[1]),
+            "acknowledged_at": datetime.now(timezone.utc).isoformat(),
+        }, on_conflict="node_id,table_name", returning=ReturnMethod.minimal)
+
+    def _apply_tombstones(self, table, direction):
+        """Delete on the target, batch by batch, the records deleted on the source since the last applied tombstone"""
+        if not self.tombstone_logs[direction]:
+            return
+        source, target = self._direction_clients(direction)
+        source_name, target_name = direction.split("_to_")
+        cursor_key = f"{direction}_tombstones"
+        # Seqs applied within the lookback window, which is read again every cycle
+        applied_key = f"tombstones_applied:{direction}:{table}"
+        try:
+            cursor = self.state.get_watermark(table, cursor_key)
+            acked = cursor
+            applied = self.state.get_metadata(applied_key) or {}
+            deleted_count = 0
+
+            after_seq = None
+            while True:
+                tombstones = (yield Query(source_name, self._tombstone_query(source, table, cursor, after_seq))).data
+                if not tombstones:
+                    break
+                after_seq = tombstones[-1]["seq"]
+                tombstones = [tombstone for tombstone in tombstones if str(tombstone["seq"]) not in applied]
+                if not tombstones:
                     continue
-                
-                logger.info(f"Syncing {len(remote_records)} records to {table}")
-                
-                # Insert or update records in local db
-                for record in remote_records:
-                    record_copy = dict(record)
-                    record_copy["synced"] = True  # Mark as synced
-                    self.local_supabase.table(table).upsert(record_copy).execute()
-                
-                # Update last sync timestamp
-                current_time = time.strftime("%Y-%m-%dT%H:%M:%S")
-                with open(last_sync_file, "w") as f:
-                    f.write(current_time)
-                
-                logger.success(f"Successfully synced {len(remote_records)} records to {table}")
-            
+                record_ids = list(dict.fromkeys(tombstone["record_id"] for tombstone in tombstones))
+
+                # A deleted record may have been inserted again since
+                present = (yield Query(source_name, source.table(table).select("id").in_("id", record_ids))).data
+                present_ids = {str(record["id"]) for record in present}
+                record_ids = [record_id for record_id in record_ids if record_id not in present_ids]
+                if record_ids:
+                    logger.info(f"Deleting {len(record_ids)} records from {table} ({direction.replace('_', ' ')})")
+                    yield Query(target_name, self._tombstone_delete_query(target, table, direction, record_ids))
+                    deleted_count += len(record_ids)
+
+                if cursor is None or tombstones[-1]["seq"] > int(cursor[1]):
+                    cursor = (tombstones[-1]["deleted_at"], tombstones[-1]["seq"])
+                    self.state.set_watermark(table, cursor_key, *cursor)
+                window_start = self._tombstone_window_start(cursor)
+                applied.update((str(tombstone["seq"]), tombstone["deleted_at"]) for tombstone in tombstones)
+                applied = {
+                    seq: deleted_at for seq, deleted_at in applied.items()
+                    if datetime.fromisoformat(deleted_at) >= window_start
+                }
+                self.state.set_metadata(applied_key, applied)
+
+            # Acknowledge once per cycle, and once up front so compaction waits for this node
+            if cursor is None:
+                cursor = ("1970-01-01T00:00:00", 0)
+                self.state.set_watermark(table, cursor_key, *cursor)
+            if cursor != acked:
+                yield Query(source_name, self._ack_tombstones_query(source, table, cursor))
+            if deleted_count:
+                self.metrics.add_rows(direction, table, deleted_count)
+                logger.success(f"Applied {deleted_count} tombstones of {table}")
+
+        except Exception as e:
+            if self._table_missing(e):
+                logger.warning(f"No sync_tombstones table on {source_name} Supabase, deletes will not be propagated: {e}")
+                self.tombstone_logs[direction] = False
+                return
+            logger.error(f"Error propagating deletes of {table}: {e}")
+            self._set_unhealthy(f"Error propagating deletes of {table}: {str(e)}")
+
+    def _compact_tombstones(self):
+        """Remove old tombstones every node has applied, on each instance whose tombstone log is read"""
+        sources = {"remote": ("remote_to_local", self.remote_supabase)}
+        if self.push_source == "scan":
+            sources["local"] = ("local_to_remote", self.local_supabase)
+        for target, (direction, source) in sources.items():
+            if not self.tombstone_logs[direction]:
+                continue
+            try:
+                query = source.rpc("compact_sync_tombstones", {"retention_days": SYNC_TOMBSTONE_RETENTION_DAYS})
+                removed = (yield Query(target, query)).data
+                if removed:
+                    logger.info(f"Compacted {removed} tombstones on {target} Supabase")
             except Exception as e:
-                logger.error(f"Error syncing {table} from remote: {e}")
-                self.is_healthy = False
-                self.health_status = f"Error syncing {table} from remote: {str(e)}"
+                logger.warning(f"Could not compact tombstones on {target} Supabase: {e}")
+
+    def _table_dependencies(self, tables=None, reverse=False):
+        """Map each table being synced (all by default) to the tables it must wait for.
+
+        Tables wait for the tables they reference, or with reverse for the
+        tables referencing them (as deletes must). Dependencies that would
+        close a cycle are dropped with a warning, so every table is
+        guaranteed to be scheduled.
+        """
+        selected = self.PHARMACY_DB_TABLES if tables is None else [t for t in self.PHARMACY_DB_TABLES if t in tables]
+        dependencies = {table: set() for table in selected}
+
+        def depends_on(table, other):
+            stack, seen = [table], set()
+            while stack:
+                current = stack.pop()
+                if current == other:
+                    return True
+                if current not in seen:
+                    seen.add(current)
+                    stack.extend(dependencies[current])
+            return False
+
+        for table in selected:
+            for parent in self.TABLE_DEPENDENCIES.get(table, []):
+                if parent not in dependencies or parent == table:
+                    continue
+                waiting, awaited = (parent, table) if reverse else (table, parent)
+                if depends_on(awaited, waiting):
+                    logger.warning(f"Ignoring circular dependency of {table} on {parent}")
+                    continue
+                dependencies[waiting].add(awaited)
+        return dependencies
+
+    def _run_lanes(self, sync_table, direction, tables=None):
+        """Run sync_table for every table (or the given ones) lane by lane, in the order LaneScheduler plans"""
+        selected = self.PHARMACY_DB_TABLES if tables is None else [t for t in self.PHARMACY_DB_TABLES if t in tables]
+        for lane, lane_tables in self.lanes.plan(direction, selected, self.TABLE_DEPENDENCIES):
+            self.lanes.start_lane(lane, direction)
+            with self.tracer.span("lane", lane=lane, direction=direction, tables=len(lane_tables)):
+                yield PerTable(lambda table: self._run_in_lane(sync_table, table, direction), lane_tables)
+            self.metrics.set_lane_backlog(lane, direction, *self.lanes.backlog(lane, direction))
+
+    def _run_in_lane(self, sync_table, table, direction):
+        """Sync a table unless its lane has already spent its budget"""
+        self.lanes.table_started(table, direction)
+        with self.tracer.span("table", table=table, direction=direction) as span:
+            if self.lanes.out_of_budget(table, direction):
+                span["deferred"] = True
+                yield from self._defer(table, direction)
+            else:
+                yield from sync_table(table)
+        self.lanes.table_finished(table, direction)
+
+    def _deferred_backlog_query(self, table, direction):
+        """Build the query counting the records of a table still waiting to be synced in a direction"""
+        if direction == "local_to_remote":
+            return self._backlog_query(table)
+        watermark = self.state.get_watermark(table, "remote_to_local") or ("1970-01-01T00:00:00", None)
+        return self.remote_supabase.table(table).select("id", count=CountMethod.exact, head=True).gt("updated_at", watermark[0])
+
+    def _defer(self, table, direction):
+        """Leave the rest of a table's backlog to the next cycle, counting how much is left"""
+        source_name = direction.split("_to_")[0]
+        try:
+            rows = (yield Query(source_name, self._deferred_backlog_query(table, direction))).count or 0
+        except Exception as e:
+            logger.warning(f"Could not count the deferred backlog of {table}: {e}")
+            rows = 0
+        self.lanes.defer(table, direction, rows)
+        logger.info(f"Deferring {rows} records of {table} ({direction.replace('_', ' ')}) to the next cycle: its lane's time budget is spent")
+
+    def sync_critical_lanes(self):
+        """Sync only the tables of the lanes without a time budget, between full cycles"""
+        self._run_steps(self._sync_critical_lanes())
+
+    def _sync_critical_lanes(self):
+        """Steps of sync_critical_lanes"""
+        if self._skip_for_open_circuit():
+            return
+        yield from self._ensure_connections()
+        if not self.local_supabase or not self.remote_supabase:
+            return
+        tables = self.lanes.critical_tables(self.PHARMACY_DB_TABLES, self.TABLE_DEPENDENCIES)
+        with self.tracer.span("critical_cycle", node=self.node_id):
+            yield from self._push(tables)
+            yield from self._pull(tables)
+
+    def run_retention(self):
+        """Move rows past their retention period into archive files now; returns {target: {table: rows archived}}"""
+        return self._run_steps(self.retention.run())
+
+    def _run_per_table(self, sync_table, tables=None, reverse=False):
+        """Run sync_table for every table (or the given ones), concurrently where foreign keys allow.
+
+        A table is only started once every table it references has finished,
+        so parents always reach the target before their children. With
+        reverse, children finish first instead.
+        """
+        pending = self._table_dependencies(tables, reverse)
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                ready = [table for table, dependencies in pending.items() if not dependencies]
+                for table in ready:
+                    del pending[table]
+                    # Each worker inherits the current span, so its spans nest under it
+                    running[executor.submit(contextvars.copy_context().run, sync_table, table)] = table
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    table = running.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logger.error(f"Unexpected error syncing {table}: {e}")
+                        self._set_unhealthy(f"Unexpected error syncing {table}: {str(e)}")
+                    for dependencies in pending.values():
+                        dependencies.discard(table)
 
     def run_sync(self):
         """Run a complete sync cycle"""
-        self.connect_to_supabase()
-        
-        if self.local_supabase and self.remote_supabase:
-            self.sync_local_to_remote()
-            self.sync_remote_to_local()
-            self.last_sync_time = time.strftime("%Y-%m-%dT%H:%M:%S")
-            self.is_healthy = True
-            self.health_status = f"Last successful sync at {self.last_sync_time}"
-        else:
-            if not self.local_supabase:
-                logger.error("Cannot sync: local database connection is unavailable")
-            if not self.remote_supabase:
-                logger.error("Cannot sync: remote database connection is unavailable")
+        self._run_steps(self._run_cycle())
+
+    def _run_cycle(self):
+        """Steps of run_sync: connect and sync both directions, then do the housekeeping of a cycle"""
+        if self._skip_for_open_circuit():
+            return
+
+        self.cycle_errors = []
+        with self.tracer.span("cycle", node=self.node_id):
+            connect_started = time.monotonic()
+            with self.tracer.span("connect"):
+                yield from self._ensure_connections()
+            self.last_connect_seconds = time.monotonic() - connect_started
+            if self._skip_for_open_circuit():
+                return
+
+            if self.local_supabase and self.remote_supabase:
+                sync_started = time.monotonic()
+                yield from self._push()
+                yield from self._pull()
+                with self.tracer.span("housekeeping"):
+                    yield from self._compact_tombstones()
+                    if self.retention.due():
+                        yield from self.retention.run()
+                    yield from self._update_backlog()
+                logger.info(
+                    f"Sync cycle took {time.monotonic() - sync_started:.2f}s "
+                    f"(connection setup {self.last_connect_seconds:.3f}s)"
+                )
+                self.last_sync_time = time.strftime("%Y-%m-%dT%H:%M:%S")
+                if self.cycle_errors:
+                    # Stays unhealthy, reporting the last error
+                    logger.warning(f"Sync cycle finished with {len(self.cycle_errors)} errors")
+                else:
+                    self.is_healthy = True
+                    self.health_status = f"Last successful sync at {self.last_sync_time}"
+            else:
+                if not self.local_supabase:
+                    logger.error("Cannot sync: local database connection is unavailable")
+                if not self.remote_supabase:
+                    logger.error("Cannot sync: remote database connection is unavailable")
 
     def start(self):
         """Start the sync service"""
         logger.info("Starting pharmacy database sync service")
-        logger.info(f"Local Supabase URL: {LOCAL_SUPABASE_URL}")
+        logger.info(f"Local Supabase URL: {self.local_url}")
         logger.info(f"Remote Supabase URL: {REMOTE_SUPABASE_URL}")
-        
+        self.start_metrics_server()
+
         # Run immediately on startup
         self.run_sync()
-        
-        # Schedule regular syncs
+
+        # Schedule regular syncs, and more frequent ones of the critical lanes
         schedule.every(SYNC_INTERVAL_MINUTES).minutes.do(self.run_sync)
-        
+        if SYNC_CRITICAL_INTERVAL_SECONDS:
+            schedule.every(SYNC_CRITICAL_INTERVAL_SECONDS).seconds.do(self.sync_critical_lanes)
+
         # Keep the script running
         while True:
             schedule.run_pending()
@@ -545,16 +1636,102 @@ class PharmacyDatabaseSync:
     #     return success
 
 
+def profile_cycle(sync_service, path):
+    """Run one sync cycle under the sampling profiler, writing its collapsed stacks to path"""
+    import asyncio
+    import inspect
+    
+    async def run_once():
+        try:
+            await sync_service.run_sync()
+        finally:
+            await sync_service.close()
+    
+    profiler = SamplingProfiler()
+    profiler.start()
+    try:
+        if inspect.iscoroutinefunction(sync_service.run_sync):
+            asyncio.run(run_once())
+        else:
+            sync_service.run_sync()
+    finally:
+        profiler.stop()
+    profiler.write(path)
+    logger.info(f"Profile of one sync cycle written to {path}\n{profiler.summary()}")
+
+
 def main():
     """Main function to parse arguments and run the appropriate action"""
     parser = argparse.ArgumentParser(description='Pharmacy Database Sync and Initialization Tool')
     #parser.add_argument('--init', choices=['local', 'remote', 'both'], 
     #                    help='Initialize database with mock data (local, remote, or both)')
     parser.add_argument('--sync', action='store_true', help='Run the sync service')
+    parser.add_argument('--engine', choices=['threaded', 'async'], default='threaded',
+                        help='Sync engine to run (threaded schedule loop or asyncio)')
+    parser.add_argument('--listen', action='store_true',
+                        help='Sync realtime changes as they happen, polling only for reconciliation (async engine)')
+    parser.add_argument('--branches', metavar='FILE', default=SYNC_BRANCHES_FILE,
+                        help='Sync every branch listed in this JSON file from one process (see hub.py)')
+    parser.add_argument('--verify', action='store_true',
+                        help='Compare table checksums on both instances and re-sync only the rows that differ')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='Run one sync cycle under a sampling profiler and write its collapsed stacks to FILE')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('retention', help='Move rows past their retention period into compressed archive files now')
+    snapshot_parser = subparsers.add_parser('snapshot', help='Bootstrap a branch from a compressed snapshot of the remote tables')
+    snapshot_parser.add_argument('action', choices=['export', 'import'],
+                                 help='export: write the remote tables to PATH; import: load PATH into the local instance')
+    snapshot_parser.add_argument('path', help='Snapshot directory')
     
     args = parser.parse_args()
     
-    sync_service = PharmacyDatabaseSync()
+    if args.command == 'snapshot':
+        from snapshot import Snapshot
+        sync_service = PharmacyDatabaseSync()
+        sync_service.ensure_connections()
+        target = 'remote' if args.action == 'export' else 'local'
+        if not (sync_service.remote_supabase if target == 'remote' else sync_service.local_supabase):
+            logger.error(f"Cannot {args.action} snapshot: {target} database connection is unavailable")
+            sys.exit(1)
+        snapshot = Snapshot(sync_service, args.path)
+        if not (snapshot.export() if args.action == 'export' else snapshot.load()):
+            sys.exit(1)
+        return
+    
+    if args.command == 'retention':
+        sync_service = PharmacyDatabaseSync()
+        sync_service.ensure_connections()
+        results = sync_service.run_retention()
+        logger.info(f"Retention results: {json.dumps(results)}")
+        return
+    
+    if args.verify:
+        from reconcile import ChecksumReconciler
+        sync_service = PharmacyDatabaseSync()
+        sync_service.ensure_connections()
+        if not sync_service.local_supabase or not sync_service.remote_supabase:
+            logger.error("Cannot verify: one or both database connections are unavailable")
+            sys.exit(1)
+        results = ChecksumReconciler(sync_service).verify()
+        logger.info(f"Verification results: {json.dumps(results)}")
+        if any("error" in result for result in results.values()):
+            sys.exit(1)
+        return
+    
+    if args.sync and args.branches:
+        from hub import BranchHub, load_branches
+        if args.listen:
+            logger.warning("--listen is not supported with --branches, polling every SYNC_INTERVAL_MINUTES")
+        if args.profile:
+            logger.warning("--profile is not supported with --branches, use SYNC_TRACE_FILE instead")
+        BranchHub(load_branches(args.branches)).start()
+        return
+    
+    if args.engine == 'async' or args.listen:
+        from async_engine import AsyncPharmacyDatabaseSync
+        sync_service = AsyncPharmacyDatabaseSync()
+    else:
+        sync_service = PharmacyDatabaseSync()
     
     # Handle initialization if requested
     # if args.init:
@@ -564,9 +1741,16 @@ def main():
     #     if args.init == 'remote' or args.init == 'both':
     #         sync_service.initialize_database('remote')
     
+    if args.profile:
+        profile_cycle(sync_service, args.profile)
+        return
+    
     # Run sync service if requested or if no specific action was provided
     if args.sync:
-        sync_service.start()
+        if args.listen:
+            sync_service.start(listen=True)
+        else:
+            sync_service.start()
     
 
 if __name__ == "__main__":
@@ -0,0 +1,263 @@
+-- Database functions used by the pharmacy sync service (backend/sync.py)
+-- Execute this script in the Supabase SQL Editor of BOTH the local and the remote instance
+
+-- =================================================================
+-- 1. CHECKSUM RECONCILIATION (python sync.py --verify)
+-- =================================================================
+
+-- Range-bucketed checksums over a table with an integer id.
+-- Rows are grouped into buckets of p_bucket_size consecutive ids (optionally
+-- limited to p_min_id <= id < p_max_id) and each bucket gets a row count and
+-- an md5 over its rows. The synced flag and updated_at are left out of the hash
+-- because they legitimately differ between the local and remote copy of a row.
+CREATE OR REPLACE FUNCTION sync_bucket_checksums(
+    p_table TEXT,
+    p_bucket_size BIGINT,
+    p_min_id BIGINT DEFAULT NULL,
+    p_max_id BIGINT DEFAULT NULL
+)
+RETURNS TABLE (bucket BIGINT, row_count BIGINT, checksum TEXT) AS $$
+DECLARE
+    id_type TEXT;
+BEGIN
+    SELECT data_type INTO id_type
+    FROM information_schema.columns
+    WHERE table_schema = 'public' AND table_name = p_table AND column_name = 'id';
+
+    IF id_type IS NULL OR id_type NOT IN ('smallint', 'integer', 'bigint') THEN
+        RAISE EXCEPTION 'sync_bucket_checksums requires an integer id column on %', p_table;
+    END IF;
+
+    RETURN QUERY EXECUTE format(
+        'SELECT floor(t.id::numeric / $1)::bigint AS bucket,
+                count(*)::bigint AS row_count,
+                md5(string_agg(md5((to_jsonb(t) - ''synced'' - ''updated_at'')::text), '''' ORDER BY t.id)) AS checksum
+         FROM public.%I t
+         WHERE ($2 IS NULL OR t.id >= $2) AND ($3 IS NULL OR t.id < $3)
+         GROUP BY 1
+         ORDER BY 1',
+        p_table
+    ) USING p_bucket_size, p_min_id, p_max_id;
+END;
+$$ LANGUAGE plpgsql STABLE;
+
+-- =================================================================
+-- 2. SCHEMA DISCOVERY
+-- =================================================================
+
+-- Primary key, insertable columns and referenced tables of every table in the
+-- public schema. The sync service calls this once at startup and syncs the
+-- tables that have an id primary key, updated_at and synced on both instances.
+CREATE OR REPLACE FUNCTION sync_table_metadata()
+RETURNS TABLE (table_name TEXT, primary_key TEXT[], columns TEXT[], references_tables TEXT[]) AS $$
+    SELECT
+        c.relname::text,
+        ARRAY(
+            SELECT a.attname::text
+            FROM pg_index i
+            JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+            WHERE i.indrelid = c.oid AND i.indisprimary
+            ORDER BY a.attnum
+        ),
+        -- Generated columns cannot be written, so they are not transferred
+        ARRAY(
+            SELECT a.attname::text
+            FROM pg_attribute a
+            WHERE a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped AND a.attgenerated = ''
+            ORDER BY a.attnum
+        ),
+        ARRAY(
+            SELECT DISTINCT f.relname::text
+            FROM pg_constraint k
+            JOIN pg_class f ON f.oid = k.confrelid
+            WHERE k.conrelid = c.oid AND k.contype = 'f' AND f.relnamespace = c.relnamespace
+        )
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = 'public' AND c.relkind IN ('r', 'p') AND NOT c.relispartition
+    ORDER BY c.relname;
+$$ LANGUAGE sql STABLE;
+
+-- =================================================================
+-- 3. SYNC COLUMNS FOR PURCHASE, SUPPLIER, STOCK AUDIT AND IMPORT TABLES
+-- =================================================================
+
+-- Changes made by anyone but the sync service (service role) mark the row as
+-- changed: synced is cleared and updated_at bumped. Rows written by the sync
+-- service keep the values it sends, so they are not sent back again.
+CREATE OR REPLACE FUNCTION sync_mark_changed()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF current_user <> 'service_role' THEN
+        NEW.synced := FALSE;
+        NEW.updated_at := NOW();
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Adds the columns the sync service needs to the tables created by the
+-- frontend scripts (purchases_schema.sql, stock_audit_schema.sql and
+-- enhanced_import_database_script.sql). Existing rows start out unsynced,
+-- so the first cycle copies them.
+DO $$
+DECLARE
+    synced_table TEXT;
+BEGIN
+    FOREACH synced_table IN ARRAY ARRAY[
+        'suppliers', 'purchases', 'purchase_items', 'stock_audits', 'stock_audit_items',
+        'stock_adjustments', 'import_sessions'
+    ] LOOP
+        IF to_regclass('public.' || synced_table) IS NULL THEN
+            RAISE NOTICE 'Skipping missing table %', synced_table;
+            CONTINUE;
+        END IF;
+
+        EXECUTE format('ALTER TABLE public.%I ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ DEFAULT NOW()', synced_table);
+        EXECUTE format('ALTER TABLE public.%I ADD COLUMN IF NOT EXISTS synced BOOLEAN DEFAULT FALSE', synced_table);
+        EXECUTE format('CREATE INDEX IF NOT EXISTS %I ON public.%I(updated_at, id)', 'idx_' || synced_table || '_updated_at_id', synced_table);
+        EXECUTE format('CREATE INDEX IF NOT EXISTS %I ON public.%I(id) WHERE synced = FALSE', 'idx_' || synced_table || '_unsynced', synced_table);
+
+        EXECUTE format('DROP TRIGGER IF EXISTS sync_mark_changed ON public.%I', synced_table);
+        EXECUTE format(
+            'CREATE TRIGGER sync_mark_changed BEFORE INSERT OR UPDATE ON public.%I
+             FOR EACH ROW EXECUTE FUNCTION sync_mark_changed()',
+            synced_table
+        );
+    END LOOP;
+END;
+$$;
+
+-- =================================================================
+-- 4. SET-BASED BATCH APPLY
+-- =================================================================
+
+-- Upserts a JSON array of rows into p_table in a single statement per column
+-- set, instead of PostgREST's generic row-by-row upsert path. Pulled rows
+-- carry synced = true, so the rows and their synced flag are written in the
+-- same transaction. Rows may carry different columns (unchanged large values
+-- are left out of pushes); columns a row leaves out keep their current value,
+-- or get their default when the row is new. Keys that are not writable
+-- columns are ignored. Returns the stored version of every row as
+-- [{"id", "updated_at", "inserted"}], where inserted marks the rows that did
+-- not exist yet (a trimmed push of such a row is resent in full).
+CREATE OR REPLACE FUNCTION sync_apply_batch(p_table TEXT, p_rows JSONB)
+RETURNS JSONB AS $$
+DECLARE
+    v_table REGCLASS := format('public.%I', p_table)::regclass;
+    v_keys TEXT[];
+    v_group JSONB;
+    v_columns TEXT;
+    v_updates TEXT;
+    v_applied JSONB;
+    v_result JSONB := '[]'::jsonb;
+BEGIN
+    FOR v_keys, v_group IN
+        SELECT keys, jsonb_agg(row_value)
+        FROM (
+            SELECT r.value AS row_value,
+                   ARRAY(
+                       SELECT a.attname::text
+                       FROM pg_attribute a
+                       WHERE a.attrelid = v_table AND a.attnum > 0 AND NOT a.attisdropped
+                         AND a.attgenerated = '' AND r.value ? a.attname::text
+                       ORDER BY a.attnum
+                   ) AS keys
+            FROM jsonb_array_elements(p_rows) r
+        ) rows_by_keys
+        GROUP BY keys
+    LOOP
+        SELECT string_agg(quote_ident(k), ', '),
+               string_agg(format('%1$I = EXCLUDED.%1$I', k), ', ') FILTER (WHERE k <> 'id')
+        INTO v_columns, v_updates
+        FROM unnest(v_keys) k;
+
+        EXECUTE format(
+            'WITH applied AS (
+                 INSERT INTO %1$s AS t (%2$s)
+                 SELECT %2$s FROM jsonb_populate_recordset(NULL::%1$s, $1)
+                 ON CONFLICT (id) DO %3$s
+                 RETURNING t.id, t.updated_at, (t.xmax = 0) AS inserted
+             )
+             SELECT COALESCE(jsonb_agg(jsonb_build_object(''id'', id, ''updated_at'', updated_at, ''inserted'', inserted)), ''[]''::jsonb)
+             FROM applied',
+            v_table,
+            v_columns,
+            CASE WHEN v_updates IS NULL THEN 'NOTHING' ELSE 'UPDATE SET ' || v_updates END
+        )
+        INTO v_applied
+        USING v_group;
+
+        v_result := v_result || v_applied;
+    END LOOP;
+
+    RETURN v_result;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Marks pushed rows as synced, given a JSON array of the {"id", "updated_at"}
+-- versions that were sent. A row edited again since it was read has had its
+-- updated_at bumped by sync_mark_changed, so it stays unsynced (and its
+-- sync_outbox event pending) until that edit is pushed too. Returns the
+-- number of rows marked.
+CREATE OR REPLACE FUNCTION sync_mark_synced(p_table TEXT, p_rows JSONB)
+RETURNS INTEGER AS $$
+DECLARE
+    v_table REGCLASS := format('public.%I', p_table)::regclass;
+    v_marked INTEGER;
+BEGIN
+    EXECUTE format(
+        'UPDATE %1$s t SET synced = TRUE
+         FROM jsonb_populate_recordset(NULL::%1$s, $1) r
+         WHERE t.id = r.id AND t.updated_at = r.updated_at',
+        v_table
+    )
+    USING p_rows;
+    GET DIAGNOSTICS v_marked = ROW_COUNT;
+    RETURN v_marked;
+END;
+$$ LANGUAGE plpgsql;
+
+-- =================================================================
+-- 5. ARCHIVE DELETES
+-- =================================================================
+
+-- Deletes the rows whose ids are in a JSON array of {"id"} objects from
+-- p_table, once the sync service has written them to an archive file
+-- (backend/retention.py). The sync.archiving setting tells the capture
+-- triggers of sync_outbox.sql and sync_tombstones.sql to ignore these
+-- deletes, so archived rows are not deleted on the other instance as well.
+-- Returns the number of rows deleted.
+CREATE OR REPLACE FUNCTION sync_archive_rows(p_table TEXT, p_rows JSONB)
+RETURNS INTEGER AS $$
+DECLARE
+    v_table REGCLASS := format('public.%I', p_table)::regclass;
+    v_removed INTEGER;
+BEGIN
+    PERFORM set_config('sync.archiving', 'on', true);
+    EXECUTE format(
+        'DELETE FROM %1$s t USING jsonb_populate_recordset(NULL::%1$s, $1) r WHERE t.id = r.id',
+        v_table
+    )
+    USING p_rows;
+    GET DIAGNOSTICS v_removed = ROW_COUNT;
+    PERFORM set_config('sync.archiving', 'off', true);
+    RETURN v_removed;
+END;
+$$ LANGUAGE plpgsql;
+
+-- =================================================================
+-- GRANTS AND PERMISSIONS
+-- =================================================================
+
+-- Only the sync service (service role) may call these functions
+REVOKE EXECUTE ON FUNCTION sync_bucket_checksums(TEXT, BIGINT, BIGINT, BIGINT) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION sync_bucket_checksums(TEXT, BIGINT, BIGINT, BIGINT) TO service_role;
+REVOKE EXECUTE ON FUNCTION sync_table_metadata() FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION sync_table_metadata() TO service_role;
+REVOKE EXECUTE ON FUNCTION sync_apply_batch(TEXT, JSONB) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION sync_apply_batch(TEXT, JSONB) TO service_role;
+REVOKE EXECUTE ON FUNCTION sync_mark_synced(TEXT, JSONB) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION sync_mark_synced(TEXT, JSONB) TO service_role;
+REVOKE EXECUTE ON FUNCTION sync_archive_rows(TEXT, JSONB) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION sync_archive_rows(TEXT, JSONB) TO service_role;
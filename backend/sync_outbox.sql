@@ -0,0 +1,80 @@
+-- Local change outbox for the pharmacy sync service (backend/sync.py)
+-- Execute this script in the Supabase SQL Editor of the LOCAL instance only
+
+-- =================================================================
+-- 1. OUTBOX TABLE
+-- =================================================================
+
+-- Append-only log of row changes still to be pushed to the remote instance.
+-- The sync service reads it per table in seq order and deletes the events it
+-- has handled, so a cycle costs time in proportion to the number of changes
+-- rather than the size of the tables.
+CREATE TABLE IF NOT EXISTS sync_outbox (
+    seq BIGSERIAL PRIMARY KEY,
+    table_name TEXT NOT NULL,
+    record_id TEXT NOT NULL,
+    op TEXT NOT NULL CHECK (op IN ('INSERT', 'UPDATE', 'DELETE')),
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_sync_outbox_table_seq ON sync_outbox(table_name, seq);
+
+-- =================================================================
+-- 2. CHANGE CAPTURE TRIGGER
+-- =================================================================
+
+-- Records every insert, update and delete of a synced table. Rows written by
+-- the sync service itself (pulled records and the synced flag it sets after a
+-- push) are already marked as synced and are not recorded, and neither are
+-- rows it moves into the archive (sync_archive_rows in sync_functions.sql).
+CREATE OR REPLACE FUNCTION sync_outbox_capture()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF current_setting('sync.archiving', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP = 'DELETE' THEN
+        INSERT INTO sync_outbox (table_name, record_id, op) VALUES (TG_TABLE_NAME, OLD.id::text, TG_OP);
+    ELSIF NEW.synced IS NOT TRUE THEN
+        INSERT INTO sync_outbox (table_name, record_id, op) VALUES (TG_TABLE_NAME, NEW.id::text, TG_OP);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql SECURITY DEFINER SET search_path = public;
+
+-- Attach the trigger to every table with a synced flag (the tables schema discovery syncs) and
+-- queue the rows that were already waiting to be pushed
+DO $$
+DECLARE
+    synced_table TEXT;
+BEGIN
+    FOR synced_table IN
+        SELECT c.table_name FROM information_schema.columns c
+        JOIN information_schema.tables t ON t.table_schema = c.table_schema AND t.table_name = c.table_name
+        WHERE c.table_schema = 'public' AND c.column_name = 'synced' AND t.table_type = 'BASE TABLE'
+    LOOP
+        EXECUTE format('DROP TRIGGER IF EXISTS sync_outbox_capture ON public.%I', synced_table);
+        EXECUTE format(
+            'CREATE TRIGGER sync_outbox_capture AFTER INSERT OR UPDATE OR DELETE ON public.%I
+             FOR EACH ROW EXECUTE FUNCTION sync_outbox_capture()',
+            synced_table
+        );
+
+        EXECUTE format(
+            'INSERT INTO sync_outbox (table_name, record_id, op)
+             SELECT %L, id::text, ''UPDATE'' FROM public.%I WHERE synced IS NOT TRUE ORDER BY id',
+            synced_table, synced_table
+        );
+    END LOOP;
+END;
+$$;
+
+-- =================================================================
+-- GRANTS AND PERMISSIONS
+-- =================================================================
+
+-- Only the sync service (service role) may read or acknowledge the outbox
+ALTER TABLE sync_outbox ENABLE ROW LEVEL SECURITY;
+REVOKE ALL ON sync_outbox FROM PUBLIC, anon, authenticated;
+GRANT SELECT, DELETE ON sync_outbox TO service_role;
+REVOKE EXECUTE ON FUNCTION sync_outbox_capture() FROM PUBLIC, anon, authenticated;
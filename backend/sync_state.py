@@ -0,0 +1,268 @@
+"""
+Durable sync state for the pharmacy backend
+
+Keeps the per-table, per-direction high-water marks of the sync service in a
+single SQLite file so every cycle resumes exactly where the last one stopped.
+It also remembers content hashes of large columns already on the remote, so
+unchanged values do not have to be sent again, and the last synced version of
+rows in tables with a conflict policy, as the base for three-way merges, the
+versions of rows it has just pushed, so pulling them back can be skipped, and
+small JSON metadata such as the last discovered schema.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from loguru import logger
+
+
+# Pushed versions not seen again within this many seconds (e.g. rows remote
+# never touched again) are forgotten
+PUSHED_VERSION_TTL_SECONDS = 24 * 60 * 60
+
+class SyncStateStore:
+    """SQLite-backed store for sync watermarks, large column hashes, merge bases, pushed versions and metadata"""
+
+    def __init__(self, path):
+        """Open (or create) the state file and load the current watermarks"""
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=FULL")
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS watermarks (
+                table_name TEXT NOT NULL,
+                direction TEXT NOT NULL,
+                updated_at TEXT NOT NULL,
+                record_id TEXT,
+                PRIMARY KEY (table_name, direction)
+            )
+            """
+        )
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS column_hashes (
+                table_name TEXT NOT NULL,
+                record_id TEXT NOT NULL,
+                column_name TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                PRIMARY KEY (table_name, record_id, column_name)
+            ) WITHOUT ROWID
+            """
+        )
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS base_rows (
+                table_name TEXT NOT NULL,
+                record_id TEXT NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (table_name, record_id)
+            ) WITHOUT ROWID
+            """
+        )
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS pushed_versions (
+                table_name TEXT NOT NULL,
+                record_id TEXT NOT NULL,
+                updated_at TEXT NOT NULL,
+                pushed_at REAL NOT NULL,
+                PRIMARY KEY (table_name, record_id)
+            ) WITHOUT ROWID
+            """
+        )
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS metadata (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            )
+            """
+        )
+
+        # Watermarks are small, so keep them all in memory and write through
+        rows = self._connection.execute("SELECT table_name, direction, updated_at, record_id FROM watermarks")
+        self._watermarks = {(table, direction): (updated_at, record_id) for table, direction, updated_at, record_id in rows}
+
+    def get_watermark(self, table, direction):
+        """Return the (updated_at, id) high-water mark for a table and direction, or None"""
+        watermark = self._watermarks.get((table, direction))
+        if watermark is None:
+            watermark = self._load_legacy_watermark(table, direction)
+        return watermark
+
+    def set_watermark(self, table, direction, updated_at, record_id):
+        """Record the highest (updated_at, id) seen for a table and direction"""
+        record_id = None if record_id is None else str(record_id)
+        with self._lock:
+            self._connection.execute(
+                "INSERT INTO watermarks (table_name, direction, updated_at, record_id) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (table_name, direction) DO UPDATE SET updated_at = excluded.updated_at, record_id = excluded.record_id",
+                (table, direction, updated_at, record_id),
+            )
+            self._watermarks[(table, direction)] = (updated_at, record_id)
+
+    def get_column_hashes(self, table, record_ids):
+        """Return {(record_id, column): hash} of the large column values last synced for these records"""
+        record_ids = [str(record_id) for record_id in record_ids]
+        hashes = {}
+        with self._lock:
+            # Stay well below SQLite's bound-parameter limit
+            for start in range(0, len(record_ids), 500):
+                chunk = record_ids[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._connection.execute(
+                    f"SELECT record_id, column_name, hash FROM column_hashes "
+                    f"WHERE table_name = ? AND record_id IN ({placeholders})",
+                    (table, *chunk),
+                )
+                for record_id, column, value_hash in rows:
+                    hashes[(record_id, column)] = value_hash
+        return hashes
+
+    def set_column_hashes(self, table, hashes):
+        """Record (record_id, column, hash) entries for large column values now present on both sides"""
+        if not hashes:
+            return
+        with self._lock:
+            self._connection.execute("BEGIN")
+            try:
+                self._connection.executemany(
+                    "INSERT INTO column_hashes (table_name, record_id, column_name, hash) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (table_name, record_id, column_name) DO UPDATE SET hash = excluded.hash",
+                    [(table, str(record_id), column, value_hash) for record_id, column, value_hash in hashes],
+                )
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+
+    def get_base_rows(self, table, record_ids):
+        """Return {record_id: row} of the versions last synced for these records"""
+        record_ids = [str(record_id) for record_id in record_ids]
+        rows = {}
+        with self._lock:
+            for start in range(0, len(record_ids), 500):
+                chunk = record_ids[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                result = self._connection.execute(
+                    f"SELECT record_id, data FROM base_rows WHERE table_name = ? AND record_id IN ({placeholders})",
+                    (table, *chunk),
+                )
+                for record_id, data in result:
+                    rows[record_id] = json.loads(data)
+        return rows
+
+    def set_base_rows(self, table, rows):
+        """Record rows as the versions now present on both sides"""
+        if not rows:
+            return
+        with self._lock:
+            self._connection.execute("BEGIN")
+            try:
+                self._connection.executemany(
+                    "INSERT INTO base_rows (table_name, record_id, data) VALUES (?, ?, ?) "
+                    "ON CONFLICT (table_name, record_id) DO UPDATE SET data = excluded.data",
+                    [(table, str(row["id"]), json.dumps(row, default=str)) for row in rows],
+                )
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+
+    def set_pushed_versions(self, table, versions):
+        """Record the [{"id", "updated_at"}] versions remote stored for rows this node pushed"""
+        now = time.time()
+        with self._lock:
+            self._connection.execute("BEGIN")
+            try:
+                self._connection.execute(
+                    "DELETE FROM pushed_versions WHERE pushed_at < ?", (now - PUSHED_VERSION_TTL_SECONDS,)
+                )
+                self._connection.executemany(
+                    "INSERT INTO pushed_versions (table_name, record_id, updated_at, pushed_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (table_name, record_id) DO UPDATE SET updated_at = excluded.updated_at, pushed_at = excluded.pushed_at",
+                    [(table, str(version["id"]), version["updated_at"], now) for version in versions if version.get("updated_at")],
+                )
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+
+    def has_pushed_versions(self, table):
+        """Return whether any pushed version of a table is still waiting to be seen on pull"""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT 1 FROM pushed_versions WHERE table_name = ? LIMIT 1", (table,)
+            ).fetchone()
+        return row is not None
+
+    def take_pushed_versions(self, table, records):
+        """Return the ids (as text) of records whose (id, updated_at) this node pushed.
+
+        Every pushed version of these records is forgotten: a record either
+        came back as pushed, or remote has changed it since.
+        """
+        versions = {str(record["id"]): record["updated_at"] for record in records}
+        record_ids = list(versions)
+        echoes = set()
+        with self._lock:
+            self._connection.execute("BEGIN")
+            try:
+                for start in range(0, len(record_ids), 500):
+                    chunk = record_ids[start:start + 500]
+                    placeholders = ",".join("?" * len(chunk))
+                    rows = self._connection.execute(
+                        f"SELECT record_id, updated_at FROM pushed_versions "
+                        f"WHERE table_name = ? AND record_id IN ({placeholders})",
+                        (table, *chunk),
+                    )
+                    echoes.update(record_id for record_id, updated_at in rows if versions[record_id] == updated_at)
+                    self._connection.execute(
+                        f"DELETE FROM pushed_versions WHERE table_name = ? AND record_id IN ({placeholders})",
+                        (table, *chunk),
+                    )
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+        return echoes
+
+    def get_metadata(self, key):
+        """Return the JSON value stored under key, or None"""
+        with self._lock:
+            row = self._connection.execute("SELECT value FROM metadata WHERE key = ?", (key,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def set_metadata(self, key, value):
+        """Store a JSON-serializable value under key"""
+        with self._lock:
+            self._connection.execute(
+                "INSERT INTO metadata (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+                (key, json.dumps(value)),
+            )
+
+    def close(self):
+        """Close the underlying SQLite connection"""
+        with self._lock:
+            self._connection.close()
+
+    def _load_legacy_watermark(self, table, direction):
+        """Fall back to the last_sync_{table}.txt files written by earlier versions"""
+        legacy_file = f"last_sync_{table}.txt"
+        if direction != "remote_to_local" or not os.path.exists(legacy_file):
+            return None
+
+        with open(legacy_file, "r") as f:
+            last_sync = f.read().strip()
+        if not last_sync:
+            return None
+
+        logger.info(f"Migrating legacy watermark for {table} from {legacy_file}")
+        self.set_watermark(table, direction, last_sync, None)
+        return (last_sync, None)
@@ -0,0 +1,120 @@
+-- Tombstone log for delete propagation by the pharmacy sync service (backend/sync.py)
+-- Execute this script in the Supabase SQL Editor of the REMOTE instance, and of
+-- the LOCAL instance too when the sync service runs with SYNC_PUSH_SOURCE=scan
+-- (with the default outbox push source, local deletes travel through sync_outbox)
+
+-- =================================================================
+-- 1. TOMBSTONE TABLES
+-- =================================================================
+
+-- One row per deleted record of a synced table. The sync service reads it per
+-- table in seq order and deletes the same records on the other instance in bulk.
+CREATE TABLE IF NOT EXISTS sync_tombstones (
+    seq BIGSERIAL PRIMARY KEY,
+    table_name TEXT NOT NULL,
+    record_id TEXT NOT NULL,
+    deleted_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_sync_tombstones_table_seq ON sync_tombstones(table_name, seq);
+
+-- The last tombstone each sync node (SYNC_NODE_ID) has applied, per table.
+-- Tombstones are only compacted once every node has acknowledged them.
+CREATE TABLE IF NOT EXISTS sync_tombstone_acks (
+    node_id TEXT NOT NULL,
+    table_name TEXT NOT NULL,
+    last_seq BIGINT NOT NULL,
+    acknowledged_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (node_id, table_name)
+);
+
+-- =================================================================
+-- 2. DELETE CAPTURE TRIGGER
+-- =================================================================
+
+-- Rows moved into the archive (sync_archive_rows in sync_functions.sql) are
+-- archived on each instance separately and leave no tombstone
+CREATE OR REPLACE FUNCTION sync_tombstone_capture()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF current_setting('sync.archiving', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+    INSERT INTO sync_tombstones (table_name, record_id) VALUES (TG_TABLE_NAME, OLD.id::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql SECURITY DEFINER SET search_path = public;
+
+-- Attach the trigger to every table with a synced flag (the tables schema discovery syncs)
+DO $$
+DECLARE
+    synced_table TEXT;
+BEGIN
+    FOR synced_table IN
+        SELECT c.table_name FROM information_schema.columns c
+        JOIN information_schema.tables t ON t.table_schema = c.table_schema AND t.table_name = c.table_name
+        WHERE c.table_schema = 'public' AND c.column_name = 'synced' AND t.table_type = 'BASE TABLE'
+    LOOP
+        EXECUTE format('DROP TRIGGER IF EXISTS sync_tombstone_capture ON public.%I', synced_table);
+        EXECUTE format(
+            'CREATE TRIGGER sync_tombstone_capture AFTER DELETE ON public.%I
+             FOR EACH ROW EXECUTE FUNCTION sync_tombstone_capture()',
+            synced_table
+        );
+    END LOOP;
+END;
+$$;
+
+-- Products deleted before this script was installed are only known to the
+-- audit log of enhanced_product_deletion.sql; turn them into tombstones once
+DO $$
+BEGIN
+    IF to_regclass('public.product_deletion_audit') IS NOT NULL
+       AND NOT EXISTS (SELECT 1 FROM sync_tombstones WHERE table_name = 'products') THEN
+        INSERT INTO sync_tombstones (table_name, record_id, deleted_at)
+        SELECT 'products', pda.product_id::text, pda.performed_at
+        FROM product_deletion_audit pda
+        WHERE pda.operation_type = 'delete'
+          AND pda.product_id IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM products p WHERE p.id = pda.product_id)
+        ORDER BY pda.performed_at;
+    END IF;
+END;
+$$;
+
+-- =================================================================
+-- 3. COMPACTION
+-- =================================================================
+
+-- Removes tombstones older than retention_days that every node has applied.
+-- Called by the sync service once per cycle; returns the number removed.
+CREATE OR REPLACE FUNCTION compact_sync_tombstones(retention_days INTEGER DEFAULT 30)
+RETURNS INTEGER AS $$
+DECLARE
+    removed INTEGER;
+BEGIN
+    DELETE FROM sync_tombstones t
+    WHERE t.deleted_at < NOW() - make_interval(days => retention_days)
+      AND t.seq <= (
+          SELECT MIN(a.last_seq) FROM sync_tombstone_acks a WHERE a.table_name = t.table_name
+      );
+    GET DIAGNOSTICS removed = ROW_COUNT;
+    RETURN removed;
+END;
+$$ LANGUAGE plpgsql SECURITY DEFINER SET search_path = public;
+
+-- =================================================================
+-- GRANTS AND PERMISSIONS
+-- =================================================================
+
+-- Only the sync service (service role) may read the tombstones or acknowledge them.
+-- A decommissioned node holds back compaction until its row in
+-- sync_tombstone_acks is deleted.
+ALTER TABLE sync_tombstones ENABLE ROW LEVEL SECURITY;
+ALTER TABLE sync_tombstone_acks ENABLE ROW LEVEL SECURITY;
+REVOKE ALL ON sync_tombstones, sync_tombstone_acks FROM PUBLIC, anon, authenticated;
+GRANT SELECT ON sync_tombstones TO service_role;
+GRANT SELECT, INSERT, UPDATE, DELETE ON sync_tombstone_acks TO service_role;
+REVOKE EXECUTE ON FUNCTION sync_tombstone_capture() FROM PUBLIC, anon, authenticated;
+REVOKE EXECUTE ON FUNCTION compact_sync_tombstones(INTEGER) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION compact_sync_tombstones(INTEGER) TO service_role;
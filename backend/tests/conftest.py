@@ -0,0 +1,48 @@
+"""
+Shared setup for the backend tests
+
+The backend modules import each other as top-level modules, so the backend
+directory goes on the import path, along with benchmarks/ for the in-memory
+Supabase stand-ins. config.py requires SYNC_INTERVAL_MINUTES; no test runs a
+sync loop, so any value will do.
+"""
+
+import os
+import sys
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, os.path.join(BACKEND_DIR, "benchmarks"))
+os.environ.setdefault("SYNC_INTERVAL_MINUTES", "5")
+
+from fake_supabase import FakeSupabase
+from sync_state import SyncStateStore
+
+
+@pytest.fixture
+def state(tmp_path):
+    """A sync state store in a fresh SQLite file"""
+    store = SyncStateStore(str(tmp_path / "sync_state.db"))
+    yield store
+    store.close()
+
+
+@pytest.fixture
+def engine(tmp_path, monkeypatch):
+    """A threaded sync engine between two in-memory Supabase stand-ins, with its state in tmp_path.
+
+    The local stand-in captures changes into sync_outbox like the trigger of
+    sync_outbox.sql; neither has the sync_table_metadata function, so the
+    built-in table list is synced.
+    """
+    from sync import PharmacyDatabaseSync
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(PharmacyDatabaseSync, "_log_configured", True)
+    engine = PharmacyDatabaseSync()
+    engine.local_supabase = FakeSupabase(capture_outbox=True)
+    engine.remote_supabase = FakeSupabase()
+    yield engine
+    engine.state.close()
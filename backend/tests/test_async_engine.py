@@ -0,0 +1,59 @@
+"""Tests for the asyncio engine (async_engine.py) against the in-memory Supabase stand-ins"""
+
+import asyncio
+
+import pytest
+
+from fake_supabase import AsyncFakeSupabase
+
+
+@pytest.fixture
+def async_engine(tmp_path, monkeypatch):
+    """An async sync engine between two in-memory Supabase stand-ins, with its state in tmp_path"""
+    from async_engine import AsyncPharmacyDatabaseSync
+
+    # Apart from the state file of the threaded engine fixture
+    workdir = tmp_path / "async"
+    workdir.mkdir()
+    monkeypatch.chdir(workdir)
+    monkeypatch.setattr(AsyncPharmacyDatabaseSync, "_log_configured", True)
+    engine = AsyncPharmacyDatabaseSync()
+    engine.local_supabase = AsyncFakeSupabase(capture_outbox=True)
+    engine.remote_supabase = AsyncFakeSupabase()
+    # Created with the clients in connect_to_supabase
+    engine._semaphores = {target: asyncio.Semaphore(engine.max_in_flight) for target in ("local", "remote")}
+    yield engine
+    engine.state.close()
+
+
+def test_a_failing_table_does_not_stop_the_others(async_engine):
+    synced = []
+
+    async def sync_table(table):
+        if table == "customers":
+            raise RuntimeError("unexpected")
+        await asyncio.sleep(0)
+        synced.append(table)
+
+    asyncio.run(async_engine._run_per_table(sync_table))
+
+    assert sorted(synced) == sorted(table for table in async_engine.PHARMACY_DB_TABLES if table != "customers")
+    assert not async_engine.is_healthy
+    assert async_engine.cycle_errors == ["Unexpected error syncing customers: unexpected"]
+
+
+def test_threaded_and_async_engines_push_the_same_rows(engine, async_engine):
+    for sync_engine in (engine, async_engine):
+        sync_engine.PHARMACY_DB_TABLES = ["customers", "notifications"]
+        for record_id in range(1, 4):
+            for table in sync_engine.PHARMACY_DB_TABLES:
+                row = {"id": record_id, "name": f"Row {record_id}", "synced": False, "updated_at": "2026-01-01T08:00:00"}
+                sync_engine.local_supabase.put(table, row)
+                sync_engine.local_supabase.capture(table, row, "INSERT")
+
+    engine.sync_local_to_remote()
+    asyncio.run(async_engine.sync_local_to_remote())
+
+    assert async_engine.remote_supabase.tables["customers"] == engine.remote_supabase.tables["customers"]
+    assert async_engine.remote_supabase.tables["notifications"] == engine.remote_supabase.tables["notifications"]
+    assert async_engine.local_supabase.tables["sync_outbox"] == {}
@@ -0,0 +1,116 @@
+"""Tests for the three-way merges of ConflictResolver (conflicts.py)"""
+
+import pytest
+
+from conflicts import ConflictResolver
+
+
+POLICIES = {
+    "products": {"strategy": "merge", "additive": ["quantity"]},
+    "customers": {"strategy": "merge", "additive": ["total_spent"]},
+    "settings": {"strategy": "remote_wins"},
+}
+
+
+@pytest.fixture
+def resolver(state):
+    return ConflictResolver(state, POLICIES)
+
+
+def product(**values):
+    return dict({"id": 1, "name": "Paracetamol", "quantity": 10, "updated_at": "2026-01-01T00:00:00"}, **values)
+
+
+def test_additive_columns_combine_both_deltas(resolver):
+    resolver.record_bases("products", [product()])
+    local = product(quantity=7, updated_at="2026-01-02T00:00:00")
+    remote = product(quantity=15, updated_at="2026-01-02T00:00:01")
+
+    changed = resolver.resolve_page("products", [local], [remote])
+
+    # A sale of 3 on the branch and a delivery of 5 at HQ: 10 - 3 + 5
+    assert changed == [local]
+    assert local["quantity"] == 12
+
+
+def test_additive_decimals_do_not_drift(resolver):
+    base = {"id": 1, "total_spent": 10.1, "updated_at": "2026-01-01T00:00:00"}
+    resolver.record_bases("customers", [base])
+    local = dict(base, total_spent=10.3, updated_at="2026-01-02T00:00:00")
+    remote = dict(base, total_spent=10.2, updated_at="2026-01-02T00:00:01")
+
+    resolver.resolve_page("customers", [local], [remote])
+
+    assert local["total_spent"] == 10.4
+
+
+def test_column_changed_on_both_sides_takes_the_newer_row(resolver):
+    resolver.record_bases("products", [product()])
+    local = product(name="Local name", updated_at="2026-01-02T00:00:00")
+    remote = product(name="Remote name", updated_at="2026-01-03T00:00:00")
+
+    changed = resolver.resolve_page("products", [local], [remote])
+
+    assert changed == [local]
+    assert local["name"] == "Remote name"
+    assert local["updated_at"] == "2026-01-03T00:00:00"
+
+
+def test_newer_local_change_is_kept(resolver):
+    resolver.record_bases("products", [product()])
+    local = product(name="Local name", updated_at="2026-01-03T00:00:00")
+    remote = product(name="Remote name", updated_at="2026-01-02T00:00:00")
+
+    changed = resolver.resolve_page("products", [local], [remote])
+
+    assert changed == []
+    assert local["name"] == "Local name"
+
+
+def test_column_changed_on_one_side_keeps_that_change(resolver):
+    resolver.record_bases("products", [product()])
+    local = product(quantity=8, updated_at="2026-01-03T00:00:00")
+    remote = product(name="Renamed", updated_at="2026-01-02T00:00:00")
+
+    resolver.resolve_page("products", [local], [remote])
+
+    assert local["name"] == "Renamed"
+    assert local["quantity"] == 8
+
+
+def test_rows_without_a_base_are_left_alone(resolver):
+    local = product(quantity=7, updated_at="2026-01-02T00:00:00")
+    remote = product(quantity=15, updated_at="2026-01-02T00:00:01")
+
+    changed = resolver.resolve_page("products", [local], [remote])
+
+    assert changed == []
+    assert local["quantity"] == 7
+
+
+def test_rows_missing_remotely_are_left_alone(resolver):
+    resolver.record_bases("products", [product()])
+    local = product(quantity=7)
+
+    assert resolver.resolve_page("products", [local], []) == []
+    assert local["quantity"] == 7
+
+
+def test_remote_wins_replaces_local_changes(resolver):
+    base = {"id": 1, "name": "currency", "value": "EUR", "updated_at": "2026-01-01T00:00:00"}
+    resolver.record_bases("settings", [base])
+    local = dict(base, value="USD", updated_at="2026-01-03T00:00:00")
+    remote = dict(base, value="GBP", updated_at="2026-01-02T00:00:00")
+
+    changed = resolver.resolve_page("settings", [local], [remote])
+
+    assert changed == [local]
+    assert local["value"] == "GBP"
+
+
+def test_bases_are_only_recorded_for_tables_with_a_policy(resolver, state):
+    resolver.record_bases("products", [dict(product(), synced=True)])
+    resolver.record_bases("sales", [{"id": 1, "total": 5}])
+
+    assert state.get_base_rows("products", [1]) == {"1": product()}
+    assert state.get_base_rows("sales", [1]) == {}
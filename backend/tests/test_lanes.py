@@ -0,0 +1,132 @@
+"""Tests for the lane ordering, foreign key promotion and time budgets of LaneScheduler (lanes.py)"""
+
+import time
+
+import pytest
+
+from lanes import LaneScheduler
+
+
+LANES = {
+    "critical": {"tables": ["sales", "sale_items", "products"], "budget_seconds": None},
+    "standard": {"budget_seconds": 120, "max_delay_minutes": 30},
+    "bulk": {"tables": ["notifications", "email_logs"], "budget_seconds": 60, "max_delay_minutes": 120},
+}
+TABLES = ["categories", "products", "customers", "sales", "sale_items", "settings", "notifications", "email_logs"]
+DEPENDENCIES = {
+    "products": ["categories"],
+    "sales": ["customers"],
+    "sale_items": ["sales", "products"],
+}
+
+
+@pytest.fixture
+def scheduler():
+    return LaneScheduler({lane: dict(config) for lane, config in LANES.items()})
+
+
+def test_tables_go_to_their_listed_lane_or_the_catch_all(scheduler):
+    assignment = scheduler.assign(["settings", "notifications", "sales"], {})
+
+    assert assignment == {"settings": "standard", "notifications": "bulk", "sales": "critical"}
+
+
+def test_referenced_tables_are_promoted_to_the_more_urgent_lane(scheduler):
+    assignment = scheduler.assign(TABLES, DEPENDENCIES)
+
+    assert assignment["categories"] == "critical"
+    assert assignment["customers"] == "critical"
+    assert assignment["settings"] == "standard"
+    assert scheduler.critical_tables(TABLES, DEPENDENCIES) == ["categories", "products", "customers", "sales", "sale_items"]
+
+
+def test_referenced_table_in_a_less_urgent_lane_moves_up(scheduler):
+    assignment = scheduler.assign(TABLES, dict(DEPENDENCIES, settings=["email_logs"]))
+
+    assert assignment["email_logs"] == "standard"
+    assert assignment["settings"] == "standard"
+
+
+def test_child_follows_a_parent_in_a_budgeted_lane(scheduler):
+    # The standard lane may be deferred, so notifications must not run ahead of settings in its own lane
+    assignment = scheduler.assign(TABLES, dict(DEPENDENCIES, notifications=["settings"]))
+
+    assert assignment["notifications"] == "standard"
+    assert assignment["settings"] == "standard"
+
+
+def test_unbudgeted_lanes_run_first_then_the_configured_order(scheduler):
+    plan = scheduler.plan("local_to_remote", TABLES, DEPENDENCIES)
+
+    assert [lane for lane, _ in plan] == ["critical", "standard", "bulk"]
+    assert plan[0][1] == ["categories", "products", "customers", "sales", "sale_items"]
+
+
+def test_lane_with_more_deferred_backlog_goes_first(scheduler, monkeypatch):
+    scheduler.assign(TABLES, DEPENDENCIES)
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now)
+    scheduler.defer("notifications", "remote_to_local", 500)
+    monkeypatch.setattr(time, "time", lambda: now + 600)
+
+    plan = scheduler.plan("remote_to_local", TABLES, DEPENDENCIES)
+
+    assert [lane for lane, _ in plan] == ["critical", "bulk", "standard"]
+    # Backlog is kept per direction
+    assert [lane for lane, _ in scheduler.plan("local_to_remote", TABLES, DEPENDENCIES)] == ["critical", "standard", "bulk"]
+
+
+def test_starved_lane_goes_first_whatever_its_backlog(scheduler, monkeypatch):
+    scheduler.assign(TABLES, DEPENDENCIES)
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now)
+    scheduler.defer("settings", "remote_to_local", 1)
+    monkeypatch.setattr(time, "time", lambda: now + 20 * 60)
+    scheduler.defer("notifications", "remote_to_local", 10000)
+    # standard has waited 31 minutes, past its max_delay_minutes of 30
+    monkeypatch.setattr(time, "time", lambda: now + 31 * 60)
+
+    plan = scheduler.plan("remote_to_local", TABLES, DEPENDENCIES)
+
+    assert [lane for lane, _ in plan] == ["critical", "standard", "bulk"]
+
+
+def test_budget_is_spent_once_its_deadline_passes(scheduler, monkeypatch):
+    scheduler.assign(TABLES, DEPENDENCIES)
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now)
+    scheduler.start_lane("critical", "local_to_remote")
+    scheduler.start_lane("bulk", "local_to_remote")
+
+    assert not scheduler.out_of_budget("notifications", "local_to_remote")
+    monkeypatch.setattr(time, "monotonic", lambda: now + 61)
+    assert scheduler.out_of_budget("notifications", "local_to_remote")
+    # Lanes without a budget never run out
+    assert not scheduler.out_of_budget("sales", "local_to_remote")
+    # Nor does a lane that has not started in that direction
+    assert not scheduler.out_of_budget("notifications", "remote_to_local")
+
+
+def test_backlog_is_forgotten_once_a_table_syncs_to_the_end(scheduler):
+    scheduler.assign(TABLES, DEPENDENCIES)
+    scheduler.table_started("notifications", "remote_to_local")
+    scheduler.defer("notifications", "remote_to_local", 40)
+    scheduler.table_finished("notifications", "remote_to_local")
+
+    assert scheduler.backlog("bulk", "remote_to_local")[0] == 40
+
+    scheduler.table_started("notifications", "remote_to_local")
+    scheduler.table_finished("notifications", "remote_to_local")
+
+    assert scheduler.backlog("bulk", "remote_to_local") == (0, 0.0)
+
+
+def test_deferred_backlog_keeps_the_time_it_was_first_deferred(scheduler, monkeypatch):
+    scheduler.assign(TABLES, DEPENDENCIES)
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now)
+    scheduler.defer("email_logs", "remote_to_local", 100)
+    monkeypatch.setattr(time, "time", lambda: now + 300)
+    scheduler.defer("email_logs", "remote_to_local", 30)
+
+    assert scheduler.backlog("bulk", "remote_to_local") == (30, 300)
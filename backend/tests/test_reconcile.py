@@ -0,0 +1,50 @@
+"""Tests for the row repairs of ChecksumReconciler (reconcile.py)"""
+
+import pytest
+
+from reconcile import ChecksumReconciler
+
+
+@pytest.fixture
+def reconciler(engine):
+    engine.PHARMACY_DB_TABLES = ["customers"]
+    return ChecksumReconciler(engine)
+
+
+def customer(record_id, **values):
+    return dict({"id": record_id, "name": f"Customer {record_id}", "updated_at": "2026-01-01T08:00:00"}, **values)
+
+
+def test_unsynced_local_rows_are_pushed_and_synced_ones_pulled(engine, reconciler):
+    local, remote = engine.local_supabase, engine.remote_supabase
+    local.put("customers", customer(1, name="Edited locally", synced=False))
+    remote.put("customers", customer(1))
+    local.put("customers", customer(2, synced=True))
+    remote.put("customers", customer(2, name="Edited at HQ"))
+
+    results = reconciler.verify()
+
+    assert results["customers"]["differing"] == 2
+    assert remote.tables["customers"][1]["name"] == "Edited locally"
+    assert local.tables["customers"][2]["name"] == "Edited at HQ"
+
+
+def test_synced_rows_deleted_on_remote_are_not_pushed_back(engine, reconciler):
+    local, remote = engine.local_supabase, engine.remote_supabase
+    local.put("customers", customer(1, synced=True))
+    local.put("customers", customer(2, synced=False))
+
+    results = reconciler.verify()
+
+    assert results["customers"]["pushed"] == 1
+    assert list(remote.tables["customers"]) == [2]
+
+
+def test_repairs_only_transfer_the_synced_columns(engine, reconciler):
+    local, remote = engine.local_supabase, engine.remote_supabase
+    engine.SYNC_PROFILES["customers"] = {"columns": ["id", "name", "updated_at"]}
+    local.put("customers", customer(1, notes="Branch only", synced=False))
+
+    reconciler.verify()
+
+    assert "notes" not in remote.tables["customers"][1]
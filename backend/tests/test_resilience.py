@@ -0,0 +1,199 @@
+"""Tests for the CircuitBreaker state transitions and the breaker transports (resilience.py)"""
+
+import asyncio
+import time
+
+import httpx
+import pytest
+
+from resilience import AsyncBreakerTransport, BreakerTransport, CircuitBreaker, CircuitOpenError
+
+
+class Clock:
+    """Stand-in for time.monotonic that only moves when told to"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, "monotonic", clock)
+    return clock
+
+
+@pytest.fixture
+def breaker(clock):
+    breaker = CircuitBreaker("remote")
+    breaker.failure_threshold = 3
+    breaker.base_delay = 10
+    breaker.max_delay = 40
+    return breaker
+
+
+def open_circuit(breaker):
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+
+
+def test_opens_after_too_many_failures_in_a_row(breaker):
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    assert breaker.allow()
+
+    breaker.record_failure()
+
+    assert breaker.state == "open"
+    assert breaker.is_open()
+    assert not breaker.allow()
+
+
+def test_success_resets_the_failure_count(breaker):
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+
+    assert breaker.state == "closed"
+
+
+def test_delay_is_jittered_within_half_to_full(breaker):
+    open_circuit(breaker)
+
+    assert 5 <= breaker.retry_in() <= 10
+
+
+def test_half_open_lets_a_single_probe_through(breaker, clock):
+    open_circuit(breaker)
+    clock.now += 10
+
+    assert not breaker.is_open()
+    assert breaker.allow()
+    assert breaker.state == "half_open"
+    assert not breaker.allow()
+
+
+def test_successful_probe_closes_the_circuit(breaker, clock):
+    open_circuit(breaker)
+    clock.now += 10
+    breaker.allow()
+
+    breaker.record_success()
+
+    assert breaker.state == "closed"
+    assert breaker.allow()
+    assert breaker.allow()
+
+
+def test_failed_probe_reopens_with_a_longer_delay_up_to_the_maximum(breaker, clock):
+    open_circuit(breaker)
+    for delay in (20, 40, 40):
+        clock.now += breaker.retry_in()
+        assert breaker.allow()
+        breaker.record_failure()
+
+        assert breaker.state == "open"
+        assert delay / 2 <= breaker.retry_in() <= delay
+
+
+def test_failures_while_open_do_not_extend_the_delay(breaker, clock):
+    open_circuit(breaker)
+    retry_in = breaker.retry_in()
+
+    breaker.record_failure()
+    breaker.record_failure()
+
+    assert breaker.retry_in() == retry_in
+
+
+def test_release_frees_the_probe(breaker, clock):
+    open_circuit(breaker)
+    clock.now += 10
+    assert breaker.allow()
+
+    breaker.release()
+
+    assert breaker.state == "half_open"
+    assert breaker.allow()
+
+
+class Responding(httpx.BaseTransport):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+    def handle_request(self, request):
+        return httpx.Response(self.status_code)
+
+
+class Failing(httpx.BaseTransport):
+    def handle_request(self, request):
+        raise httpx.ConnectError("connection refused", request=request)
+
+
+def test_transport_counts_unavailable_responses_and_network_errors(breaker):
+    request = httpx.Request("GET", "https://remote.example/rest/v1/products")
+    BreakerTransport(breaker, Responding(503)).handle_request(request)
+    with pytest.raises(httpx.ConnectError):
+        BreakerTransport(breaker, Failing()).handle_request(request)
+    BreakerTransport(breaker, Responding(500)).handle_request(request)
+
+    # A 500 means the instance answered
+    assert breaker.state == "closed"
+
+    BreakerTransport(breaker, Responding(503)).handle_request(request)
+    BreakerTransport(breaker, Responding(502)).handle_request(request)
+    with pytest.raises(httpx.ConnectError):
+        BreakerTransport(breaker, Failing()).handle_request(request)
+
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        BreakerTransport(breaker, Responding(200)).handle_request(request)
+
+
+class Hanging(httpx.AsyncBaseTransport):
+    async def handle_async_request(self, request):
+        await asyncio.sleep(60)
+
+
+class FailingAsync(httpx.AsyncBaseTransport):
+    async def handle_async_request(self, request):
+        raise httpx.ConnectError("connection refused", request=request)
+
+
+def test_cancelled_request_is_not_counted_as_a_failure(breaker, clock):
+    request = httpx.Request("GET", "https://remote.example/rest/v1/products")
+    transport = AsyncBreakerTransport(breaker, Hanging())
+
+    async def cancel_probe():
+        task = asyncio.create_task(transport.handle_async_request(request))
+        await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    open_circuit(breaker)
+    clock.now += 10
+    asyncio.run(cancel_probe())
+
+    # The probe was given back rather than re-opening the circuit
+    assert breaker.state == "half_open"
+    assert breaker.allow()
+
+
+def test_async_network_error_is_counted_as_a_failure(breaker):
+    request = httpx.Request("GET", "https://remote.example/rest/v1/products")
+    transport = AsyncBreakerTransport(breaker, FailingAsync())
+
+    async def send():
+        with pytest.raises(httpx.ConnectError):
+            await transport.handle_async_request(request)
+
+    for _ in range(breaker.failure_threshold):
+        asyncio.run(send())
+
+    assert breaker.state == "open"
@@ -0,0 +1,312 @@
+"""Behaviour tests of PharmacyDatabaseSync (sync.py) against the in-memory Supabase stand-ins"""
+
+from datetime import datetime, timezone
+
+
+def insert(db, table, row, seq=None):
+    """Write an unsynced local row and capture it in the outbox, as the local app does"""
+    row = dict({"synced": False, "updated_at": "2026-01-01T08:00:00"}, **row)
+    db.put(table, row)
+    db.capture(table, row, "INSERT", seq)
+    return row
+
+
+def test_outbox_push_marks_rows_synced_and_empties_the_outbox(engine):
+    local, remote = engine.local_supabase, engine.remote_supabase
+    for record_id in range(1, 4):
+        insert(local, "customers", {"id": record_id, "name": f"Customer {record_id}"})
+
+    engine.sync_local_to_remote()
+
+    assert sorted(remote.tables["customers"]) == [1, 2, 3]
+    assert all(row["synced"] for row in local.tables["customers"].values())
+    assert local.tables["sync_outbox"] == {}
+
+
+def test_outbox_event_committed_late_with_a_lower_seq_is_still_pushed(engine, monkeypatch):
+    local, remote = engine.local_supabase, engine.remote_supabase
+    insert(local, "customers", {"id": 1, "name": "First"})
+    late_seq = local.reserve_seq()
+    insert(local, "customers", {"id": 3, "name": "Third"})
+
+    # The transaction that took seq 2 commits after the drain read seqs 1 and 3, before it acknowledged them
+    coalesce_outbox = engine._coalesce_outbox
+
+    def commit_late(events):
+        if late_seq not in local.tables["sync_outbox"]:
+            insert(local, "customers", {"id": 2, "name": "Second"}, seq=late_seq)
+        return coalesce_outbox(events)
+    monkeypatch.setattr(engine, "_coalesce_outbox", commit_late)
+
+    engine.sync_local_to_remote()
+
+    assert sorted(remote.tables["customers"]) == [1, 3]
+    assert list(local.tables["sync_outbox"]) == [late_seq]
+
+    engine.sync_local_to_remote()
+
+    assert sorted(remote.tables["customers"]) == [1, 2, 3]
+    assert local.tables["sync_outbox"] == {}
+
+
+def update(db, table, record_id, **values):
+    """Change a local row and capture it in the outbox"""
+    row = db.tables[table][record_id]
+    row.update(values, synced=False)
+    db.capture(table, row, "UPDATE")
+    return row
+
+
+def test_remote_edit_of_a_trimmed_column_survives_a_conflicting_local_edit(engine):
+    local, remote = engine.local_supabase, engine.remote_supabase
+    insert(local, "products", {"id": 1, "name": "Paracetamol", "quantity": 10, "description": "Original leaflet"})
+    engine.sync_local_to_remote()
+    # The description has not changed, so this push leaves it out
+    update(local, "products", 1, quantity=9, updated_at="2026-01-01T09:00:00")
+    engine.sync_local_to_remote()
+
+    remote.tables["products"][1].update(description="Leaflet revised at HQ", updated_at="2026-01-01T10:00:00")
+    update(local, "products", 1, name="Paracetamol 500mg", updated_at="2026-01-01T09:30:00")
+    engine.sync_remote_to_local()
+    engine.sync_local_to_remote()
+
+    for db in (local, remote):
+        assert db.tables["products"][1]["description"] == "Leaflet revised at HQ"
+        assert db.tables["products"][1]["name"] == "Paracetamol 500mg"
+
+
+def test_mark_synced_over_rest_is_one_request_and_skips_rows_edited_meanwhile(engine, monkeypatch):
+    local = engine.local_supabase
+    engine.bulk_mark = False
+    engine.push_source = "scan"
+    engine.tombstone_logs["local_to_remote"] = False
+    engine.PHARMACY_DB_TABLES = ["customers"]
+    for record_id in range(1, 51):
+        insert(local, "customers", {"id": record_id, "name": f"Customer {record_id}", "updated_at": f"2026-01-01T08:{record_id:02d}:00"})
+
+    # Customer 7 is edited again while its previous version is being pushed
+    upsert_records = engine._upsert_records
+
+    def edit_during_push(target, table, records):
+        result = yield from upsert_records(target, table, records)
+        if target == "remote" and local.tables["customers"][7]["name"] != "Edited":
+            update(local, "customers", 7, name="Edited", updated_at="2026-01-01T09:00:00")
+        return result
+    monkeypatch.setattr(engine, "_upsert_records", edit_during_push)
+    local.round_trips = 0
+
+    engine.sync_local_to_remote()
+
+    # Page read, mark, and the empty page read
+    assert local.round_trips == 3
+    assert [row["id"] for row in local.tables["customers"].values() if not row["synced"]] == [7]
+
+
+def tombstone(db, table, seq, record_id, deleted_at):
+    """Record a delete in the sync_tombstones log the way its trigger does"""
+    db.put("sync_tombstones", {"id": seq, "seq": seq, "table_name": table, "record_id": str(record_id), "deleted_at": deleted_at})
+
+
+def test_tombstone_committed_late_with_a_lower_seq_is_still_applied(engine):
+    local, remote = engine.local_supabase, engine.remote_supabase
+    for record_id in (1, 2, 3):
+        local.put("customers", {"id": record_id, "name": f"Customer {record_id}", "synced": True, "updated_at": "2026-01-01T08:00:00"})
+    tombstone(remote, "customers", 1, 1, "2026-01-01T09:00:00")
+    tombstone(remote, "customers", 3, 3, "2026-01-01T09:00:02")
+
+    engine.sync_remote_to_local()
+    # The delete that took seq 2 commits after seq 3 was applied and acknowledged
+    tombstone(remote, "customers", 2, 2, "2026-01-01T09:00:01")
+    engine.sync_remote_to_local()
+    engine.sync_remote_to_local()
+
+    assert local.tables["customers"] == {}
+    # Tombstones read again behind the cursor are only applied once
+    assert engine.metrics.rows_pulled["customers"] == 3
+
+
+def test_push_sends_one_upsert_and_one_mark_per_batch(engine):
+    local, remote = engine.local_supabase, engine.remote_supabase
+    engine.push_source = "scan"
+    engine.tombstone_logs["local_to_remote"] = False
+    engine.PHARMACY_DB_TABLES = ["notifications"]
+    engine.batch_size = engine.max_batch_size = 100
+    for record_id in range(1, 251):
+        insert(local, "notifications", {"id": record_id, "message": f"Notification {record_id}"})
+    local.round_trips = 0
+
+    engine.sync_local_to_remote()
+
+    assert len(remote.tables["notifications"]) == 250
+    assert all(row["synced"] for row in local.tables["notifications"].values())
+    assert remote.round_trips == 3
+    # The page read, one mark per batch, and the empty page read
+    assert local.round_trips == 5
+
+
+def test_push_over_rest_sends_one_upsert_per_batch(engine):
+    local, remote = engine.local_supabase, engine.remote_supabase
+    engine.push_source = "scan"
+    engine.tombstone_logs["local_to_remote"] = False
+    engine.PHARMACY_DB_TABLES = ["notifications"]
+    engine.batch_size = engine.max_batch_size = 100
+    engine.bulk_apply["remote"] = False
+    for record_id in range(1, 251):
+        insert(local, "notifications", {"id": record_id, "message": f"Notification {record_id}"})
+
+    engine.sync_local_to_remote()
+
+    assert len(remote.tables["notifications"]) == 250
+    assert remote.round_trips == 3
+
+
+def test_rejected_row_fails_alone_and_stays_unsynced(engine, monkeypatch):
+    local, remote = engine.local_supabase, engine.remote_supabase
+    engine.PHARMACY_DB_TABLES = ["notifications"]
+    for record_id in range(1, 9):
+        insert(local, "notifications", {"id": record_id, "message": f"Notification {record_id}"})
+    upsert_records = engine._upsert_records
+
+    def reject_row_5(target, table, records):
+        if target == "remote" and any(record["id"] == 5 for record in records):
+            raise ValueError("violates check constraint")
+        return (yield from upsert_records(target, table, records))
+    monkeypatch.setattr(engine, "_upsert_records", reject_row_5)
+
+    engine.sync_local_to_remote()
+
+    assert sorted(remote.tables["notifications"]) == [1, 2, 3, 4, 6, 7, 8]
+    assert [row["id"] for row in local.tables["notifications"].values() if not row["synced"]] == [5]
+    # Its outbox event is kept for the next cycle
+    assert [event["record_id"] for event in local.tables["sync_outbox"].values()] == ["5"]
+    assert not engine.is_healthy
+
+
+def test_pull_pages_through_rows_sharing_an_updated_at(engine):
+    local, remote = engine.local_supabase, engine.remote_supabase
+    engine.PHARMACY_DB_TABLES = ["notifications"]
+    engine.page_size = 10
+    for record_id in range(1, 26):
+        remote.put("notifications", {"id": record_id, "message": f"Notification {record_id}", "updated_at": "2026-01-01T08:00:00"})
+
+    engine.sync_remote_to_local()
+
+    assert sorted(local.tables["notifications"]) == list(range(1, 26))
+    assert all(row["synced"] for row in local.tables["notifications"].values())
+    assert engine.state.get_watermark("notifications", "remote_to_local") == ("2026-01-01T08:00:00", "25")
+
+
+def test_pull_resumes_after_the_last_row_received(engine):
+    local, remote = engine.local_supabase, engine.remote_supabase
+    engine.PHARMACY_DB_TABLES = ["notifications"]
+    engine.page_size = 10
+    for record_id in range(1, 6):
+        remote.put("notifications", {"id": record_id, "message": f"Notification {record_id}", "updated_at": "2026-01-01T08:00:00"})
+    engine.sync_remote_to_local()
+
+    # Same updated_at as the watermark, higher id
+    remote.put("notifications", {"id": 6, "message": "Notification 6", "updated_at": "2026-01-01T08:00:00"})
+    engine.sync_remote_to_local()
+
+    assert sorted(local.tables["notifications"]) == list(range(1, 7))
+    assert engine.metrics.rows_pulled["notifications"] == 6
+
+
+def test_scan_push_pages_through_unsynced_rows_by_id(engine):
+    local, remote = engine.local_supabase, engine.remote_supabase
+    engine.push_source = "scan"
+    engine.tombstone_logs["local_to_remote"] = False
+    engine.PHARMACY_DB_TABLES = ["notifications"]
+    engine.page_size = 10
+    for record_id in range(1, 26):
+        insert(local, "notifications", {"id": record_id, "message": f"Notification {record_id}"})
+    local.put("notifications", {"id": 26, "message": "Already synced", "synced": True, "updated_at": "2026-01-01T08:00:00"})
+
+    engine.sync_local_to_remote()
+
+    assert sorted(remote.tables["notifications"]) == list(range(1, 26))
+
+
+def test_outbox_coalesces_changes_and_pushes_deletes(engine):
+    local, remote = engine.local_supabase, engine.remote_supabase
+    engine.PHARMACY_DB_TABLES = ["notifications"]
+    remote.put("notifications", {"id": 1, "message": "Pushed earlier", "updated_at": "2026-01-01T07:00:00"})
+    local.put("notifications", {"id": 1, "message": "Pushed earlier", "synced": True, "updated_at": "2026-01-01T07:00:00"})
+    local.remove("notifications", 1)
+    local.capture("notifications", {"id": 1}, "DELETE")
+    insert(local, "notifications", {"id": 2, "message": "Draft"})
+    update(local, "notifications", 2, message="Final", updated_at="2026-01-01T08:05:00")
+
+    engine.sync_local_to_remote()
+
+    assert list(remote.tables["notifications"]) == [2]
+    assert remote.tables["notifications"][2]["message"] == "Final"
+    assert engine.metrics.rows_pushed["notifications"] == 2
+    assert local.tables["sync_outbox"] == {}
+
+
+def test_outbox_delete_of_a_row_inserted_again_pushes_the_row(engine):
+    local, remote = engine.local_supabase, engine.remote_supabase
+    engine.PHARMACY_DB_TABLES = ["notifications"]
+    insert(local, "notifications", {"id": 1, "message": "First"})
+    local.remove("notifications", 1)
+    local.capture("notifications", {"id": 1}, "DELETE")
+    # Inserted again by a transaction whose outbox event has not been read yet
+    local.put("notifications", {"id": 1, "message": "Again", "synced": False, "updated_at": "2026-01-01T08:10:00"})
+
+    engine.sync_local_to_remote()
+
+    assert remote.tables["notifications"][1]["message"] == "Again"
+
+
+def test_pulled_tombstones_delete_synced_rows_only(engine):
+    local, remote = engine.local_supabase, engine.remote_supabase
+    engine.PHARMACY_DB_TABLES = ["notifications"]
+    for record_id in (1, 2, 3):
+        local.put("notifications", {"id": record_id, "message": "Read", "synced": True, "updated_at": "2026-01-01T08:00:00"})
+    update(local, "notifications", 2, message="Edited on the branch", updated_at="2026-01-01T09:30:00")
+    for seq, record_id in enumerate((1, 2, 3), start=1):
+        tombstone(remote, "notifications", seq, record_id, f"2026-01-01T09:00:0{seq}")
+    # Inserted again at HQ after its delete
+    remote.put("notifications", {"id": 3, "message": "Restored", "updated_at": "2026-01-01T09:10:00"})
+
+    engine.sync_remote_to_local()
+
+    assert sorted(local.tables["notifications"]) == [2, 3]
+    assert local.tables["notifications"][2]["message"] == "Edited on the branch"
+    assert local.tables["notifications"][3]["message"] == "Restored"
+    acks = list(remote.tables["sync_tombstone_acks"].values())
+    assert [(ack["node_id"], ack["table_name"], ack["last_seq"]) for ack in acks] == [(engine.node_id, "notifications", 3)]
+
+
+def test_tombstones_are_compacted_once_every_node_has_applied_them(engine):
+    remote = engine.remote_supabase
+    engine.PHARMACY_DB_TABLES = ["notifications"]
+    tombstone(remote, "notifications", 1, 1, "2020-01-01T09:00:00")
+    tombstone(remote, "notifications", 2, 2, "2020-01-01T09:00:01")
+    tombstone(remote, "notifications", 3, 3, datetime.now(timezone.utc).replace(tzinfo=None).isoformat())
+    # Another branch has only applied the first one
+    remote.put("sync_tombstone_acks", {"node_id": "other-branch", "table_name": "notifications", "last_seq": 1}, ("other-branch", "notifications"))
+
+    engine.sync_remote_to_local()
+    engine._run_steps(engine._compact_tombstones())
+
+    assert sorted(remote.tables["sync_tombstones"]) == [2, 3]
+
+
+def test_pushed_rows_are_not_pulled_back(engine):
+    local, remote = engine.local_supabase, engine.remote_supabase
+    engine.PHARMACY_DB_TABLES = ["notifications"]
+    for record_id in range(1, 6):
+        insert(local, "notifications", {"id": record_id, "message": f"Notification {record_id}"})
+    engine.sync_local_to_remote()
+    # Changed at HQ after it was pushed
+    remote.tables["notifications"][4].update(message="Edited at HQ", updated_at="2026-01-01T10:00:00")
+
+    engine.sync_remote_to_local()
+
+    assert engine.metrics.echoes_skipped["notifications"] == 4
+    assert engine.metrics.rows_pulled["notifications"] == 1
+    assert local.tables["notifications"][4]["message"] == "Edited at HQ"
+    # Every pushed version has been seen again, so the next pull reads full rows
+    assert not engine.state.has_pushed_versions("notifications")
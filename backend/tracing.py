@@ -0,0 +1,162 @@
+"""
+Tracing and profiling for the pharmacy sync service
+
+With SYNC_TRACE_FILE set, every sync cycle is recorded as a tree of spans
+written as JSON lines, one span per line, using OpenTelemetry's span field
+names:
+
+    cycle > push / pull > lane > table > page > request
+
+Request spans come from the HTTP clients and carry the method, path, status
+and body bytes of each PostgREST call; the time of a page span not covered
+by its requests is spent in the sync service itself. Spans are written when
+they end, so children precede their parents in the file.
+
+`python sync.py --profile FILE` runs a single cycle under SamplingProfiler,
+which samples the stacks of every thread (the threaded engine syncs tables
+on worker threads, which cProfile would not see) and writes them in the
+collapsed-stack format read by flamegraph.pl and speedscope.
+"""
+
+import contextvars
+import json
+import os
+import secrets
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+# The span the code running in this thread or task belongs to
+_current_span = contextvars.ContextVar("sync_span", default=None)
+
+
+class Tracer:
+    """Writes spans of sync cycles to a JSON lines file; does nothing without a path"""
+
+    def __init__(self, path=None):
+        """Append spans to the file at path"""
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, "a", buffering=1, encoding="utf-8") if path else None
+
+    @property
+    def enabled(self):
+        """Whether spans are being recorded"""
+        return self._file is not None
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """Record the enclosed block as a span, a child of the span it runs in.
+
+        Yields the span's attributes, so counts known only inside the block
+        (such as rows) can be added to them.
+        """
+        if self._file is None:
+            yield {}
+            return
+
+        parent = _current_span.get()
+        span = self._new_span(name, parent, attributes)
+        token = _current_span.set(span)
+        started = time.perf_counter_ns()
+        try:
+            yield span["attributes"]
+        except BaseException as e:
+            span["status"] = {"code": "ERROR", "message": str(e)}
+            raise
+        finally:
+            _current_span.reset(token)
+            span["endTimeUnixNano"] = span["startTimeUnixNano"] + time.perf_counter_ns() - started
+            self._write(span)
+
+    def record(self, name, start_ns, end_ns, **attributes):
+        """Record a span that has already ended, e.g. an HTTP request, as a child of the current span"""
+        if self._file is None:
+            return
+        span = self._new_span(name, _current_span.get(), attributes)
+        span["startTimeUnixNano"] = start_ns
+        span["endTimeUnixNano"] = end_ns
+        self._write(span)
+
+    def close(self):
+        """Close the trace file"""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _new_span(self, name, parent, attributes):
+        return {
+            "traceId": parent["traceId"] if parent else secrets.token_hex(16),
+            "spanId": secrets.token_hex(8),
+            "parentSpanId": parent["spanId"] if parent else None,
+            "name": name,
+            "startTimeUnixNano": time.time_ns(),
+            "attributes": attributes,
+        }
+
+    def _write(self, span):
+        span["durationMs"] = round((span["endTimeUnixNano"] - span["startTimeUnixNano"]) / 1e6, 3)
+        line = json.dumps(span, default=str)
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line + "\n")
+
+
+class SamplingProfiler:
+    """Samples the call stacks of every thread at a fixed interval while running"""
+
+    def __init__(self, interval=0.005):
+        """Take a sample every interval seconds"""
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start sampling in a background thread"""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sync-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling"""
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, path):
+        """Write the samples as collapsed stacks ("outer;...;inner count" per line)"""
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{';'.join(stack)} {count}\n")
+
+    def summary(self, limit=20):
+        """Return a table of the functions with the most samples, inclusive and on top of the stack"""
+        inclusive, own = Counter(), Counter()
+        for stack, count in self.stacks.items():
+            for frame in set(stack):
+                inclusive[frame] += count
+            own[stack[-1]] += count
+        # Shares of all thread samples, so threads waiting on each other count too
+        total = max(sum(self.stacks.values()), 1)
+        lines = [f"{self.samples} samples of every thread, {self.interval * 1000:g} ms apart", "  total    self  function"]
+        for frame, count in inclusive.most_common(limit):
+            lines.append(f"{count / total:6.1%}  {own[frame] / total:6.1%}  {frame}")
+        return "\n".join(lines)
+
+    def _run(self):
+        own_thread = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[tuple(reversed(stack))] += 1
+            self.samples += 1